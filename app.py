@@ -1,23 +1,59 @@
 from flask import Flask, request, jsonify, Response
-import pika
-import json
 import logging
-from retrying import retry
-from database import init_db, save_notification, get_user_notifications
+import json
+from database import (
+    init_db,
+    save_notification,
+    save_notifications,
+    new_notification_document,
+    get_user_notifications_page,
+    get_notification_summary,
+    iter_user_notifications,
+    content_fields,
+    template_fields,
+    tenant_fields,
+    save_template,
+    get_template,
+    create_fanout_job,
+    get_fanout_job,
+    add_segment_members,
+    count_segment_members,
+)
+from publisher import get_publisher
+from validation import (
+    validate_notification,
+    parse_inbox_params,
+    parse_export_params,
+    parse_dead_letter_limit,
+    validate_template,
+    validate_fanout,
+    validate_segment_members,
+    scheduled_for,
+)
+from retries import list_dead_letters, replay_dead_letters
+from export import stream_ndjson
+from lanes import get_lane
+from latency import stamp
+from templates import template_cache
+from jinja2 import TemplateError
+from bson.errors import InvalidId
 import warnings
 import time
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from metrics import (
+    NOTIFICATIONS_SENT,
+    NOTIFICATION_DURATION,
+    API_REQUESTS,
+    QUEUE_ERRORS,
+)
 from config import (
     API_HOST,
     API_PORT,
     DEBUG,
     LOG_LEVEL,
-    RABBITMQ_HOST,
-    RABBITMQ_PORT,
-    RABBITMQ_USER,
-    RABBITMQ_PASSWORD,
-    RABBITMQ_URL,
-    RABBITMQ_QUEUE,
+    BATCH_MAX_SIZE,
+    INGESTION_MODE,
+    RABBITMQ_FANOUT_QUEUE,
 )
 
 # Ignore unnecessary warnings
@@ -31,64 +67,53 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Define Prometheus metrics
-NOTIFICATIONS_SENT = Counter(
-    "notifications_sent_total", "Total number of notifications sent", ["type"]
-)
-NOTIFICATION_DURATION = Histogram(
-    "notification_processing_seconds", "Time spent processing notification requests"
-)
-API_REQUESTS = Counter(
-    "api_requests_total", "Total API requests", ["endpoint", "method", "status"]
-)
-QUEUE_ERRORS = Counter("queue_errors_total", "Total number of queue errors")
-
 app = Flask(__name__)
 app.logger.setLevel(logging.ERROR)  # Only show errors from Flask
 
-# Quick database setup
-init_db()
 
+def check_template(notification_data):
+    """
+    Make sure a templated notification's template exists and renders
 
-# RabbitMQ connection setup
-def get_rabbitmq_connection():
-    # Use URL-based connection if available, otherwise use parameters
-    if RABBITMQ_URL:
-        connection = pika.BlockingConnection(pika.URLParameters(RABBITMQ_URL))
-    else:
-        credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials
-            )
-        )
-    return connection
+    Goes through the compiled-template cache, so it's a Mongo read per
+    template every TEMPLATE_CACHE_TTL_SECONDS, not per request. Returns the
+    error message, or None.
+    """
+    template_id = notification_data.get("template_id")
+    if not template_id:
+        return None
+    try:
+        template_cache.get(template_id, get_template)
+    except TemplateError:
+        return f"unknown template_id: {template_id}"
+    return None
 
 
-# Retry logic for failed notifications
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
-def send_to_queue(notification_data):
+def send_to_queue(notification_data, priority=None):
     """
-    Send a notification to the RabbitMQ queue
+    Send a notification to its priority lane's RabbitMQ queue
+
+    Returns once the broker has confirmed the message; retries on nacks and
+    dropped connections happen inside the publisher
 
     Args:
         notification_data (dict): Notification data including id, user_id, type, and content
+        priority (str): lane name, None for the default lane
     """
-    connection = get_rabbitmq_connection()
-    channel = connection.channel()
-    channel.queue_declare(
-        queue=RABBITMQ_QUEUE, durable=True
-    )  # Convert notification data to JSON
-    message = json.dumps(notification_data)
-
-    channel.basic_publish(
-        exchange="",
-        routing_key=RABBITMQ_QUEUE,
-        body=message,
-        properties=pika.BasicProperties(delivery_mode=2),  # make message persistent
-    )
+    # Reuses this worker's long-lived connection instead of dialing RabbitMQ every time
+    get_publisher().publish(notification_data, routing_key=get_lane(priority).queue)
 
-    connection.close()
+
+def send_batch_to_queue(notifications, priority=None):
+    """
+    Send a batch of notifications to one lane's RabbitMQ queue over one channel
+
+    Returns:
+        list: an error message (or None) for each notification
+    """
+    return get_publisher().publish_many(
+        notifications, routing_key=get_lane(priority).queue
+    )
 
 
 @app.route("/notifications", methods=["POST"])
@@ -104,50 +129,93 @@ def send_notification():
         ).inc()
         return jsonify({"error": "Request body is required"}), 400
 
-    user_id = data.get("user_id")
-    notification_type = data.get("type")
-    content = data.get("content")
-
-    if not user_id:
+    # Same rules as the batch endpoint
+    error = validate_notification(data)
+    if error:
         API_REQUESTS.labels(
             endpoint="/notifications", method="POST", status="400"
         ).inc()
-        return jsonify({"error": "user_id is required"}), 400
+        return jsonify({"error": error}), 400
 
-    if not notification_type:
-        API_REQUESTS.labels(
-            endpoint="/notifications", method="POST", status="400"
-        ).inc()
-        return jsonify({"error": "type is required"}), 400
+    user_id = data["user_id"]
+    notification_type = data["type"]
+    # Templated notifications travel as template_id + variables, not text
+    fields = {**content_fields(data), **tenant_fields(data)}
 
-    if not content:
-        API_REQUESTS.labels(
-            endpoint="/notifications", method="POST", status="400"
-        ).inc()
-        return jsonify({"error": "content is required"}), 400
-
-    # Validate notification type
-    valid_types = ["email", "sms", "in-app"]
-    if notification_type not in valid_types:
-        API_REQUESTS.labels(
-            endpoint="/notifications", method="POST", status="400"
-        ).inc()
-        return jsonify({"error": f"type must be one of: {', '.join(valid_types)}"}), 400
+    # Carried along in the message so the consumer can time every stage
+    timestamps = {"received": start_time}
 
     try:
-        # Save the notification to the database
-        notification_id = save_notification(user_id, notification_type, content)
+        # In here, since a template cache miss reads from Mongo
+        error = check_template(data)
+        if error:
+            API_REQUESTS.labels(
+                endpoint="/notifications", method="POST", status="400"
+            ).inc()
+            return jsonify({"error": error}), 400
+
+        send_at = scheduled_for(data)
+        if send_at is not None:
+            # Not yet - it waits in Mongo (write-behind or not) until
+            # scheduler.py publishes it
+            notification_id = save_notification(
+                user_id,
+                notification_type,
+                data.get("content"),
+                **template_fields(data),
+                **tenant_fields(data),
+                send_at=send_at,
+                priority=data.get("priority"),
+            )
+            API_REQUESTS.labels(
+                endpoint="/notifications", method="POST", status="200"
+            ).inc()
+            NOTIFICATION_DURATION.observe(time.time() - start_time)
+            return (
+                jsonify(
+                    {
+                        "message": "Notification scheduled",
+                        "notification_id": notification_id,
+                        "send_at": send_at.isoformat(),
+                    }
+                ),
+                200,
+            )
+
+        if INGESTION_MODE == "write_behind":
+            # Pick the id ourselves and let persister.py save the record later
+            document = new_notification_document(
+                user_id,
+                notification_type,
+                data.get("content"),
+                **template_fields(data),
+                **tenant_fields(data),
+            )
+            notification_id = str(document["_id"])
+        else:
+            # Save the notification to the database
+            notification_id = save_notification(
+                user_id,
+                notification_type,
+                data.get("content"),
+                **template_fields(data),
+                **tenant_fields(data),
+            )
+            timestamps["persisted"] = time.time()
 
         # Prepare notification data for the queue
         notification_data = {
             "id": notification_id,
             "user_id": user_id,
             "type": notification_type,
-            "content": content,
+            **fields,
+            "timestamps": timestamps,
         }
+        if INGESTION_MODE == "write_behind":
+            notification_data["created_at"] = document["created_at"].isoformat()
 
         # Send the notification to the queue
-        send_to_queue(notification_data)
+        send_to_queue(stamp(notification_data, "published"), data.get("priority"))
 
         NOTIFICATIONS_SENT.labels(type=notification_type).inc()
         API_REQUESTS.labels(
@@ -174,16 +242,331 @@ def send_notification():
         return jsonify({"error": str(e)}), 500
 
 
+def parse_batch_body():
+    """
+    Pull the list of notifications out of a batch request
+
+    Accepts a JSON array, {"notifications": [...]}, or NDJSON (one
+    notification per line). NDJSON lines that aren't valid JSON come back as
+    an error string in their slot so they get reported per item.
+    """
+    if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(f"invalid JSON: {str(e)}")
+        return items
+
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get("notifications")
+    return data if isinstance(data, list) else None
+
+
+@app.route("/notifications/batch", methods=["POST"])
+def send_notification_batch():
+    """Bulk gateway - lots of notifications, one request, one insert, one channel"""
+    start_time = time.time()
+    items = parse_batch_body()
+
+    if not items:
+        API_REQUESTS.labels(
+            endpoint="/notifications/batch", method="POST", status="400"
+        ).inc()
+        return jsonify({"error": "A non-empty list of notifications is required"}), 400
+
+    if len(items) > BATCH_MAX_SIZE:
+        API_REQUESTS.labels(
+            endpoint="/notifications/batch", method="POST", status="413"
+        ).inc()
+        return (
+            jsonify({"error": f"Batch size must not exceed {BATCH_MAX_SIZE}"}),
+            413,
+        )
+
+    # Check everything first, so only the good ones touch Mongo and RabbitMQ
+    results = [{"index": index} for index in range(len(items))]
+    valid = []
+    try:
+        # In the try, since template cache misses read from Mongo
+        for index, item in enumerate(items):
+            error = item if isinstance(item, str) else validate_notification(item)
+            error = error or check_template(item)
+            if error:
+                results[index]["error"] = error
+            else:
+                valid.append(index)
+
+        # send_at as a datetime - or None if it's unset or already passed
+        notifications = [
+            dict(items[index], send_at=scheduled_for(items[index])) for index in valid
+        ]
+        saved = save_notifications(notifications)
+        timestamps = {"received": start_time, "persisted": time.time()}
+
+        # One publish_many per priority lane: {priority: (indexes, messages)}
+        lanes = {}
+        for index, notification, (notification_id, error) in zip(valid, notifications, saved):
+            if error:
+                results[index]["error"] = error
+                continue
+            if notification["send_at"] is not None:
+                # scheduler.py publishes this one when it's due
+                results[index]["notification_id"] = notification_id
+                results[index]["send_at"] = notification["send_at"].isoformat()
+                continue
+            queued, messages = lanes.setdefault(items[index].get("priority"), ([], []))
+            queued.append(index)
+            messages.append(
+                {
+                    "id": notification_id,
+                    "user_id": items[index]["user_id"],
+                    "type": items[index]["type"],
+                    **content_fields(items[index]),
+                    **tenant_fields(items[index]),
+                    "timestamps": dict(timestamps),
+                }
+            )
+            results[index]["notification_id"] = notification_id
+
+        for priority, (queued, messages) in lanes.items():
+            published = time.time()
+            for message in messages:
+                stamp(message, "published", now=published)
+            for index, error in zip(queued, send_batch_to_queue(messages, priority)):
+                if error:
+                    QUEUE_ERRORS.inc()
+                    results[index]["error"] = error
+                else:
+                    NOTIFICATIONS_SENT.labels(type=items[index]["type"]).inc()
+
+    except Exception as e:
+        logger.error(f"Error sending notification batch: {str(e)}")
+        QUEUE_ERRORS.inc()
+        API_REQUESTS.labels(
+            endpoint="/notifications/batch", method="POST", status="500"
+        ).inc()
+        return jsonify({"error": str(e)}), 500
+
+    rejected = sum(1 for result in results if "error" in result)
+    API_REQUESTS.labels(
+        endpoint="/notifications/batch", method="POST", status="200"
+    ).inc()
+    NOTIFICATION_DURATION.observe(time.time() - start_time)
+
+    return (
+        jsonify(
+            {
+                "accepted": len(results) - rejected,
+                "rejected": rejected,
+                "results": results,
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/notifications/fanout", methods=["POST"])
+def send_notification_fanout():
+    """
+    One notification for a lot of users - a list of user_ids or a segment_id
+
+    Just records the job and queues its id; fanout.py does the expansion in
+    chunks, so this returns right away however big the audience is
+    """
+    data = request.get_json(silent=True)
+    error = validate_fanout(data)
+    if error:
+        API_REQUESTS.labels(
+            endpoint="/notifications/fanout", method="POST", status="400"
+        ).inc()
+        return jsonify({"error": error}), 400
+
+    try:
+        # In here, since a template cache miss reads from Mongo
+        error = check_template(data)
+        if error:
+            API_REQUESTS.labels(
+                endpoint="/notifications/fanout", method="POST", status="400"
+            ).inc()
+            return jsonify({"error": error}), 400
+
+        job = {"type": data["type"], **content_fields(data), **tenant_fields(data)}
+        if data.get("priority"):
+            job["priority"] = data["priority"]
+        if "user_ids" in data:
+            # Sorted, so the checkpoint can be "the last user id done"
+            job["user_ids"] = sorted(set(data["user_ids"]))
+            job["total"] = len(job["user_ids"])
+        else:
+            job["segment_id"] = data["segment_id"]
+            job["total"] = count_segment_members(data["segment_id"])
+
+        job_id = create_fanout_job(job)
+        get_publisher().publish({"job_id": job_id}, routing_key=RABBITMQ_FANOUT_QUEUE)
+
+        API_REQUESTS.labels(
+            endpoint="/notifications/fanout", method="POST", status="202"
+        ).inc()
+        return jsonify({"job_id": job_id, "total": job["total"]}), 202
+
+    except Exception as e:
+        logger.error(f"Error creating fan-out job: {str(e)}")
+        QUEUE_ERRORS.inc()
+        API_REQUESTS.labels(
+            endpoint="/notifications/fanout", method="POST", status="500"
+        ).inc()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/notifications/fanout/<job_id>", methods=["GET"])
+def get_fanout_job_endpoint(job_id):
+    """How far a fan-out job has got"""
+    try:
+        job = get_fanout_job(job_id)
+    except InvalidId:
+        job = None
+    except Exception as e:
+        logger.error(f"Error retrieving fan-out job: {str(e)}")
+        API_REQUESTS.labels(
+            endpoint="/notifications/fanout/<job_id>", method="GET", status="500"
+        ).inc()
+        return jsonify({"error": str(e)}), 500
+
+    if job is None:
+        API_REQUESTS.labels(
+            endpoint="/notifications/fanout/<job_id>", method="GET", status="404"
+        ).inc()
+        return jsonify({"error": "Fan-out job not found"}), 404
+
+    API_REQUESTS.labels(
+        endpoint="/notifications/fanout/<job_id>", method="GET", status="200"
+    ).inc()
+    return (
+        jsonify(
+            {
+                "job_id": job_id,
+                "status": job["status"],
+                "total": job.get("total"),
+                "expanded": job["expanded"],
+                "error": job.get("error"),
+                "created_at": job["created_at"].isoformat(),
+                "updated_at": job["updated_at"].isoformat(),
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/segments/<segment_id>/members", methods=["POST"])
+def add_segment_members_endpoint(segment_id):
+    """Add up to BATCH_MAX_SIZE users to a segment that fan-out jobs can target"""
+    data = request.get_json(silent=True)
+    error = validate_segment_members(data)
+    if error:
+        API_REQUESTS.labels(
+            endpoint="/segments/<segment_id>/members", method="POST", status="400"
+        ).inc()
+        return jsonify({"error": error}), 400
+
+    try:
+        added = add_segment_members(segment_id, data["user_ids"])
+        API_REQUESTS.labels(
+            endpoint="/segments/<segment_id>/members", method="POST", status="200"
+        ).inc()
+        return jsonify({"segment_id": segment_id, "added": added}), 200
+
+    except Exception as e:
+        logger.error(f"Error adding segment members: {str(e)}")
+        API_REQUESTS.labels(
+            endpoint="/segments/<segment_id>/members", method="POST", status="500"
+        ).inc()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/templates", methods=["POST"])
+def register_template_endpoint():
+    """Register (or replace) a template that notifications can name by template_id"""
+    data = request.get_json(silent=True)
+    error = validate_template(data)
+    if error:
+        API_REQUESTS.labels(endpoint="/templates", method="POST", status="400").inc()
+        return jsonify({"error": error}), 400
+
+    try:
+        version = save_template(data["template_id"], data["content"])
+        # Other processes catch up when their cached copy expires
+        template_cache.invalidate(data["template_id"])
+        API_REQUESTS.labels(endpoint="/templates", method="POST", status="200").inc()
+        return jsonify({"template_id": data["template_id"], "version": version}), 200
+
+    except Exception as e:
+        logger.error(f"Error saving template: {str(e)}")
+        API_REQUESTS.labels(endpoint="/templates", method="POST", status="500").inc()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/templates/<template_id>", methods=["GET"])
+def get_template_endpoint(template_id):
+    """Look at a registered template"""
+    try:
+        template = get_template(template_id)
+    except Exception as e:
+        logger.error(f"Error retrieving template: {str(e)}")
+        API_REQUESTS.labels(endpoint="/templates/<template_id>", method="GET", status="500").inc()
+        return jsonify({"error": str(e)}), 500
+
+    if template is None:
+        API_REQUESTS.labels(endpoint="/templates/<template_id>", method="GET", status="404").inc()
+        return jsonify({"error": "Template not found"}), 404
+
+    API_REQUESTS.labels(endpoint="/templates/<template_id>", method="GET", status="200").inc()
+    return (
+        jsonify(
+            {
+                "template_id": template["_id"],
+                "content": template["content"],
+                "version": template["version"],
+                "updated_at": template["updated_at"].isoformat(),
+            }
+        ),
+        200,
+    )
+
+
 @app.route("/users/<int:user_id>/notifications", methods=["GET"])
 def get_user_notifications_endpoint(user_id):
-    """Inbox viewer - shows all notifications for a user"""
+    """
+    Inbox viewer - one page of a user's notifications, newest first
+
+    Query params: limit, before/after (cursors from a previous page),
+    status, type, fields (comma separated projection)
+    """
+    limit, options, error = parse_inbox_params(request.args)
+    if error:
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications", method="GET", status="400"
+        ).inc()
+        return jsonify({"error": error}), 400
+
     try:
-        # Pull their message history
-        notifications = get_user_notifications(user_id)
+        # Pull one page of their message history
+        page = get_user_notifications_page(user_id, limit, **options)
         API_REQUESTS.labels(
             endpoint="/users/<user_id>/notifications", method="GET", status="200"
         ).inc()
-        return jsonify({"user_id": user_id, "notifications": notifications}), 200
+        return jsonify({"user_id": user_id, **page}), 200
+
+    except ValueError as e:
+        # Bad cursor
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications", method="GET", status="400"
+        ).inc()
+        return jsonify({"error": str(e)}), 400
 
     except Exception as e:
         logger.error(f"Error retrieving notifications: {str(e)}")
@@ -193,6 +576,104 @@ def get_user_notifications_endpoint(user_id):
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/users/<int:user_id>/notifications/export", methods=["GET"])
+def export_user_notifications_endpoint(user_id):
+    """
+    Someone's full history as NDJSON, streamed straight off the cursor
+
+    Query params: from, to (ISO 8601, to is exclusive), format (ndjson or gzip)
+    """
+    start, end, compress, error = parse_export_params(request.args)
+    if error:
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications/export", method="GET", status="400"
+        ).inc()
+        return jsonify({"error": error}), 400
+
+    def generate():
+        try:
+            yield from stream_ndjson(
+                iter_user_notifications(user_id, start, end), compress=compress
+            )
+        except Exception as e:
+            # Headers are long gone by now, all we can do is cut the stream short
+            logger.error(f"Export for user {user_id} failed mid-stream: {str(e)}")
+            raise
+
+    filename = f"notifications-{user_id}.ndjson" + (".gz" if compress else "")
+    API_REQUESTS.labels(
+        endpoint="/users/<user_id>/notifications/export", method="GET", status="200"
+    ).inc()
+    return Response(
+        generate(),
+        mimetype="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.route("/users/<int:user_id>/notifications/summary", methods=["GET"])
+def get_notification_summary_endpoint(user_id):
+    """Badge counts - totals by status and type, no inbox download needed"""
+    try:
+        summary = get_notification_summary(user_id)
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications/summary", method="GET", status="200"
+        ).inc()
+        return jsonify({"user_id": user_id, **summary}), 200
+
+    except Exception as e:
+        logger.error(f"Error retrieving notification summary: {str(e)}")
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications/summary", method="GET", status="500"
+        ).inc()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/dead-letters", methods=["GET"])
+def list_dead_letters_endpoint():
+    """Peek at the oldest messages that ran out of retries (?limit=)"""
+    limit, error = parse_dead_letter_limit(request.args.get("limit"))
+    if error:
+        API_REQUESTS.labels(endpoint="/dead-letters", method="GET", status="400").inc()
+        return jsonify({"error": error}), 400
+
+    try:
+        total, dead_letters = list_dead_letters(limit)
+        API_REQUESTS.labels(endpoint="/dead-letters", method="GET", status="200").inc()
+        return jsonify({"total": total, "dead_letters": dead_letters}), 200
+
+    except Exception as e:
+        logger.error(f"Error listing dead letters: {str(e)}")
+        API_REQUESTS.labels(endpoint="/dead-letters", method="GET", status="500").inc()
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/dead-letters/replay", methods=["POST"])
+def replay_dead_letters_endpoint():
+    """Put up to {"limit": n} dead letters back on the main queue, oldest first"""
+    data = request.get_json(silent=True) or {}
+    limit, error = parse_dead_letter_limit(data.get("limit"), maximum=BATCH_MAX_SIZE)
+    if error:
+        API_REQUESTS.labels(
+            endpoint="/dead-letters/replay", method="POST", status="400"
+        ).inc()
+        return jsonify({"error": error}), 400
+
+    try:
+        replayed = replay_dead_letters(limit)
+        API_REQUESTS.labels(
+            endpoint="/dead-letters/replay", method="POST", status="200"
+        ).inc()
+        return jsonify({"replayed": replayed}), 200
+
+    except Exception as e:
+        logger.error(f"Error replaying dead letters: {str(e)}")
+        API_REQUESTS.labels(
+            endpoint="/dead-letters/replay", method="POST", status="500"
+        ).inc()
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route("/health", methods=["GET"])
 def health_check():
     """Just checking if we're still alive"""
@@ -207,5 +688,8 @@ def metrics():
 
 
 if __name__ == "__main__":
+    # The dev server is a single process, so it can set up the indexes
+    # itself (in production that's init_indexes.py's job, once per deploy)
+    init_db()
     # Fire it up! Let the notifications flow
     app.run(host=API_HOST, port=API_PORT, debug=DEBUG)
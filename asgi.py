@@ -0,0 +1,356 @@
+"""
+ASGI entry point for the notification API
+
+Talks to Mongo (Motor) and RabbitMQ (aio-pika) without blocking, so one
+worker can keep lots of requests in flight. It serves the hot paths, with
+the same response shapes as app.py:
+
+    POST /notifications
+    GET  /users/{user_id}/notifications (plus /export and /summary)
+    GET  /dead-letters, POST /dead-letters/replay
+    GET  /health, GET /metrics
+
+Batches, fan-out jobs, segments and templates are only served by app.py.
+Run it with:
+
+    gunicorn -k uvicorn.workers.UvicornWorker --config gunicorn.conf.py asgi:app
+"""
+
+import logging
+import time
+import warnings
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+import async_database
+from async_publisher import AsyncPublisher
+from validation import (
+    validate_notification,
+    parse_inbox_params,
+    parse_export_params,
+    parse_dead_letter_limit,
+    scheduled_for,
+)
+import retries
+from export import stream_ndjson_async
+from lanes import get_lane
+from latency import stamp
+from templates import template_cache
+from jinja2 import TemplateError
+from database import (
+    content_fields,
+    template_fields,
+    tenant_fields,
+    new_notification_document,
+)
+from metrics import (
+    NOTIFICATIONS_SENT,
+    NOTIFICATION_DURATION,
+    API_REQUESTS,
+    QUEUE_ERRORS,
+)
+from config import LOG_LEVEL, BATCH_MAX_SIZE, INGESTION_MODE
+
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+warnings.filterwarnings("ignore", category=UserWarning)
+
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL),
+    format="%(levelname)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+publisher = AsyncPublisher.from_config()
+
+
+async def send_notification(request):
+    """The main gateway for sending notifications to users"""
+    start_time = time.time()
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+
+    # Make sure we got something to work with
+    if not data:
+        API_REQUESTS.labels(
+            endpoint="/notifications", method="POST", status="400"
+        ).inc()
+        return JSONResponse({"error": "Request body is required"}, status_code=400)
+
+    error = validate_notification(data)
+    if error:
+        API_REQUESTS.labels(
+            endpoint="/notifications", method="POST", status="400"
+        ).inc()
+        return JSONResponse({"error": error}, status_code=400)
+
+    try:
+        # In here, since a template cache miss reads from Mongo
+        if data.get("template_id"):
+            try:
+                await template_cache.get_async(
+                    data["template_id"], async_database.get_template
+                )
+            except TemplateError:
+                API_REQUESTS.labels(
+                    endpoint="/notifications", method="POST", status="400"
+                ).inc()
+                return JSONResponse(
+                    {"error": f"unknown template_id: {data['template_id']}"},
+                    status_code=400,
+                )
+
+        send_at = scheduled_for(data)
+        if send_at is not None:
+            # Waits in Mongo until scheduler.py publishes it
+            notification_id = await async_database.save_notification(
+                data["user_id"],
+                data["type"],
+                data.get("content"),
+                **template_fields(data),
+                **tenant_fields(data),
+                send_at=send_at,
+                priority=data.get("priority"),
+            )
+            API_REQUESTS.labels(
+                endpoint="/notifications", method="POST", status="200"
+            ).inc()
+            NOTIFICATION_DURATION.observe(time.time() - start_time)
+            return JSONResponse(
+                {
+                    "message": "Notification scheduled",
+                    "notification_id": notification_id,
+                    "send_at": send_at.isoformat(),
+                }
+            )
+
+        # Carried along so the consumer can time every stage
+        timestamps = {"received": start_time}
+        if INGESTION_MODE == "write_behind":
+            # Pick the id ourselves and let persister.py save the record later
+            document = new_notification_document(
+                data["user_id"],
+                data["type"],
+                data.get("content"),
+                **template_fields(data),
+                **tenant_fields(data),
+            )
+            notification_id = str(document["_id"])
+        else:
+            notification_id = await async_database.save_notification(
+                data["user_id"],
+                data["type"],
+                data.get("content"),
+                **template_fields(data),
+                **tenant_fields(data),
+            )
+            timestamps["persisted"] = time.time()
+
+        notification_data = {
+            "id": notification_id,
+            "user_id": data["user_id"],
+            "type": data["type"],
+            **content_fields(data),
+            **tenant_fields(data),
+            "timestamps": timestamps,
+        }
+        if INGESTION_MODE == "write_behind":
+            notification_data["created_at"] = document["created_at"].isoformat()
+        await publisher.publish(
+            stamp(notification_data, "published"),
+            routing_key=get_lane(data.get("priority")).queue,
+        )
+
+        NOTIFICATIONS_SENT.labels(type=data["type"]).inc()
+        API_REQUESTS.labels(
+            endpoint="/notifications", method="POST", status="200"
+        ).inc()
+        NOTIFICATION_DURATION.observe(time.time() - start_time)
+
+        return JSONResponse(
+            {
+                "message": "Notification sent successfully",
+                "notification_id": notification_id,
+            }
+        )
+
+    except Exception as e:
+        logger.error(f"Error sending notification: {str(e)}")
+        QUEUE_ERRORS.inc()
+        API_REQUESTS.labels(
+            endpoint="/notifications", method="POST", status="500"
+        ).inc()
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def get_user_notifications_endpoint(request):
+    """Inbox viewer - one page of a user's notifications, newest first"""
+    user_id = request.path_params["user_id"]
+    limit, options, error = parse_inbox_params(request.query_params)
+    if error:
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications", method="GET", status="400"
+        ).inc()
+        return JSONResponse({"error": error}, status_code=400)
+
+    try:
+        page = await async_database.get_user_notifications_page(
+            user_id, limit, **options
+        )
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications", method="GET", status="200"
+        ).inc()
+        return JSONResponse({"user_id": user_id, **page})
+
+    except ValueError as e:
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications", method="GET", status="400"
+        ).inc()
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    except Exception as e:
+        logger.error(f"Error retrieving notifications: {str(e)}")
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications", method="GET", status="500"
+        ).inc()
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def export_user_notifications_endpoint(request):
+    """Someone's full history as NDJSON (or gzip), streamed straight off the cursor"""
+    user_id = request.path_params["user_id"]
+    start, end, compress, error = parse_export_params(request.query_params)
+    if error:
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications/export", method="GET", status="400"
+        ).inc()
+        return JSONResponse({"error": error}, status_code=400)
+
+    filename = f"notifications-{user_id}.ndjson" + (".gz" if compress else "")
+    API_REQUESTS.labels(
+        endpoint="/users/<user_id>/notifications/export", method="GET", status="200"
+    ).inc()
+    return StreamingResponse(
+        stream_ndjson_async(
+            async_database.iter_user_notifications(user_id, start, end),
+            compress=compress,
+        ),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+async def get_notification_summary_endpoint(request):
+    """Badge counts - totals by status and type, no inbox download needed"""
+    user_id = request.path_params["user_id"]
+    try:
+        summary = await async_database.get_notification_summary(user_id)
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications/summary", method="GET", status="200"
+        ).inc()
+        return JSONResponse({"user_id": user_id, **summary})
+
+    except Exception as e:
+        logger.error(f"Error retrieving notification summary: {str(e)}")
+        API_REQUESTS.labels(
+            endpoint="/users/<user_id>/notifications/summary", method="GET", status="500"
+        ).inc()
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def list_dead_letters_endpoint(request):
+    """Peek at the oldest messages that ran out of retries (?limit=)"""
+    limit, error = parse_dead_letter_limit(request.query_params.get("limit"))
+    if error:
+        API_REQUESTS.labels(endpoint="/dead-letters", method="GET", status="400").inc()
+        return JSONResponse({"error": error}, status_code=400)
+
+    try:
+        # Rare admin call - the blocking pika helpers in a thread are fine here
+        total, dead_letters = await run_in_threadpool(retries.list_dead_letters, limit)
+        API_REQUESTS.labels(endpoint="/dead-letters", method="GET", status="200").inc()
+        return JSONResponse({"total": total, "dead_letters": dead_letters})
+
+    except Exception as e:
+        logger.error(f"Error listing dead letters: {str(e)}")
+        API_REQUESTS.labels(endpoint="/dead-letters", method="GET", status="500").inc()
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def replay_dead_letters_endpoint(request):
+    """Put up to {"limit": n} dead letters back on the main queue, oldest first"""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    limit, error = parse_dead_letter_limit(
+        (data or {}).get("limit") if isinstance(data, dict) else None,
+        maximum=BATCH_MAX_SIZE,
+    )
+    if error:
+        API_REQUESTS.labels(
+            endpoint="/dead-letters/replay", method="POST", status="400"
+        ).inc()
+        return JSONResponse({"error": error}, status_code=400)
+
+    try:
+        replayed = await run_in_threadpool(retries.replay_dead_letters, limit)
+        API_REQUESTS.labels(
+            endpoint="/dead-letters/replay", method="POST", status="200"
+        ).inc()
+        return JSONResponse({"replayed": replayed})
+
+    except Exception as e:
+        logger.error(f"Error replaying dead letters: {str(e)}")
+        API_REQUESTS.labels(
+            endpoint="/dead-letters/replay", method="POST", status="500"
+        ).inc()
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def health_check(request):
+    """Just checking if we're still alive"""
+    API_REQUESTS.labels(endpoint="/health", method="GET", status="200").inc()
+    return JSONResponse({"status": "ok"})
+
+
+async def metrics(request):
+    """Endpoint to expose Prometheus metrics"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+async def shutdown():
+    await publisher.close()
+    async_database.close()
+
+
+app = Starlette(
+    routes=[
+        Route("/notifications", send_notification, methods=["POST"]),
+        Route(
+            "/users/{user_id:int}/notifications",
+            get_user_notifications_endpoint,
+            methods=["GET"],
+        ),
+        Route(
+            "/users/{user_id:int}/notifications/export",
+            export_user_notifications_endpoint,
+            methods=["GET"],
+        ),
+        Route(
+            "/users/{user_id:int}/notifications/summary",
+            get_notification_summary_endpoint,
+            methods=["GET"],
+        ),
+        Route("/dead-letters", list_dead_letters_endpoint, methods=["GET"]),
+        Route(
+            "/dead-letters/replay", replay_dead_letters_endpoint, methods=["POST"]
+        ),
+        Route("/health", health_check, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ],
+    on_shutdown=[shutdown],
+)
@@ -0,0 +1,368 @@
+import asyncio
+import json
+import logging
+import signal
+import warnings
+import aio_pika
+from jinja2 import TemplateError
+from notification_services import get_notification_service, registry
+from consumer import parse_notification
+from async_database import (
+    update_notification_status,
+    claim_notification,
+    release_notification,
+    get_template,
+    close as close_database,
+)
+from dedup import recently_completed, seen_recently, note_claim
+from lanes import LANES, WeightedScheduler, get_lane, observe_processed
+from latency import stamp, observe_stages
+from metrics import start_metrics_server
+from rate_limit import rate_limiter, parse_rate_limits
+from retries import plan_retry, retry_topology
+from templates import render_notification_async
+from config import (
+    LOG_LEVEL,
+    RABBITMQ_QUEUE,
+    RABBITMQ_URL,
+    ASYNC_CONSUMER_CONCURRENCY,
+    ASYNC_CONSUMER_CHANNELS,
+    CONSUMER_DRAIN_TIMEOUT,
+    CHANNEL_CONCURRENCY,
+    RETRY_ENABLED,
+    RABBITMQ_RETRY_EXCHANGE,
+    DEDUP_ENABLED,
+)
+
+# Quiet those pesky warnings
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+warnings.filterwarnings("ignore", category=UserWarning)
+
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL),
+    format="%(levelname)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# Most sends of each type in flight at once (on top of the rate limits)
+CHANNEL_CONCURRENCY_LIMITS = {
+    name: int(limit) for name, (limit, _) in parse_rate_limits(CHANNEL_CONCURRENCY).items()
+}
+_channel_semaphores = {}
+
+
+def channel_semaphore(notification_type):
+    """The per-type send slot, or None when the type isn't capped"""
+    limit = CHANNEL_CONCURRENCY_LIMITS.get(notification_type)
+    if limit is None:
+        return None
+    if notification_type not in _channel_semaphores:
+        _channel_semaphores[notification_type] = asyncio.Semaphore(limit)
+    return _channel_semaphores[notification_type]
+
+
+async def deliver_notification_async(notification_data):
+    """
+    Same job as consumer.deliver_notification, but awaits the provider
+
+    Returns the status to record: "delivered" or "failed"
+    """
+    notification_id = notification_data["id"]
+    user_id = notification_data["user_id"]
+    notification_type = notification_data["type"]
+
+    logger.info(
+        f"Processing {notification_type} notification {notification_id} for user {user_id}"
+    )
+
+    try:
+        await render_notification_async(notification_data, get_template)
+    except TemplateError as e:
+        logger.error(f"Can't render notification {notification_id}: {str(e)}")
+        return "failed"
+
+    service = get_notification_service(notification_type)
+    semaphore = channel_semaphore(notification_type)
+
+    async def send():
+        if semaphore is None:
+            return await service.send_async(user_id, notification_data["content"])
+        async with semaphore:
+            return await service.send_async(user_id, notification_data["content"])
+
+    # Waiting for a token keeps the message here, unacked, rather than
+    # sending it back round the queue
+    sent = await rate_limiter.run_async(
+        notification_type, send, tenant=notification_data.get("tenant_id")
+    )
+    stamp(notification_data, "sent")
+    if sent:
+        logger.info(f"Notification {notification_id} delivered successfully")
+        return "delivered"
+
+    logger.error(f"Failed to deliver notification {notification_id}")
+    return "failed"
+
+
+async def schedule_retry_async(
+    exchange, message, error, count_attempt=True, queue=RABBITMQ_QUEUE
+):
+    """
+    retries.schedule_retry for aio-pika: publish to the next delay queue
+    (or the dead-letter queue), then ack the original
+
+    Our channels have publisher confirms on, so the publish only returns
+    once the broker has it; if it's nacked the original goes back instead
+    """
+    routing_key, headers, expiration = plan_retry(
+        message.headers, error, queue, count_attempt=count_attempt
+    )
+    try:
+        await exchange.publish(
+            aio_pika.Message(
+                body=message.body,
+                headers=headers,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                expiration=expiration / 1000 if expiration is not None else None,
+            ),
+            routing_key=routing_key,
+        )
+    except aio_pika.exceptions.DeliveryError as e:
+        logger.error(f"Broker refused a retry, requeueing the message: {str(e)}")
+        await message.nack(requeue=True)
+        return
+    await message.ack()
+
+
+async def declare_retry_topology_async(channel, queue=RABBITMQ_QUEUE):
+    """Declare everything from retries.retry_topology with aio-pika"""
+    exchanges = {}
+    queues = {}
+    for method_name, kwargs in retry_topology(queue):
+        if method_name == "exchange_declare":
+            exchanges[kwargs["exchange"]] = await channel.declare_exchange(
+                kwargs["exchange"], aio_pika.ExchangeType.DIRECT, durable=True
+            )
+        elif method_name == "queue_declare":
+            queues[kwargs["queue"]] = await channel.declare_queue(
+                kwargs["queue"], durable=True, arguments=kwargs.get("arguments")
+            )
+        elif method_name == "queue_bind":
+            await queues[kwargs["queue"]].bind(
+                exchanges[kwargs["exchange"]], routing_key=kwargs["routing_key"]
+            )
+    return exchanges[RABBITMQ_RETRY_EXCHANGE]
+
+
+async def handle_message(message, retry_exchange=None, lane=None):
+    """
+    The asyncio version of process_notification - same checks, same acks
+
+    Bad JSON and incomplete messages are acked and dropped. Anything that
+    blows up goes to `lane`'s delay queue via retry_exchange, or is nacked
+    and requeued if there isn't one (retries turned off). DEDUP_ENABLED works
+    the same as in process_notification.
+    """
+    lane = lane or get_lane()
+    claimed = None
+    try:
+        notification_data = parse_notification(message.body)
+        if notification_data is None:
+            await message.ack()
+            return
+        stamp(notification_data, "consumed")
+
+        if DEDUP_ENABLED:
+            notification_id = notification_data["id"]
+            state = (
+                "duplicate"
+                if seen_recently(notification_id)
+                else note_claim(
+                    notification_id,
+                    await claim_notification(notification_id, notification=notification_data),
+                )
+            )
+            if state == "duplicate":
+                await message.ack()
+                return
+            if state == "in_flight":
+                if retry_exchange is None:
+                    await message.nack(requeue=True)
+                else:
+                    await schedule_retry_async(
+                        retry_exchange,
+                        message,
+                        "in flight elsewhere",
+                        count_attempt=False,
+                        queue=lane.queue,
+                    )
+                return
+            claimed = notification_id
+
+        status = await deliver_notification_async(notification_data)
+        await update_notification_status(notification_data["id"], status, notification_data)
+        stamp(notification_data, "status_written")
+        if claimed:
+            recently_completed.add(claimed)
+        await message.ack()
+        observe_stages(notification_data)
+        observe_processed(lane.name, notification_data)
+
+    except json.JSONDecodeError as e:
+        logger.error(
+            f"Invalid JSON in message: {str(e)}. Message content: '{message.body.decode('utf-8', errors='replace')}'"
+        )
+        await message.ack()
+    except Exception as e:
+        logger.error(f"Error processing notification: {str(e)}")
+        if claimed:
+            await release_notification(claimed)
+        if retry_exchange is None:
+            await message.nack(requeue=True)
+        else:
+            await schedule_retry_async(retry_exchange, message, e, queue=lane.queue)
+
+
+class AsyncConsumer:
+    """
+    Lots of sends in flight per process instead of one at a time
+
+    Every channel consumes all the priority lanes. No more than
+    `concurrency` sends per channel run at once; deliveries past that wait
+    in that channel's WeightedScheduler, and each free slot goes to
+    whichever lane's turn it is. So one busy channel can't take the slots
+    the others need. The prefetch window is twice the concurrency for each lane, so
+    the next messages are already here by the time a slot frees up - and a
+    bulk backlog can't fill the window that transactional messages need.
+    """
+
+    def __init__(
+        self,
+        concurrency=ASYNC_CONSUMER_CONCURRENCY,
+        channels=ASYNC_CONSUMER_CHANNELS,
+        lanes=None,
+    ):
+        self.concurrency = concurrency
+        self.channels = channels
+        self.lanes = {lane.name: lane for lane in (LANES if lanes is None else lanes)}
+        # Per channel: messages waiting for a slot, and sends running now
+        self._schedulers = [
+            WeightedScheduler(list(self.lanes.values())) for _ in range(channels)
+        ]
+        self._in_flight = [0] * channels
+        self._connection = None
+        self._consumers = []
+        self._tasks = set()
+        self._draining = False
+        self._stopping = asyncio.Event()
+
+    def dispatch(self, lane_name, message, retry_exchange=None, channel=0):
+        """Line a message up for handling (called for every delivery on `channel`)"""
+        self._schedulers[channel].push(lane_name, (message, retry_exchange))
+        self._start_next(channel)
+
+    def _start_next(self, channel):
+        """Hand the channel's free slots to the lanes whose turn it is"""
+        scheduler = self._schedulers[channel]
+        while not self._draining and self._in_flight[channel] < self.concurrency:
+            lane_name = scheduler.next_lane()
+            if lane_name is None:
+                return
+            [(message, retry_exchange)] = scheduler.take(lane_name)
+            task = asyncio.ensure_future(
+                handle_message(message, retry_exchange, self.lanes[lane_name])
+            )
+            self._tasks.add(task)
+            self._in_flight[channel] += 1
+            task.add_done_callback(lambda task, channel=channel: self._finished(task, channel))
+
+    def _finished(self, task, channel):
+        self._tasks.discard(task)
+        self._in_flight[channel] -= 1
+        self._start_next(channel)
+
+    async def start(self):
+        """Connect and start consuming every lane on every channel"""
+        self._connection = await aio_pika.connect_robust(RABBITMQ_URL)
+        registry.start_all()
+
+        for index in range(self.channels):
+            channel = await self._connection.channel()
+            # Per consumer, so each lane gets a window of its own
+            await channel.set_qos(prefetch_count=self.concurrency * 2)
+            for lane in self.lanes.values():
+                queue = await channel.declare_queue(lane.queue, durable=True)
+                retry_exchange = (
+                    await declare_retry_topology_async(channel, lane.queue)
+                    if RETRY_ENABLED
+                    else None
+                )
+
+                async def on_message(
+                    message, name=lane.name, retry_exchange=retry_exchange, index=index
+                ):
+                    self.dispatch(name, message, retry_exchange, channel=index)
+
+                consumer_tag = await queue.consume(on_message)
+                self._consumers.append((queue, consumer_tag))
+
+        lanes = ", ".join(f"{lane.name}={lane.weight}" for lane in self.lanes.values())
+        logger.info(
+            f"🔔 Async notification handler is listening ({self.channels} channel(s), "
+            f"{self.concurrency} sends each, lanes {lanes})..."
+        )
+
+    async def drain(self, timeout=CONSUMER_DRAIN_TIMEOUT):
+        """
+        Stop taking new messages and let the in-flight ones finish
+
+        Anything still running after the timeout is cancelled, and anything
+        still waiting its turn is left alone; those messages were never
+        acked, so RabbitMQ hands them to someone else
+        """
+        self._draining = True
+        for queue, consumer_tag in self._consumers:
+            await queue.cancel(consumer_tag)
+        self._consumers.clear()
+
+        if self._tasks:
+            logger.info(f"Draining {len(self._tasks)} in-flight notification(s)...")
+            done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            for task in pending:
+                task.cancel()
+
+        if self._connection is not None:
+            await self._connection.close()
+        close_database()
+        registry.close()
+
+    def request_stop(self):
+        self._stopping.set()
+
+    async def run(self):
+        """Consume until SIGTERM/SIGINT, then drain gracefully"""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.request_stop)
+
+        await self.start()
+        await self._stopping.wait()
+        await self.drain()
+
+
+def start_async_consumer(metrics_port=None):
+    """
+    Entry point for the asyncio consumer
+
+    metrics_port pins /metrics to one port (the supervisor gives each
+    worker its own); otherwise it's the first free one from CONSUMER_METRICS_PORT
+    """
+    if metrics_port is None:
+        start_metrics_server()
+    else:
+        start_metrics_server(metrics_port, tries=1)
+    asyncio.run(AsyncConsumer().run())
+
+
+if __name__ == "__main__":
+    start_async_consumer()
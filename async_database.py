@@ -0,0 +1,228 @@
+"""Non-blocking MongoDB access (Motor) for the asyncio consumer and ASGI API."""
+
+import asyncio
+import datetime
+import logging
+from bson.objectid import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from cache import inbox_cache, MemoryCacheBackend
+from database import (
+    build_inbox_query,
+    build_inbox_page,
+    insert_deltas,
+    status_change_deltas,
+    counter_operations,
+    summarize_counters,
+    serialize_notification,
+    build_export_filter,
+    content_fields,
+    tenant_fields,
+    schedule_fields,
+    claimable_filter,
+    claim_update,
+    claim_state,
+    upsert_fields,
+    status_update,
+    STATUS_UPSERT,
+)
+from config import (
+    MONGODB_URI,
+    MONGODB_DATABASE,
+    EXPORT_BATCH_SIZE,
+    DEDUP_LEASE_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+
+def get_database():
+    """
+    The service database, through a Motor client
+
+    Created on first use so the client attaches to the running event loop
+    """
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(MONGODB_URI)
+    return _client[MONGODB_DATABASE]
+
+
+def get_notifications_collection():
+    return get_database()["notifications"]
+
+
+async def apply_counter_deltas(deltas):
+    operations = counter_operations(deltas)
+    if operations:
+        await get_database()["notification_counters"].bulk_write(
+            operations, ordered=False
+        )
+
+
+async def invalidate_inbox(*user_ids):
+    """
+    Drop users' cached inbox pages after a write
+
+    The Redis backend is a blocking client, so it runs in the default
+    executor rather than stalling the loop
+    """
+    if not inbox_cache.enabled or isinstance(inbox_cache.backend, MemoryCacheBackend):
+        inbox_cache.invalidate(*user_ids)
+    else:
+        await asyncio.get_running_loop().run_in_executor(
+            None, inbox_cache.invalidate, *user_ids
+        )
+
+
+async def save_notification(
+    user_id,
+    notification_type,
+    content,
+    template_id=None,
+    variables=None,
+    send_at=None,
+    priority=None,
+    tenant_id=None,
+):
+    """Store a notification (same arguments as database.save_notification) and return its id"""
+    notification = {
+        "user_id": user_id,
+        "type": notification_type,
+        **content_fields(
+            {"content": content, "template_id": template_id, "variables": variables}
+        ),
+        **tenant_fields({"tenant_id": tenant_id}),
+        **schedule_fields(send_at, priority),
+        "created_at": datetime.datetime.now(),
+    }
+    result = await get_notifications_collection().insert_one(notification)
+    await apply_counter_deltas(insert_deltas([notification]))
+    await invalidate_inbox(user_id)
+    return str(result.inserted_id)
+
+
+async def update_notification_status(notification_id, status, notification=None):
+    """
+    Mark a notification as delivered or failed, without blocking the loop
+
+    In write-behind mode the record may not be saved yet, so (like
+    database.update_notification_status) the status is upserted along with
+    the rest of the record from `notification`
+    """
+    collection = get_notifications_collection()
+    inserting = upsert_fields(notification)
+    try:
+        before = await collection.find_one_and_update(
+            {"_id": ObjectId(notification_id)},
+            status_update(status, inserting),
+            projection={"user_id": 1, "status": 1},
+            upsert=STATUS_UPSERT,
+            return_document=ReturnDocument.BEFORE,
+        )
+    except DuplicateKeyError:
+        # The persister inserted it between our lookup and our insert -
+        # it's there now, so a plain update does it
+        before = await collection.find_one_and_update(
+            {"_id": ObjectId(notification_id)},
+            status_update(status),
+            projection={"user_id": 1, "status": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+    if before is None and inserting:
+        # Nothing there, so the upsert just created the whole record
+        await apply_counter_deltas(insert_deltas([{**inserting, "status": status}]))
+        await invalidate_inbox(inserting["user_id"])
+    elif before and "user_id" in before:
+        await apply_counter_deltas(
+            status_change_deltas([before], {before["_id"]: status})
+        )
+        await invalidate_inbox(before["user_id"])
+
+
+async def claim_notification(
+    notification_id, lease_seconds=DEDUP_LEASE_SECONDS, notification=None
+):
+    """database.claim_notification for the asyncio consumer"""
+    now = datetime.datetime.now()
+    token = ObjectId()
+    object_id = ObjectId(notification_id)
+    collection = get_notifications_collection()
+    inserting = upsert_fields(notification)
+    try:
+        result = await collection.update_one(
+            {"_id": object_id, **claimable_filter(now)},
+            claim_update(now, token, lease_seconds, inserting),
+            upsert=STATUS_UPSERT,
+        )
+        if result.upserted_id is not None and inserting:
+            # Created the whole record - count it (a claim is still pending)
+            await apply_counter_deltas(insert_deltas([{**inserting, "status": "sending"}]))
+            await invalidate_inbox(inserting["user_id"])
+        if result.matched_count or result.upserted_id is not None:
+            return "claimed"
+    except DuplicateKeyError:
+        pass
+
+    return claim_state(
+        await collection.find_one({"_id": object_id}, {"status": 1, "claim": 1}), token
+    )
+
+
+async def release_notification(notification_id):
+    """Hand a claim back (sending -> pending) after a send blew up"""
+    await get_notifications_collection().update_one(
+        {"_id": ObjectId(notification_id), "status": "sending"},
+        {"$set": {"status": "pending"}, "$unset": {"lease_until": "", "claim": ""}},
+    )
+
+
+async def get_template(template_id):
+    """database.get_template without blocking the loop"""
+    return await get_database()["notification_templates"].find_one({"_id": template_id})
+
+
+async def get_user_notifications_page(user_id, limit, **options):
+    """One page of someone's notifications - same options as database.py"""
+    query = build_inbox_query(user_id, limit, **options)
+    cursor = get_notifications_collection().find(
+        query["filter"], query["projection"], sort=query["sort"], limit=query["limit"]
+    )
+    docs = await cursor.to_list(length=query["limit"])
+    return build_inbox_page(
+        docs, limit, after=options.get("after"), fields=options.get("fields")
+    )
+
+
+async def get_notification_summary(user_id):
+    """Badge counts for a user, straight from the precomputed counters"""
+    counters = await get_database()["notification_counters"].find_one({"_id": user_id})
+    return summarize_counters(counters)
+
+
+async def iter_user_notifications(
+    user_id, start=None, end=None, batch_size=EXPORT_BATCH_SIZE
+):
+    """Async version of database.iter_user_notifications - oldest first, flat memory"""
+    cursor = (
+        get_notifications_collection()
+        .find(build_export_filter(user_id, start, end))
+        .sort([("created_at", 1), ("_id", 1)])
+        .batch_size(batch_size)
+    )
+    try:
+        async for doc in cursor:
+            yield serialize_notification(doc)
+    finally:
+        await cursor.close()
+
+
+def close():
+    """Drop the Motor client (consumer shutdown)"""
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
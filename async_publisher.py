@@ -0,0 +1,90 @@
+"""Non-blocking RabbitMQ publishing (aio-pika) for the ASGI API."""
+
+import asyncio
+import json
+import logging
+import aio_pika
+from config import RABBITMQ_URL, RABBITMQ_QUEUE
+from lanes import LANES
+from publisher import get_publisher_topology
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPublisher:
+    """
+    One robust connection and a confirm-mode channel per worker process
+
+    aio-pika waits for the broker's confirm inside publish(), but many
+    publishes can be awaiting at once on the same channel, so concurrent
+    requests pipeline naturally
+
+    With an `exchange` (write-behind mode, see get_publisher_topology)
+    messages go through it and `bindings` copy each one into its delivery
+    queue and the persistence queue
+    """
+
+    def __init__(
+        self, url=RABBITMQ_URL, queue=RABBITMQ_QUEUE, lanes=None, exchange="", bindings=()
+    ):
+        self.url = url
+        self.queue = queue
+        self.lane_queues = [lane.queue for lane in (LANES if lanes is None else lanes)]
+        self.exchange_name = exchange
+        self.bindings = list(bindings)
+        self._connection = None
+        self._channel = None
+        self._exchange = None
+        self._connect_lock = asyncio.Lock()
+
+    @classmethod
+    def from_config(cls):
+        """A publisher for the configured INGESTION_MODE"""
+        topology = get_publisher_topology()
+        return cls(exchange=topology.get("exchange", ""), bindings=topology.get("bindings", ()))
+
+    async def connect(self):
+        """Open the connection once, however many requests race to be first"""
+        async with self._connect_lock:
+            if self._channel is not None:
+                return
+            self._connection = await aio_pika.connect_robust(self.url)
+            channel = await self._connection.channel(publisher_confirms=True)
+            queues = {}
+            for queue in dict.fromkeys(
+                [self.queue, *self.lane_queues, *(bound for bound, _ in self.bindings)]
+            ):
+                queues[queue] = await channel.declare_queue(queue, durable=True)
+            if self.exchange_name:
+                self._exchange = await channel.declare_exchange(
+                    self.exchange_name, aio_pika.ExchangeType.DIRECT, durable=True
+                )
+                for bound, routing_key in self.bindings:
+                    await queues[bound].bind(self._exchange, routing_key=routing_key)
+            else:
+                self._exchange = channel.default_exchange
+            self._channel = channel
+
+    async def publish(self, notification_data, routing_key=None):
+        """
+        Publish a persistent message and wait for the broker to confirm it
+
+        Goes to `routing_key` (a priority lane's queue) if given
+        """
+        if self._channel is None:
+            await self.connect()
+
+        await self._exchange.publish(
+            aio_pika.Message(
+                body=json.dumps(notification_data).encode("utf-8"),
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=routing_key or self.queue,
+        )
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+        self._connection = None
+        self._channel = None
+        self._exchange = None
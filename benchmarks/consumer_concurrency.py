@@ -0,0 +1,122 @@
+"""
+Sync vs asyncio consumer throughput against a stub provider
+
+Every send sleeps for --latency seconds to stand in for an SMS/email API
+call. Mongo and RabbitMQ are replaced with in-process fakes so the numbers
+only reflect how many sends each engine keeps in flight.
+
+    python benchmarks/consumer_concurrency.py --messages 500 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from unittest.mock import MagicMock, patch
+
+# Make the service modules importable when run from anywhere
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import async_consumer
+import consumer
+from lanes import get_lane
+from notification_services import NotificationService
+
+
+class StubProvider(NotificationService):
+    """A provider that takes `latency` seconds per call and always succeeds"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def send(self, user_id, content):
+        time.sleep(self.latency)
+        return True
+
+    async def send_async(self, user_id, content):
+        await asyncio.sleep(self.latency)
+        return True
+
+
+class FakeMessage:
+    """Just enough of aio_pika's IncomingMessage for handle_message"""
+
+    def __init__(self, body):
+        self.body = body
+
+    async def ack(self):
+        pass
+
+    async def nack(self, requeue=True):
+        pass
+
+
+def make_bodies(count):
+    return [
+        json.dumps(
+            {
+                "id": "60f8f1b3c2d7a8f9e1d2c3b4",
+                "user_id": index + 1,
+                "type": "email",
+                "content": "Benchmark notification",
+            }
+        ).encode("utf-8")
+        for index in range(count)
+    ]
+
+
+def run_sync(bodies, provider):
+    channel = MagicMock()
+    method = MagicMock()
+    with patch("consumer.get_notification_service", return_value=provider), patch(
+        "consumer.update_notification_status"
+    ):
+        start = time.perf_counter()
+        for body in bodies:
+            consumer.process_notification(channel, method, None, body)
+        return time.perf_counter() - start
+
+
+async def run_async(bodies, provider, concurrency):
+    engine = async_consumer.AsyncConsumer(concurrency=concurrency, channels=1)
+
+    async def no_op_status(notification_id, status):
+        pass
+
+    with patch(
+        "async_consumer.get_notification_service", return_value=provider
+    ), patch("async_consumer.update_notification_status", no_op_status):
+        start = time.perf_counter()
+        for body in bodies:
+            engine.dispatch(get_lane().name, FakeMessage(body))
+        # Finished sends start the next ones, so wait until nothing is left
+        while engine._tasks:
+            await asyncio.wait(set(engine._tasks))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    provider = StubProvider(args.latency)
+    bodies = make_bodies(args.messages)
+
+    sync_seconds = run_sync(bodies, provider)
+    async_seconds = asyncio.run(run_async(bodies, provider, args.concurrency))
+
+    print(f"messages={args.messages} provider_latency={args.latency * 1000:.0f}ms")
+    print(f"sync loop:          {args.messages / sync_seconds:8.1f} msg/s")
+    print(
+        f"async (c={args.concurrency:<3}):     {args.messages / async_seconds:8.1f} msg/s"
+    )
+    print(f"speedup:            {sync_seconds / async_seconds:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+HTTP load test for POST /notifications
+
+Hammers a running API with `--concurrency` clients for `--duration` seconds
+and reports requests/sec plus p50/p99 latency. Run it against both entry
+points on the same box to compare them:
+
+    gunicorn --config gunicorn.conf.py app:app
+    python benchmarks/http_load.py --url http://localhost:5000
+
+    GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker \\
+        gunicorn --config gunicorn.conf.py asgi:app
+    python benchmarks/http_load.py --url http://localhost:5000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import httpx
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def client_loop(client, url, deadline, latencies, errors):
+    payload = {"user_id": 123, "type": "email", "content": "Load test notification"}
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await client.post(url, json=payload)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+                continue
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(url, concurrency, duration):
+    latencies = []
+    errors = []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(
+            *[
+                client_loop(client, url, deadline, latencies, errors)
+                for _ in range(concurrency)
+            ]
+        )
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test POST /notifications")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--json", action="store_true", help="print the raw result")
+    args = parser.parse_args()
+
+    result = asyncio.run(
+        run(args.url.rstrip("/") + "/notifications", args.concurrency, args.duration)
+    )
+
+    if args.json:
+        print(json.dumps(result))
+        return
+    print(f"requests:  {result['requests']} ({result['errors']} errors)")
+    print(f"req/sec:   {result['rps']:.1f}")
+    print(f"p50:       {result['p50_ms']:.1f} ms")
+    print(f"p99:       {result['p99_ms']:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Transactional latency during a bulk blast: one shared queue vs priority lanes
+
+A simulated consumer handles one message every --service-ms. At time zero
+--bulk messages land in the bulk lane, and a transactional message shows
+up every --interval-ms from then on. The same arrivals go through a single
+FIFO queue (what we had before lanes) and through lanes.WeightedScheduler
+with the configured weights. Simulated time, so it runs in a second.
+
+    python benchmarks/priority_lanes.py --bulk 20000 --service-ms 5
+"""
+
+import argparse
+import os
+import sys
+from collections import deque
+
+# Make the service modules importable when run from anywhere
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lanes import Lane, WeightedScheduler
+
+
+def make_arrivals(bulk, interval, duration):
+    """(arrival time, lane) pairs, in arrival order"""
+    arrivals = [(0.0, "bulk")] * bulk
+    t = interval
+    while t < duration:
+        arrivals.append((t, "transactional"))
+        t += interval
+    return sorted(arrivals, key=lambda arrival: arrival[0])
+
+
+def simulate(arrivals, service, scheduler=None):
+    """
+    Serve everything, one message per `service` seconds
+
+    Returns {lane: [latency, ...]}
+    """
+    fifo = deque()
+    latencies = {"transactional": [], "bulk": []}
+    now = 0.0
+    index = 0
+    waiting = 0
+    while index < len(arrivals) or waiting:
+        while index < len(arrivals) and arrivals[index][0] <= now:
+            arrived_at, lane = arrivals[index]
+            if scheduler is None:
+                fifo.append((lane, arrived_at))
+            else:
+                scheduler.push(lane, arrived_at)
+            index += 1
+            waiting += 1
+        if not waiting:
+            now = arrivals[index][0]
+            continue
+
+        if scheduler is None:
+            lane, arrived_at = fifo.popleft()
+        else:
+            lane = scheduler.next_lane()
+            [arrived_at] = scheduler.take(lane)
+        waiting -= 1
+        now += service
+        latencies[lane].append(now - arrived_at)
+    return latencies
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--bulk", type=int, default=20000)
+    parser.add_argument("--service-ms", type=float, default=5)
+    parser.add_argument("--interval-ms", type=float, default=50)
+    parser.add_argument("--transactional-weight", type=int, default=8)
+    parser.add_argument("--bulk-weight", type=int, default=1)
+    args = parser.parse_args()
+
+    service = args.service_ms / 1000.0
+    interval = args.interval_ms / 1000.0
+    # Keep the transactional trickle going for as long as the blast lasts
+    arrivals = make_arrivals(args.bulk, interval, args.bulk * service)
+    print(
+        f"bulk={args.bulk} service={args.service_ms:.1f}ms "
+        f"transactional every {args.interval_ms:.0f}ms "
+        f"weights={args.transactional_weight}:{args.bulk_weight}"
+    )
+
+    lanes = [
+        Lane("transactional", "transactional", args.transactional_weight),
+        Lane("bulk", "bulk", args.bulk_weight),
+    ]
+    for name, scheduler in (
+        ("single queue", None),
+        ("lanes", WeightedScheduler(lanes)),
+    ):
+        latencies = simulate(arrivals, service, scheduler)
+        transactional = latencies["transactional"]
+        print(
+            f"{name:<13} transactional p50={percentile(transactional, 0.5) * 1000:9.1f}ms "
+            f"p99={percentile(transactional, 0.99) * 1000:9.1f}ms   "
+            f"bulk done after {max(latencies['bulk']):7.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
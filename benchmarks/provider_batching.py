@@ -0,0 +1,118 @@
+"""
+Per-message vs bulk provider calls in the batch consumer
+
+The stub provider charges --latency seconds per request (the HTTP round
+trip) plus --per-recipient seconds for each recipient in it. The same
+batches go through consumer.process_batch twice: once with the default
+send_batch (one provider call per message) and once with a bulk send_batch
+(one call per batch). Mongo and RabbitMQ are faked out.
+
+    python benchmarks/provider_batching.py --messages 2000 --batch-size 100
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from unittest.mock import MagicMock, patch
+
+# Make the service modules importable when run from anywhere
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import consumer
+from notification_services import NotificationService, group_for_bulk_send
+
+
+class StubProvider(NotificationService):
+    """Sleeps like a remote API and counts how many requests it got"""
+
+    def __init__(self, latency, per_recipient):
+        self.latency = latency
+        self.per_recipient = per_recipient
+        self.calls = 0
+
+    def _request(self, recipients):
+        self.calls += 1
+        time.sleep(self.latency + self.per_recipient * recipients)
+
+    def send(self, user_id, content):
+        self._request(1)
+        return True
+
+
+class BulkStubProvider(StubProvider):
+    """Same stub, but with a bulk endpoint like the email/SMS services use"""
+
+    def send_batch(self, items, max_recipients=1000):
+        results = [None] * len(items)
+        for content, indexes in group_for_bulk_send(items, max_recipients):
+            self._request(len(indexes))
+            for index in indexes:
+                results[index] = True
+        return results
+
+
+def make_batches(count, batch_size):
+    deliveries = []
+    for index in range(count):
+        method = MagicMock()
+        method.delivery_tag = index + 1
+        body = json.dumps(
+            {
+                "id": "60f8f1b3c2d7a8f9e1d2c3b4",
+                "user_id": index + 1,
+                "type": "email",
+                "content": "Benchmark notification",
+            }
+        ).encode("utf-8")
+        deliveries.append((method, None, body))
+    return [
+        deliveries[start : start + batch_size]
+        for start in range(0, count, batch_size)
+    ]
+
+
+def run(batches, provider):
+    channel = MagicMock()
+    with patch("consumer.get_notification_service", return_value=provider), patch(
+        "consumer.update_notification_statuses"
+    ):
+        start = time.perf_counter()
+        for batch in batches:
+            consumer.process_batch(channel, batch)
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--per-recipient", type=float, default=0.0001)
+    args = parser.parse_args()
+
+    batches = make_batches(args.messages, args.batch_size)
+    print(
+        f"messages={args.messages} batch_size={args.batch_size} "
+        f"request_latency={args.latency * 1000:.0f}ms "
+        f"per_recipient={args.per_recipient * 1000:.1f}ms"
+    )
+
+    results = {}
+    for name, provider in (
+        ("per-message", StubProvider(args.latency, args.per_recipient)),
+        ("bulk", BulkStubProvider(args.latency, args.per_recipient)),
+    ):
+        seconds = run(batches, provider)
+        results[name] = seconds
+        print(
+            f"{name:<12} provider calls={provider.calls:<6} "
+            f"{provider.calls / seconds:8.1f} calls/s {args.messages / seconds:9.1f} msg/s"
+        )
+
+    print(f"speedup:     {results['per-message'] / results['bulk']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,542 @@
+"""
+Throughput, latency and round-trip benchmarks for the API and the consumer
+
+Scenarios:
+
+    api             POST /notifications through Flask's test client
+    api_batch       POST /notifications/batch, --batch-size notifications each
+    consumer        consumer.process_notification, one delivery at a time
+    consumer_batch  consumer.process_batch, --batch-size deliveries at a time
+    http            POST /notifications over real HTTP to a gunicorn this
+                    script starts (local backend only)
+
+Backends:
+
+    local   a real mongod and RabbitMQ, configured the usual way
+            (MONGODB_URI, RABBITMQ_HOST, ... - the docker-compose services do)
+    fakes   everything in-process: mongomock stands in for Mongo and a fake
+            channel for RabbitMQ (pip install -r benchmarks/requirements.txt)
+
+Each scenario reports notifications/sec, p50/p99 latency per call, Mongo
+round trips and broker calls per notification, and resident memory. Round
+trips are counted with a pymongo CommandListener (local) or by counting
+collection calls (fakes). Broker calls are the channel methods the code
+under test invokes; publishes go through the blocking RabbitMQPublisher so
+every one of them can be seen. Providers are stubs that take
+--provider-latency seconds.
+
+    python benchmarks/suite.py --backend fakes --output report.json
+    python benchmarks/suite.py --backend fakes --baseline benchmarks/baseline.json
+
+With --baseline, any metric that got worse by more than --tolerance (20%)
+is listed and the exit code is 1, so CI can fail on it. --check limits that
+to some metrics: timings vary from machine to machine, round trips don't.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from unittest.mock import MagicMock, patch
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+# Make the service modules importable when run from anywhere
+sys.path.append(REPO_DIR)
+
+SCENARIOS = ("api", "api_batch", "consumer", "consumer_batch", "http")
+
+# metric -> True if bigger is better
+METRICS = {
+    "notifications_per_second": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "mongo_round_trips_per_notification": False,
+    "broker_calls_per_notification": False,
+    "rss_mb": False,
+}
+
+# Collection methods that each cost one trip to the server
+MONGO_CALLS = {
+    "insert_one",
+    "insert_many",
+    "find_one",
+    "find",
+    "find_one_and_update",
+    "update_one",
+    "update_many",
+    "bulk_write",
+    "aggregate",
+    "count_documents",
+    "delete_many",
+}
+
+
+class RoundTrips:
+    """Counts Mongo round trips and broker calls for the scenario running now"""
+
+    def __init__(self):
+        self.mongo = 0
+        self.broker = 0
+
+    def reset(self):
+        self.mongo = 0
+        self.broker = 0
+
+
+counts = RoundTrips()
+
+
+class CommandCounter:
+    """pymongo CommandListener - every command started is one round trip"""
+
+    def started(self, event):
+        counts.mongo += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+class CountingCollection:
+    """Wraps a (mongomock) collection and counts the calls that would hit the server"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in MONGO_CALLS:
+            return attribute
+
+        def counted(*args, **kwargs):
+            counts.mongo += 1
+            return attribute(*args, **kwargs)
+
+        return counted
+
+
+class CountingChannel:
+    """Wraps a pika channel (real or fake) and counts every method called on it"""
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def __getattr__(self, name):
+        attribute = getattr(self._channel, name)
+        if not callable(attribute) or name.startswith("_") or name in ("is_open", "connection"):
+            return attribute
+
+        def counted(*args, **kwargs):
+            counts.broker += 1
+            return attribute(*args, **kwargs)
+
+        return counted
+
+
+def setup_backend(backend):
+    """
+    Point Mongo at the chosen backend - has to run before database is imported
+
+    Uses its own database so the numbers don't depend on what's in yours
+    """
+    os.environ.setdefault("MONGODB_DATABASE", "notification_service_bench")
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    # Consumers would otherwise start a metrics server on import of the entry points
+    os.environ.setdefault("CONSUMER_METRICS_PORT", "0")
+
+    import pymongo
+
+    if backend == "fakes":
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("--backend fakes needs mongomock: pip install -r benchmarks/requirements.txt")
+        pymongo.MongoClient = mongomock.MongoClient
+    else:
+        pymongo.monitoring.register(CommandCounter())
+
+    import database
+
+    if backend == "fakes":
+        database.notifications_collection = CountingCollection(
+            database.notifications_collection
+        )
+        database.counters_collection = CountingCollection(database.counters_collection)
+    else:
+        # The same indexes a deployed service has (init_indexes.py)
+        database.init_db()
+
+
+def reset_database():
+    """Every scenario starts from empty collections"""
+    import database
+
+    database.notifications_collection.delete_many({})
+    database.counters_collection.delete_many({})
+
+
+def fake_connection():
+    """A pika BlockingConnection stand-in that accepts anything"""
+    connection = MagicMock()
+    connection.is_open = True
+    connection.channel.return_value.is_open = True
+    return connection
+
+
+def counting_connection_factory(backend):
+    from publisher import get_rabbitmq_connection
+
+    def connect():
+        connection = fake_connection() if backend == "fakes" else get_rabbitmq_connection()
+        channel = connection.channel
+
+        connection.channel = lambda *args, **kwargs: CountingChannel(channel(*args, **kwargs))
+        return connection
+
+    return connect
+
+
+class StubProvider:
+    """Stands in for every notification type"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def send(self, user_id, content):
+        if self.latency:
+            time.sleep(self.latency)
+        return True
+
+    def send_batch(self, items):
+        if self.latency:
+            time.sleep(self.latency)
+        return [True] * len(items)
+
+
+def payload(index):
+    return {"user_id": index % 1000 + 1, "type": "email", "content": "Benchmark notification"}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def rss_mb(pid="self"):
+    """Resident memory of a process (Linux), falling back to our own peak"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid != "self":
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def measure(calls, notifications_per_call, warmup):
+    """Run `calls` (a list of no-arg functions), timing each one after the warmup"""
+    for call in calls[:warmup]:
+        call()
+    counts.reset()
+    latencies = []
+    started = time.perf_counter()
+    for call in calls[warmup:]:
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - started
+
+    notifications = len(latencies) * notifications_per_call
+    latencies.sort()
+    return {
+        "notifications": notifications,
+        "notifications_per_second": notifications / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mongo_round_trips_per_notification": counts.mongo / notifications,
+        "broker_calls_per_notification": counts.broker / notifications,
+        "rss_mb": rss_mb(),
+    }
+
+
+def run_api(args, batch):
+    import app
+    from publisher import RabbitMQPublisher, get_publisher_topology
+
+    publisher = RabbitMQPublisher(
+        connection_factory=counting_connection_factory(args.backend),
+        **get_publisher_topology(),
+    )
+    client = app.app.test_client()
+    calls = []
+    if batch:
+        for start in range(0, args.requests, args.batch_size):
+            body = [payload(index) for index in range(start, start + args.batch_size)]
+            calls.append(lambda body=body: client.post("/notifications/batch", json=body))
+    else:
+        for index in range(args.requests):
+            calls.append(lambda body=payload(index): client.post("/notifications", json=body))
+
+    with patch("app.get_publisher", return_value=publisher):
+        result = measure(
+            calls, args.batch_size if batch else 1, max(1, args.warmup // (args.batch_size if batch else 1))
+        )
+    publisher.close()
+    return result
+
+
+def consumer_deliveries(args, channel):
+    """
+    Pre-built deliveries for the consumer scenarios
+
+    With the local backend they really go through RabbitMQ: published to a
+    scratch queue and fetched back, so acks hit the broker
+    """
+    import database
+
+    ids = [
+        database.save_notification(notification["user_id"], notification["type"], notification["content"])
+        for notification in map(payload, range(args.requests))
+    ]
+    bodies = [
+        json.dumps({"id": notification_id, **payload(index)}).encode("utf-8")
+        for index, notification_id in enumerate(ids)
+    ]
+    if args.backend == "fakes":
+        deliveries = []
+        for tag, body in enumerate(bodies, start=1):
+            method = MagicMock()
+            method.delivery_tag = tag
+            deliveries.append((method, None, body))
+        return deliveries
+
+    queue = "notifications.bench"
+    channel.queue_declare(queue=queue, durable=False, auto_delete=False)
+    channel.queue_purge(queue=queue)
+    for body in bodies:
+        channel.basic_publish(exchange="", routing_key=queue, body=body)
+    deliveries = []
+    while len(deliveries) < len(bodies):
+        method, properties, body = channel.basic_get(queue, auto_ack=False)
+        if method is not None:
+            deliveries.append((method, properties, body))
+    return deliveries
+
+
+def run_consumer(args, batch):
+    import consumer
+
+    connection = counting_connection_factory(args.backend)()
+    channel = connection.channel()
+    if args.backend == "fakes":
+        channel._channel.connection.sleep = time.sleep
+    deliveries = consumer_deliveries(args, channel)
+
+    if batch:
+        calls = [
+            lambda group=deliveries[start : start + args.batch_size]: consumer.process_batch(
+                channel, group
+            )
+            for start in range(0, len(deliveries), args.batch_size)
+        ]
+    else:
+        calls = [
+            lambda delivery=delivery: consumer.process_notification(channel, *delivery)
+            for delivery in deliveries
+        ]
+
+    with patch(
+        "consumer.get_notification_service", return_value=StubProvider(args.provider_latency)
+    ):
+        result = measure(
+            calls, args.batch_size if batch else 1, max(1, args.warmup // (args.batch_size if batch else 1))
+        )
+    if args.backend == "local":
+        connection.close()
+    return result
+
+
+def run_http(args):
+    """gunicorn + the existing HTTP load generator; memory is per worker"""
+    import asyncio
+    import httpx
+    from http_load import run as http_load
+
+    port = args.http_port
+    env = dict(
+        os.environ,
+        GUNICORN_BIND=f"127.0.0.1:{port}",
+        GUNICORN_WORKERS=str(args.workers),
+        GUNICORN_LOG_LEVEL="warning",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "app:app"],
+        cwd=REPO_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline or server.poll() is not None:
+                raise RuntimeError("gunicorn didn't come up")
+            time.sleep(0.2)
+
+        result = asyncio.run(
+            http_load(f"http://127.0.0.1:{port}/notifications", args.concurrency, args.duration)
+        )
+        workers = worker_pids(server.pid)
+        memory = [rss_mb(pid) for pid in workers]
+        memory = [value for value in memory if value is not None]
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    return {
+        "notifications": result["requests"],
+        "errors": result["errors"],
+        "notifications_per_second": result["rps"],
+        "p50_ms": result["p50_ms"],
+        "p99_ms": result["p99_ms"],
+        # Happens inside the server processes, out of our sight
+        "mongo_round_trips_per_notification": None,
+        "broker_calls_per_notification": None,
+        "rss_mb": sum(memory) / len(memory) if memory else None,
+    }
+
+
+def worker_pids(master_pid):
+    try:
+        with open(f"/proc/{master_pid}/task/{master_pid}/children") as children:
+            return [int(pid) for pid in children.read().split()]
+    except OSError:
+        return []
+
+
+def compare(report, baseline, tolerance, checks=None):
+    """Every metric that got worse than the baseline by more than `tolerance`"""
+    regressions = []
+    for name, result in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base is None:
+            continue
+        for metric, bigger_is_better in METRICS.items():
+            if checks and metric not in checks:
+                continue
+            now, then = result.get(metric), base.get(metric)
+            if now is None or then is None:
+                continue
+            if bigger_is_better:
+                worse = now < then * (1 - tolerance)
+            else:
+                worse = now > then * (1 + tolerance)
+            if worse:
+                regressions.append((name, metric, then, now))
+    return regressions
+
+
+def format_value(value):
+    return "n/a" if value is None else f"{value:.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=("local", "fakes"), default="fakes")
+    parser.add_argument("--scenarios", default="api,api_batch,consumer,consumer_batch")
+    parser.add_argument("--requests", type=int, default=1000, help="notifications per scenario")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--provider-latency", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers (http)")
+    parser.add_argument("--concurrency", type=int, default=32, help="HTTP clients (http)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds (http)")
+    parser.add_argument("--http-port", type=int, default=5099)
+    parser.add_argument("--output", help="write the report here as JSON")
+    parser.add_argument("--baseline", help="compare against this report")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--check", help="comma-separated metrics to compare (default: all)")
+    parser.add_argument("--write-baseline", help="save the report as a new baseline here")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    if "http" in scenarios and args.backend != "local":
+        parser.error("the http scenario needs --backend local")
+
+    setup_backend(args.backend)
+    runners = {
+        "api": lambda: run_api(args, batch=False),
+        "api_batch": lambda: run_api(args, batch=True),
+        "consumer": lambda: run_consumer(args, batch=False),
+        "consumer_batch": lambda: run_consumer(args, batch=True),
+        "http": lambda: run_http(args),
+    }
+
+    report = {
+        "backend": args.backend,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "requests": args.requests,
+            "batch_size": args.batch_size,
+            "provider_latency": args.provider_latency,
+        },
+        "scenarios": {},
+    }
+    print(
+        f"{'scenario':<16}{'notif/s':>12}{'p50 ms':>10}{'p99 ms':>10}"
+        f"{'mongo/notif':>13}{'broker/notif':>14}{'rss MB':>9}"
+    )
+    for name in scenarios:
+        reset_database()
+        result = runners[name]()
+        report["scenarios"][name] = result
+        print(
+            f"{name:<16}{result['notifications_per_second']:>12.1f}"
+            f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+            f"{format_value(result['mongo_round_trips_per_notification']):>13}"
+            f"{format_value(result['broker_calls_per_notification']):>14}"
+            f"{format_value(result['rss_mb']):>9}"
+        )
+
+    for path in filter(None, (args.output, args.write_baseline)):
+        with open(path, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+            output.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        checks = [metric.strip() for metric in args.check.split(",")] if args.check else None
+        regressions = compare(report, baseline, args.tolerance, checks)
+        if regressions:
+            print(f"\nRegressions against {args.baseline} (tolerance {args.tolerance:.0%}):")
+            for name, metric, then, now in regressions:
+                print(f"  {name}.{metric}: {then:.2f} -> {now:.2f}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Per-user inbox cache: in-process LRU+TTL, or Redis when it has to be shared."""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from prometheus_client import Counter
+from config import (
+    INBOX_CACHE_BACKEND,
+    INBOX_CACHE_MAX_ENTRIES,
+    INBOX_CACHE_TTL_SECONDS,
+    REDIS_URL,
+)
+
+INBOX_CACHE_HITS = Counter("inbox_cache_hits_total", "Inbox pages served from cache")
+INBOX_CACHE_MISSES = Counter(
+    "inbox_cache_misses_total", "Inbox pages that had to go to MongoDB"
+)
+INBOX_CACHE_EVICTIONS = Counter(
+    "inbox_cache_evictions_total", "Inbox pages dropped from the cache", ["reason"]
+)
+
+
+class MemoryCacheBackend:
+    """
+    In-process cache with LRU and TTL eviction
+
+    Bounded by total number of cached pages. Only sees invalidations from
+    its own process, so it's only correct when that process makes every
+    write - status updates from a consumer would never reach it. Anything
+    with separate workers needs the Redis backend.
+    """
+
+    def __init__(self, max_entries=INBOX_CACHE_MAX_ENTRIES, ttl=INBOX_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (user_id, page_key) -> (expires_at, page)
+        self._by_user = {}  # user_id -> set of page keys
+        self._lock = threading.Lock()
+
+    def get(self, user_id, page_key):
+        key = (user_id, page_key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, page = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                INBOX_CACHE_EVICTIONS.labels(reason="expired").inc()
+                return None
+            self._entries.move_to_end(key)
+            return page
+
+    def set(self, user_id, page_key, page):
+        key = (user_id, page_key)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, page)
+            self._entries.move_to_end(key)
+            self._by_user.setdefault(user_id, set()).add(page_key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                INBOX_CACHE_EVICTIONS.labels(reason="size").inc()
+
+    def invalidate(self, user_id):
+        with self._lock:
+            for page_key in self._by_user.pop(user_id, ()):
+                self._entries.pop((user_id, page_key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        user_id, page_key = key
+        pages = self._by_user.get(user_id)
+        if pages is not None:
+            pages.discard(page_key)
+            if not pages:
+                del self._by_user[user_id]
+
+
+class RedisCacheBackend:
+    """
+    Shared cache in Redis (or anything that speaks its protocol)
+
+    One hash per user, so invalidating a user is a single DEL no matter how
+    many pages were cached. Size is bounded by Redis' own maxmemory policy.
+    Needs the `redis` package.
+    """
+
+    def __init__(self, url=REDIS_URL, ttl=INBOX_CACHE_TTL_SECONDS, client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError(
+                    "INBOX_CACHE_BACKEND=redis needs the redis package (pip install redis)"
+                ) from None
+
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+
+    def _key(self, user_id):
+        return f"inbox:{user_id}"
+
+    def get(self, user_id, page_key):
+        raw = self.client.hget(self._key(user_id), page_key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, user_id, page_key, page):
+        key = self._key(user_id)
+        pipeline = self.client.pipeline()
+        pipeline.hset(key, page_key, json.dumps(page))
+        pipeline.expire(key, int(self.ttl))
+        pipeline.execute()
+
+    def invalidate(self, user_id):
+        self.client.delete(self._key(user_id))
+
+    def clear(self):
+        for key in self.client.scan_iter("inbox:*"):
+            self.client.delete(key)
+
+
+class InboxCache:
+    """
+    Read-through cache for inbox pages, invalidated per user on writes
+
+    With the backend set to None everything is a miss and invalidation is
+    free, so callers don't need to care whether caching is on
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    @staticmethod
+    def page_key(limit, options):
+        """A stable key for one page request (limit + filters + cursor)"""
+        return json.dumps([limit, options], sort_keys=True)
+
+    def get(self, user_id, page_key):
+        if self.backend is None:
+            return None
+        page = self.backend.get(user_id, page_key)
+        if page is None:
+            INBOX_CACHE_MISSES.inc()
+        else:
+            INBOX_CACHE_HITS.inc()
+        return page
+
+    def set(self, user_id, page_key, page):
+        if self.backend is not None:
+            self.backend.set(user_id, page_key, page)
+
+    def invalidate(self, *user_ids):
+        if self.backend is not None:
+            for user_id in set(user_ids):
+                self.backend.invalidate(user_id)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+def make_backend(name=INBOX_CACHE_BACKEND):
+    """Pick the cache backend from config ("memory", "redis" or "none")"""
+    if name == "memory":
+        return MemoryCacheBackend()
+    if name == "redis":
+        return RedisCacheBackend()
+    return None
+
+
+inbox_cache = InboxCache(make_backend())
@@ -1,6 +1,7 @@
 """Configuration management for the notification service."""
 
 import os
+import multiprocessing
 from dotenv import load_dotenv
 
 # Load environment variables from .env file if it exists
@@ -25,11 +26,160 @@ RABBITMQ_URL = os.getenv(
     "RABBITMQ_URL",
     f"amqp://{RABBITMQ_USER}:{RABBITMQ_PASSWORD}@{RABBITMQ_HOST}:{RABBITMQ_PORT}/",
 )
+RABBITMQ_PERSIST_QUEUE = os.getenv("RABBITMQ_PERSIST_QUEUE", f"{RABBITMQ_QUEUE}.persist")
+RABBITMQ_INGEST_EXCHANGE = os.getenv("RABBITMQ_INGEST_EXCHANGE", f"{RABBITMQ_QUEUE}.ingest")
+RABBITMQ_RETRY_EXCHANGE = os.getenv("RABBITMQ_RETRY_EXCHANGE", f"{RABBITMQ_QUEUE}.retry")
+RABBITMQ_DEAD_LETTER_QUEUE = os.getenv(
+    "RABBITMQ_DEAD_LETTER_QUEUE", f"{RABBITMQ_QUEUE}.dead"
+)
+RABBITMQ_FANOUT_QUEUE = os.getenv("RABBITMQ_FANOUT_QUEUE", f"{RABBITMQ_QUEUE}.fanout")
+
+# Priority lanes, "name=weight" each. Every lane has its own queue
+# ("<RABBITMQ_QUEUE>.<name>", except the default lane, which keeps
+# RABBITMQ_QUEUE) and the consumer serves them in proportion to their weights.
+PRIORITY_LANES = os.getenv("PRIORITY_LANES", "transactional=8,default=4,bulk=1")
+DEFAULT_PRIORITY = os.getenv("DEFAULT_PRIORITY", "default")
+
+# Retries: failed messages wait in a delay queue (exponential backoff with
+# +/- RETRY_JITTER) and land in the dead-letter queue after RETRY_MAX_ATTEMPTS.
+# Set RETRY_ENABLED=false to go back to plain nack-and-requeue.
+RETRY_ENABLED = os.getenv("RETRY_ENABLED", "true").lower() == "true"
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY_MS = int(os.getenv("RETRY_BASE_DELAY_MS", "1000"))
+RETRY_MAX_DELAY_MS = int(os.getenv("RETRY_MAX_DELAY_MS", "300000"))
+RETRY_JITTER = float(os.getenv("RETRY_JITTER", "0.2"))
+DEAD_LETTER_LIST_MAX = int(os.getenv("DEAD_LETTER_LIST_MAX", "500"))
+
+# Ingestion mode: "sync" saves to Mongo before publishing, "write_behind"
+# publishes first and lets persister.py write the records in batches
+INGESTION_MODE = os.getenv("INGESTION_MODE", "sync")
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "500"))
+PERSIST_BATCH_TIMEOUT_MS = int(os.getenv("PERSIST_BATCH_TIMEOUT_MS", "200"))
+
+# Publisher settings (one long-lived connection per API worker process)
+PUBLISHER_MAX_RECONNECTS = int(os.getenv("PUBLISHER_MAX_RECONNECTS", "2"))
+PUBLISHER_CONFIRMS = os.getenv("PUBLISHER_CONFIRMS", "true").lower() == "true"
+PUBLISHER_MAX_IN_FLIGHT = int(os.getenv("PUBLISHER_MAX_IN_FLIGHT", "1000"))
+PUBLISHER_MAX_RETRIES = int(os.getenv("PUBLISHER_MAX_RETRIES", "3"))
+PUBLISHER_CONFIRM_TIMEOUT = float(os.getenv("PUBLISHER_CONFIRM_TIMEOUT", "10"))
+PUBLISHER_RECONNECT_DELAY = float(os.getenv("PUBLISHER_RECONNECT_DELAY", "0.5"))
+
+# Consumer settings - a batch size of 1 keeps the classic one-message-at-a-time loop
+CONSUMER_PREFETCH_COUNT = int(os.getenv("CONSUMER_PREFETCH_COUNT", "1"))
+CONSUMER_BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", "1"))
+CONSUMER_BATCH_TIMEOUT_MS = int(os.getenv("CONSUMER_BATCH_TIMEOUT_MS", "200"))
+
+# Asyncio consumer - sends in flight at once per channel, and how long to drain on SIGTERM
+ASYNC_CONSUMER_CONCURRENCY = int(os.getenv("ASYNC_CONSUMER_CONCURRENCY", "50"))
+ASYNC_CONSUMER_CHANNELS = int(os.getenv("ASYNC_CONSUMER_CHANNELS", "1"))
+CONSUMER_DRAIN_TIMEOUT = float(os.getenv("CONSUMER_DRAIN_TIMEOUT", "30"))
+
+# Consumer supervisor - how many consumer processes to run on one box
+CONSUMER_ENGINE = os.getenv("CONSUMER_ENGINE", "sync")  # sync or async
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", multiprocessing.cpu_count()))
+CONSUMER_MIN_WORKERS = int(os.getenv("CONSUMER_MIN_WORKERS", "1"))
+CONSUMER_MAX_WORKERS = int(
+    os.getenv("CONSUMER_MAX_WORKERS", multiprocessing.cpu_count() * 2)
+)
+CONSUMER_AUTOSCALE = os.getenv("CONSUMER_AUTOSCALE", "false").lower() == "true"
+CONSUMER_SCALE_INTERVAL = float(os.getenv("CONSUMER_SCALE_INTERVAL", "15"))
+CONSUMER_MESSAGES_PER_WORKER = int(os.getenv("CONSUMER_MESSAGES_PER_WORKER", "1000"))
+# Consumers serve their own /metrics here (0 turns it off). Supervised
+# workers each take the next free port up from it.
+CONSUMER_METRICS_PORT = int(os.getenv("CONSUMER_METRICS_PORT", "9100"))
+
+# Notification providers: extra modules that register channel types on import,
+# plus timeout/pool size for providers built on HTTPNotificationService
+NOTIFICATION_PROVIDER_MODULES = [
+    module.strip()
+    for module in os.getenv("NOTIFICATION_PROVIDER_MODULES", "").split(",")
+    if module.strip()
+]
+PROVIDER_HTTP_TIMEOUT = float(os.getenv("PROVIDER_HTTP_TIMEOUT", "10"))
+PROVIDER_HTTP_POOL_SIZE = int(os.getenv("PROVIDER_HTTP_POOL_SIZE", "20"))
+# Most recipients a single bulk provider request may carry
+EMAIL_BATCH_MAX_RECIPIENTS = int(os.getenv("EMAIL_BATCH_MAX_RECIPIENTS", "1000"))
+SMS_BATCH_MAX_RECIPIENTS = int(os.getenv("SMS_BATCH_MAX_RECIPIENTS", "1000"))
+
+# Rate limits per notification type, e.g. "email=100,sms=10:20" (per second,
+# optional burst after the colon). TENANT_RATE_LIMITS applies the same format
+# to each tenant_id separately. Types left out aren't limited.
+CHANNEL_RATE_LIMITS = os.getenv("CHANNEL_RATE_LIMITS", "")
+TENANT_RATE_LIMITS = os.getenv("TENANT_RATE_LIMITS", "")
+RATE_LIMIT_MAX_TENANTS = int(os.getenv("RATE_LIMIT_MAX_TENANTS", "10000"))
+# How often a send that the provider throttles is retried in place before
+# the message goes back to the queue
+RATE_LIMIT_MAX_THROTTLE_RETRIES = int(os.getenv("RATE_LIMIT_MAX_THROTTLE_RETRIES", "3"))
+# Async consumer only: most sends of one type in flight at once, e.g. "sms=5"
+CHANNEL_CONCURRENCY = os.getenv("CHANNEL_CONCURRENCY", "")
+
+# Dedup: claim each notification (pending -> sending) before sending it and
+# ack redeliveries of finished ones without calling the provider again.
+# The lease is how long a claim holds if its consumer dies mid-send.
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "false").lower() == "true"
+DEDUP_LEASE_SECONDS = float(os.getenv("DEDUP_LEASE_SECONDS", "60"))
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "100000"))
+
+# Digests: notifications of these types (e.g. "push,email") wait per
+# (user_id, type) for up to DIGEST_WINDOW_SECONDS and whatever piled up goes
+# out as one message. A digest holds at most DIGEST_MAX_ITEMS, and a consumer
+# holds at most DIGEST_MAX_BUFFERED notifications (the oldest digest goes out
+# early past that). Empty turns digests off. With dedup on, keep the window
+# well below DEDUP_LEASE_SECONDS.
+DIGEST_TYPES = [
+    notification_type.strip()
+    for notification_type in os.getenv("DIGEST_TYPES", "").split(",")
+    if notification_type.strip()
+]
+DIGEST_WINDOW_SECONDS = float(os.getenv("DIGEST_WINDOW_SECONDS", "30"))
+DIGEST_MAX_ITEMS = int(os.getenv("DIGEST_MAX_ITEMS", "50"))
+DIGEST_MAX_BUFFERED = int(os.getenv("DIGEST_MAX_BUFFERED", "1000"))
+
+# Fan-out: one request for many users. fanout.py expands each job
+# FANOUT_CHUNK_SIZE users at a time (one bulk upsert, one publish_many),
+# checkpointing after every chunk. Bigger audiences than
+# FANOUT_MAX_USER_IDS have to be stored as a segment first.
+FANOUT_CHUNK_SIZE = int(os.getenv("FANOUT_CHUNK_SIZE", "1000"))
+FANOUT_MAX_USER_IDS = int(os.getenv("FANOUT_MAX_USER_IDS", "100000"))
+
+# Scheduled notifications (send_at): scheduler.py claims whatever is due
+# within the lookahead window every poll interval, holds it in memory and
+# publishes each one at its time plus up to SCHEDULER_JITTER_SECONDS, so a
+# burst booked for the top of the hour is spread out a little. A claim
+# lasts the lookahead plus SCHEDULER_LEASE_SECONDS; a scheduler that dies
+# leaves its claims to run out and another one picks them up.
+SCHEDULER_LOOKAHEAD_SECONDS = float(os.getenv("SCHEDULER_LOOKAHEAD_SECONDS", "60"))
+SCHEDULER_POLL_INTERVAL = float(os.getenv("SCHEDULER_POLL_INTERVAL", "0.5"))
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "5000"))
+SCHEDULER_MAX_PENDING = int(os.getenv("SCHEDULER_MAX_PENDING", "100000"))
+SCHEDULER_JITTER_SECONDS = float(os.getenv("SCHEDULER_JITTER_SECONDS", "0.5"))
+SCHEDULER_LEASE_SECONDS = float(os.getenv("SCHEDULER_LEASE_SECONDS", "60"))
+
+# Notification templates: compiled templates cached per process, and how
+# long before an edited template is picked up
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "1000"))
+TEMPLATE_CACHE_TTL_SECONDS = float(os.getenv("TEMPLATE_CACHE_TTL_SECONDS", "60"))
+TEMPLATE_MAX_BYTES = int(os.getenv("TEMPLATE_MAX_BYTES", "262144"))
 
 # API settings
 API_HOST = os.getenv("API_HOST", "0.0.0.0")
 API_PORT = int(os.getenv("API_PORT", "5000"))
 DEBUG = ENV != "production"
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "5000"))
+INBOX_DEFAULT_LIMIT = int(os.getenv("INBOX_DEFAULT_LIMIT", "50"))
+INBOX_MAX_LIMIT = int(os.getenv("INBOX_MAX_LIMIT", "500"))
+# Export streaming: documents per Mongo getMore, bytes per HTTP chunk
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", "65536"))
+
+# Inbox cache: "redis" (shared, needs the redis package), "memory" or "none".
+# Status changes are written by the consumers, persister and scheduler, not
+# the API, so only a shared cache sees them - "memory" is only right when a
+# single process does every write (tests, benchmarks). Off unless asked for.
+INBOX_CACHE_BACKEND = os.getenv("INBOX_CACHE_BACKEND", "none")
+INBOX_CACHE_MAX_ENTRIES = int(os.getenv("INBOX_CACHE_MAX_ENTRIES", "10000"))
+INBOX_CACHE_TTL_SECONDS = float(os.getenv("INBOX_CACHE_TTL_SECONDS", "30"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
 # Logging
 LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING")
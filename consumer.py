@@ -2,17 +2,40 @@ import pika
 import json
 import time
 import logging
+import signal
 import warnings
-from notification_services import get_notification_service
-from database import update_notification_status
+from jinja2 import TemplateError
+from notification_services import get_notification_service, registry
+from database import (
+    update_notification_status,
+    update_notification_statuses,
+    claim_notification,
+    claim_notifications,
+    release_notifications,
+    get_template,
+)
+from dedup import recently_completed, seen_recently, note_claim
+from digest import digests, digest_content, DIGEST_DELIVERIES, DIGEST_COALESCED
+from lanes import LANES, WeightedScheduler, get_lane, observe_processed
+from latency import stamp, observe_stages
+from metrics import start_metrics_server
+from rate_limit import rate_limiter
+from templates import render_notification
+from retries import schedule_retry, declare_retry_topology
 from config import (
     LOG_LEVEL,
+    CONSUMER_PREFETCH_COUNT,
+    CONSUMER_BATCH_SIZE,
+    CONSUMER_BATCH_TIMEOUT_MS,
     RABBITMQ_HOST,
     RABBITMQ_PORT,
     RABBITMQ_USER,
     RABBITMQ_PASSWORD,
-    RABBITMQ_QUEUE,
     RABBITMQ_URL,
+    DEDUP_ENABLED,
+    DEDUP_LEASE_SECONDS,
+    DIGEST_MAX_BUFFERED,
+    DIGEST_WINDOW_SECONDS,
 )
 
 # Quiet those pesky warnings
@@ -42,7 +65,92 @@ def get_rabbitmq_connection():
     return connection
 
 
-def process_notification(ch, method, properties, body):
+def parse_notification(body):
+    """
+    Turn a raw message body into notification data
+
+    Returns None for messages we should just acknowledge and drop (empty or
+    missing fields). Invalid JSON raises json.JSONDecodeError. Templated
+    notifications carry template_id (and variables) instead of content.
+    """
+    # Check if body is empty
+    if not body:
+        logger.warning("Received empty message body. Acknowledging and skipping.")
+        return None
+
+    # Parse the notification
+    notification_data = json.loads(body)
+
+    # Validate essential fields
+    notification_id = notification_data.get("id")
+    user_id = notification_data.get("user_id")
+    notification_type = notification_data.get("type")
+    content = notification_data.get("content") or notification_data.get("template_id")
+
+    if not all([notification_id, user_id, notification_type, content]):
+        logger.warning(
+            f"Received incomplete notification data: {notification_data}. Acknowledging and skipping."
+        )
+        return None
+
+    return notification_data
+
+
+def render(notification_data):
+    """
+    Render a templated notification's content, if it has a template
+
+    False means it can't be rendered (no such template, missing variables) -
+    no retry would fix that, so it's recorded as failed
+    """
+    try:
+        render_notification(notification_data, get_template)
+    except TemplateError as e:
+        logger.error(f"Can't render notification {notification_data['id']}: {str(e)}")
+        return False
+    return True
+
+
+def deliver_notification(notification_data, sleep=time.sleep):
+    """
+    Send a parsed notification through the right channel
+
+    Waits (with `sleep`) for the type's rate limit, if it has one. Templated
+    notifications are rendered first.
+
+    Returns the status to record: "delivered" or "failed"
+    """
+    notification_id = notification_data["id"]
+    user_id = notification_data["user_id"]
+    notification_type = notification_data["type"]
+
+    logger.info(
+        f"Processing {notification_type} notification {notification_id} for user {user_id}"
+    )
+
+    if not render(notification_data):
+        return "failed"
+
+    # Get the appropriate notification service
+    service = get_notification_service(notification_type)
+
+    # Send the notification, at a pace the provider is happy with
+    sent = rate_limiter.run(
+        notification_type,
+        lambda: service.send(user_id, notification_data["content"]),
+        tenant=notification_data.get("tenant_id"),
+        sleep=sleep,
+    )
+    stamp(notification_data, "sent")
+    if sent:
+        logger.info(f"Notification {notification_id} delivered successfully")
+        return "delivered"
+
+    logger.error(f"Failed to deliver notification {notification_id}")
+    return "failed"
+
+
+def process_notification(ch, method, properties, body, lane=None):
     """
     Handles notifications coming from the queue
 
@@ -50,87 +158,587 @@ def process_notification(ch, method, properties, body):
     - Checking if the message makes sense
     - Sending it through the right channel
     - Telling RabbitMQ we're done with it
+
+    `lane` is the priority lane the message came in on (the default lane if
+    not given) - retries go back to that lane's queue.
+
+    With DEDUP_ENABLED, the notification is claimed in Mongo first, so a
+    redelivery of something already sent gets acked without sending it again
     """
+    lane = lane or get_lane()
+    claimed = None
     try:
-        # Check if body is empty
-        if not body:
-            logger.warning("Received empty message body. Acknowledging and skipping.")
+        notification_data = parse_notification(body)
+        if notification_data is None:
             ch.basic_ack(delivery_tag=method.delivery_tag)
             return
+        stamp(notification_data, "consumed")
 
-        # Parse the notification
-        notification_data = json.loads(body)
+        if DEDUP_ENABLED:
+            notification_id = notification_data["id"]
+            state = (
+                "duplicate"
+                if seen_recently(notification_id)
+                else note_claim(
+                    notification_id,
+                    claim_notification(notification_id, notification=notification_data),
+                )
+            )
+            if state == "duplicate":
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
+            if state == "in_flight":
+                # Someone else is sending it right now - check back later
+                schedule_retry(
+                    ch,
+                    method,
+                    properties,
+                    body,
+                    "in flight elsewhere",
+                    queue=lane.queue,
+                    count_attempt=False,
+                )
+                return
+            claimed = notification_id
 
-        # Validate essential fields
-        notification_id = notification_data.get("id")
-        user_id = notification_data.get("user_id")
-        notification_type = notification_data.get("type")
-        content = notification_data.get("content")
+        # connection.sleep keeps heartbeats going while we wait for a token,
+        # and the message just sits unacked in our prefetch window meanwhile
+        status = deliver_notification(notification_data, sleep=ch.connection.sleep)
 
-        if not all([notification_id, user_id, notification_type, content]):
-            logger.warning(
-                f"Received incomplete notification data: {notification_data}. Acknowledging and skipping."
-            )
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-            return
+        # Update the notification status in the database
+        update_notification_status(notification_data["id"], status, notification_data)
+        stamp(notification_data, "status_written")
+        if claimed:
+            recently_completed.add(claimed)
 
-        logger.info(
-            f"Processing {notification_type} notification {notification_id} for user {user_id}"
+        # Acknowledge the message
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        observe_stages(notification_data)
+        observe_processed(lane.name, notification_data)
+
+    except json.JSONDecodeError as e:
+        logger.error(
+            f"Invalid JSON in message: {str(e)}. Message content: '{body.decode('utf-8', errors='replace')}'"
         )
+        # Don't requeue invalid JSON messages as they will never process correctly
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+    except Exception as e:
+        logger.error(f"Error processing notification: {str(e)}")
+        if claimed:
+            # Let the retry claim it straight away
+            release_notifications([claimed])
+        # Back off and try again later instead of straight back to the queue
+        schedule_retry(ch, method, properties, body, e, queue=lane.queue)
+
+
+def deliver_batch(notifications, sleep=time.sleep):
+    """
+    Send a group of parsed notifications, one send_batch call per type
+
+    Rate limits still apply: a group costs one token per notification, and
+    is split up if that's more than the bucket can ever hold. Templated
+    notifications are rendered first; the ones that can't be are "failed".
+
+    Returns one result per notification, in order: "delivered", "failed",
+    or the exception that notification hit
+    """
+    results = [None] * len(notifications)
+    groups = {}
+    for index, notification_data in enumerate(notifications):
+        if not render(notification_data):
+            results[index] = "failed"
+            continue
+        key = (notification_data["type"], notification_data.get("tenant_id"))
+        groups.setdefault(key, []).append(index)
 
-        # Get the appropriate notification service
+    for (notification_type, tenant), group in groups.items():
+        chunk_size = rate_limiter.max_cost(notification_type, tenant) or len(group)
+        for start in range(0, len(group), chunk_size):
+            indexes = group[start : start + chunk_size]
+            deliver_chunk(notifications, indexes, results, tenant, sleep)
+
+    return results
+
+
+def deliver_chunk(notifications, indexes, results, tenant, sleep):
+    """One paced send_batch call for notifications of a single type"""
+    notification_type = notifications[indexes[0]]["type"]
+    items = [
+        (notifications[index]["user_id"], notifications[index]["content"])
+        for index in indexes
+    ]
+    try:
         service = get_notification_service(notification_type)
+        outcomes = rate_limiter.run(
+            notification_type,
+            lambda: service.send_batch(items),
+            tenant=tenant,
+            cost=len(items),
+            sleep=sleep,
+        )
+    except Exception as e:
+        # The whole provider call went wrong - every item in it did
+        outcomes = [e] * len(indexes)
 
-        # Send the notification
-        success = service.send(user_id, content)
+    outcomes = list(outcomes)
+    if len(outcomes) != len(indexes):
+        logger.error(
+            f"{notification_type} send_batch returned {len(outcomes)} results "
+            f"for {len(indexes)} notifications"
+        )
+        # No answer for a notification means we can't say it was delivered
+        outcomes = (outcomes + [False] * len(indexes))[: len(indexes)]
 
-        if success:
-            # Update the notification status in the database
-            update_notification_status(notification_id, "delivered")
+    sent_at = time.time()
+    for index, outcome in zip(indexes, outcomes):
+        notification_id = notifications[index]["id"]
+        stamp(notifications[index], "sent", now=sent_at)
+        if isinstance(outcome, Exception):
+            results[index] = outcome
+        elif outcome:
             logger.info(f"Notification {notification_id} delivered successfully")
+            results[index] = "delivered"
         else:
-            # Update the notification status in the database
-            update_notification_status(notification_id, "failed")
             logger.error(f"Failed to deliver notification {notification_id}")
+            results[index] = "failed"
 
-        # Acknowledge the message
-        ch.basic_ack(delivery_tag=method.delivery_tag)
 
-    except json.JSONDecodeError as e:
-        logger.error(
-            f"Invalid JSON in message: {str(e)}. Message content: '{body.decode('utf-8', errors='replace')}'"
+def claim_batch(ch, parsed, queue):
+    """
+    The dedup step for a batch: claim everything in one go
+
+    In-flight notifications are postponed right here (back to `queue`, the
+    lane they came from). Returns the entries
+    that are ours to send, plus the delivery tags of the duplicates (acked
+    along with the rest of the batch).
+    """
+    fresh = [entry for entry in parsed if not seen_recently(entry[1]["id"])]
+    messages = {notification_data["id"]: notification_data for _, notification_data in fresh}
+    states = claim_notifications(list(messages), notifications=messages)
+
+    to_send = []
+    sending = set()
+    duplicate_tags = []
+    for delivery, notification_data in parsed:
+        method, properties, body = delivery
+        notification_id = notification_data["id"]
+        if notification_id in states and notification_id not in sending:
+            state = note_claim(notification_id, states[notification_id])
+        else:
+            # Seen recently, or the same notification twice in one batch
+            state = "duplicate"
+
+        if state == "claimed":
+            sending.add(notification_id)
+            to_send.append((delivery, notification_data))
+        elif state == "in_flight":
+            schedule_retry(
+                ch,
+                method,
+                properties,
+                body,
+                "in flight elsewhere",
+                queue=queue,
+                count_attempt=False,
+            )
+        else:
+            duplicate_tags.append(method.delivery_tag)
+
+    return to_send, duplicate_tags
+
+
+def deliver_digest(notifications, sleep=time.sleep):
+    """
+    Send one user's held notifications of one type as a single message
+
+    Templated ones are rendered first; any that can't be are "failed" on
+    their own. A notification that ends up alone goes out as itself.
+
+    Returns one status per notification, in order. Raises if the send blew up
+    """
+    statuses = ["failed"] * len(notifications)
+    renderable = [
+        index
+        for index, notification_data in enumerate(notifications)
+        if render(notification_data)
+    ]
+    if not renderable:
+        return statuses
+    first = notifications[renderable[0]]
+    if len(renderable) == 1:
+        statuses[renderable[0]] = deliver_notification(first, sleep=sleep)
+        return statuses
+
+    content = digest_content([notifications[index] for index in renderable])
+    service = get_notification_service(first["type"])
+    sent = rate_limiter.run(
+        first["type"],
+        lambda: service.send(first["user_id"], content),
+        tenant=first.get("tenant_id"),
+        sleep=sleep,
+    )
+    status = "delivered" if sent else "failed"
+    sent_at = time.time()
+    for index in renderable:
+        stamp(notifications[index], "sent", now=sent_at)
+        statuses[index] = status
+
+    if sent:
+        logger.info(
+            f"Digest of {len(renderable)} {first['type']} notifications delivered to user {first['user_id']}"
         )
-        # Don't requeue invalid JSON messages as they will never process correctly
+    else:
+        logger.error(f"Failed to deliver digest to user {first['user_id']}")
+    return statuses
+
+
+def flush_digests(buffers, sleep=time.sleep):
+    """
+    Send each digest buffer, write every status in one go, then ack
+
+    Buffer entries are (channel, lane, (method, properties, body),
+    notification data). If a digest's send blows up, each of its messages
+    goes off for a retry on its own (and waits for a digest again when it
+    comes back).
+    """
+    statuses = {}
+    sent = []
+    for buffer in buffers:
+        notifications = [notification_data for *_, notification_data in buffer.entries]
+        try:
+            results = deliver_digest(notifications, sleep=sleep)
+        except Exception as e:
+            logger.error(f"Error sending digest for user {buffer.key[0]}: {str(e)}")
+            for ch, lane, (method, properties, body), _ in buffer.entries:
+                schedule_retry(ch, method, properties, body, e, queue=lane.queue)
+            if DEDUP_ENABLED:
+                release_notifications(
+                    [notification_data["id"] for notification_data in notifications]
+                )
+            continue
+
+        DIGEST_DELIVERIES.labels(reason=buffer.reason).inc()
+        DIGEST_COALESCED.inc(len(notifications))
+        for notification_data, status in zip(notifications, results):
+            statuses[notification_data["id"]] = status
+        sent.extend(buffer.entries)
+
+    if not sent:
+        return
+
+    try:
+        update_notification_statuses(
+            statuses,
+            {notification_data["id"]: notification_data for *_, notification_data in sent},
+        )
+    except Exception as e:
+        logger.error(f"Error writing digest statuses: {str(e)}")
+        for ch, lane, (method, properties, body), _ in sent:
+            schedule_retry(ch, method, properties, body, e, queue=lane.queue)
+        return
+
+    if DEDUP_ENABLED:
+        recently_completed.add(*statuses)
+    written_at = time.time()
+    for ch, lane, (method, _, _), notification_data in sent:
+        # Each on its own - other deliveries on the channel may still be held
         ch.basic_ack(delivery_tag=method.delivery_tag)
+        stamp(notification_data, "status_written", now=written_at)
+        observe_stages(notification_data)
+        observe_processed(lane.name, notification_data)
+
+
+def hold_for_digest(ch, parsed, lane):
+    """
+    Park the batch's notifications of digest types in their buffers
+
+    Returns the entries to send right away. Buffers that filled up in the
+    process are sent here and now.
+    """
+    to_send = []
+    ready = []
+    for delivery, notification_data in parsed:
+        if digests.wants(notification_data):
+            ready.extend(digests.add(notification_data, (ch, lane, delivery, notification_data)))
+        else:
+            to_send.append((delivery, notification_data))
+
+    if ready:
+        flush_digests(ready, sleep=ch.connection.sleep)
+    return to_send
+
+
+def ack_batch(ch, tags):
+    """
+    Ack a batch with one multiple ack - or one by one if digests still
+    hold deliveries from this channel that a multiple ack would take along
+    """
+    if digests.enabled and digests.holding(lambda entry: entry[0] is ch):
+        for tag in sorted(tags):
+            ch.basic_ack(delivery_tag=tag)
+    else:
+        ch.basic_ack(delivery_tag=max(tags), multiple=True)
+
+
+def process_batch(ch, deliveries, lane=None):
+    """
+    Handles a group of messages with one status write and one ack
+
+    Each delivery is (method, properties, body), all from the same `lane`
+    (the default lane if not given). Messages are grouped by type so each
+    provider gets a single send_batch call. Anything that blows up is sent
+    off for a delayed retry on its own; everything else has its status
+    written with a single bulk_write and is then acked with
+    basic_ack(multiple=True). Notifications of DIGEST_TYPES are held back
+    for a digest instead.
+    """
+    lane = lane or get_lane()
+    statuses = {}
+    ack_tags = []
+    parsed = []  # ((method, properties, body), notification data)
+    delivered = []
+
+    consumed_at = time.time()
+    for method, properties, body in deliveries:
+        try:
+            notification_data = parse_notification(body)
+            if notification_data is not None:
+                stamp(notification_data, "consumed", now=consumed_at)
+                parsed.append(((method, properties, body), notification_data))
+                continue
+        except json.JSONDecodeError as e:
+            # Never going to parse - ack it along with the rest
+            logger.error(
+                f"Invalid JSON in message: {str(e)}. Message content: '{body.decode('utf-8', errors='replace')}'"
+            )
+        except Exception as e:
+            logger.error(f"Error processing notification: {str(e)}")
+            schedule_retry(ch, method, properties, body, e, queue=lane.queue)
+            continue
+
+        ack_tags.append(method.delivery_tag)
+
+    if DEDUP_ENABLED and parsed:
+        parsed, duplicate_tags = claim_batch(ch, parsed, lane.queue)
+        ack_tags.extend(duplicate_tags)
+
+    if digests.enabled and parsed:
+        parsed = hold_for_digest(ch, parsed, lane)
+
+    results = deliver_batch(
+        [notification_data for _, notification_data in parsed],
+        sleep=ch.connection.sleep,
+    )
+    failed = []
+    for (delivery, notification_data), result in zip(parsed, results):
+        method, properties, body = delivery
+        if isinstance(result, Exception):
+            logger.error(f"Error processing notification: {str(result)}")
+            schedule_retry(ch, method, properties, body, result, queue=lane.queue)
+            failed.append(notification_data["id"])
+            continue
+        statuses[notification_data["id"]] = result
+        delivered.append((delivery, notification_data))
+        ack_tags.append(method.delivery_tag)
+
+    if DEDUP_ENABLED and failed:
+        # Hand the claims back so the retries can pick them straight up
+        release_notifications(failed)
+
+    if not ack_tags:
+        return
+
+    try:
+        update_notification_statuses(
+            statuses,
+            {notification_data["id"]: notification_data for _, notification_data in delivered},
+        )
     except Exception as e:
-        logger.error(f"Error processing notification: {str(e)}")
-        # Negative acknowledgment with requeue for other errors
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        logger.error(f"Error writing batch statuses: {str(e)}")
+        # Try the whole lot again later (the group ack below takes them off)
+        for (method, properties, body), _ in delivered:
+            schedule_retry(ch, method, properties, body, e, ack=False, queue=lane.queue)
+    else:
+        if DEDUP_ENABLED:
+            recently_completed.add(*statuses)
+        written_at = time.time()
+        for _, notification_data in delivered:
+            stamp(notification_data, "status_written", now=written_at)
+            observe_stages(notification_data)
+            observe_processed(lane.name, notification_data)
+
+    # One ack for the whole group (nacked tags are already settled)
+    ack_batch(ch, ack_tags)
+
+
+def consume_in_batches(
+    connection,
+    channel,
+    queue,
+    handler,
+    batch_size=CONSUMER_BATCH_SIZE,
+    batch_timeout_ms=CONSUMER_BATCH_TIMEOUT_MS,
+):
+    """
+    Gather up to `batch_size` deliveries (or whatever arrived within
+    `batch_timeout_ms` of the first one) and hand them to `handler`
+    """
+    pending = []
+
+    def on_message(ch, method, properties, body):
+        pending.append((method, properties, body))
+
+    channel.basic_consume(queue=queue, on_message_callback=on_message)
+    batch_timeout = batch_timeout_ms / 1000.0
+
+    while True:
+        if not pending:
+            connection.process_data_events(time_limit=1)
+            continue
+
+        # Got our first message - give the rest of the batch a moment to arrive
+        deadline = time.monotonic() + batch_timeout
+        while len(pending) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            connection.process_data_events(time_limit=remaining)
+
+        batch = pending[:batch_size]
+        del pending[:batch_size]
+        handler(channel, batch)
+
+
+def consume_lanes(
+    connection,
+    lanes=LANES,
+    batch_size=CONSUMER_BATCH_SIZE,
+    batch_timeout_ms=CONSUMER_BATCH_TIMEOUT_MS,
+    prefetch_count=CONSUMER_PREFETCH_COUNT,
+    scheduler=None,
+):
+    """
+    Consume every priority lane, sharing the work out by lane weight
+
+    Each lane gets its own channel (so a batch's multiple-ack never covers
+    another lane's deliveries) with its own prefetch window, so a bulk
+    backlog can't stop transactional messages from reaching us. Deliveries
+    wait in a WeightedScheduler and each turn handles one message - or one
+    batch of up to `batch_size`, gathered for at most `batch_timeout_ms` -
+    from whichever lane is next. Digests whose window is up go out between
+    turns.
+    """
+    scheduler = scheduler or WeightedScheduler(lanes)
+    lanes_by_name = {lane.name: lane for lane in lanes}
+
+    def buffer_for(name):
+        def on_message(ch, method, properties, body):
+            scheduler.push(name, (ch, method, properties, body))
+
+        return on_message
+
+    for lane in lanes:
+        channel = connection.channel()
+        channel.queue_declare(queue=lane.queue, durable=True)
+        declare_retry_topology(channel, lane.queue)
+        # The prefetch window has to fit at least one full batch, on top of
+        # whatever the digests are holding unacked
+        held = DIGEST_MAX_BUFFERED if digests.enabled else 0
+        channel.basic_qos(prefetch_count=max(prefetch_count, batch_size) + held)
+        channel.basic_consume(
+            queue=lane.queue, on_message_callback=buffer_for(lane.name)
+        )
+
+    batch_timeout = batch_timeout_ms / 1000.0
+    while True:
+        if digests.enabled:
+            flush_digests(digests.due(), sleep=connection.sleep)
 
+        name = scheduler.next_lane()
+        if name is None:
+            connection.process_data_events(time_limit=1)
+            continue
 
-def start_consumer():
-    """Wake up our message handler and start listening"""
+        if batch_size > 1:
+            # Give the rest of the batch a moment to arrive
+            deadline = time.monotonic() + batch_timeout
+            while scheduler.pending(name) < batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                connection.process_data_events(time_limit=remaining)
+
+        batch = scheduler.take(name, batch_size)
+        channel = batch[0][0]
+        if batch_size > 1 or digests.enabled:
+            process_batch(
+                channel,
+                [(method, properties, body) for _, method, properties, body in batch],
+                lanes_by_name[name],
+            )
+        else:
+            process_notification(*batch[0], lane=lanes_by_name[name])
+
+        # Let in whatever arrived meanwhile before picking the next lane
+        connection.process_data_events(time_limit=0)
+
+
+def start_consumer(metrics_port=None):
+    """
+    Wake up our message handler and start listening
+
+    metrics_port pins /metrics to one port (the supervisor gives each
+    worker its own); otherwise it's the first free one from CONSUMER_METRICS_PORT
+    """
+
+    # Our own /metrics, since the API's endpoint can't see this process
+    if metrics_port is None:
+        start_metrics_server()
+    else:
+        start_metrics_server(metrics_port, tries=1)
 
     # Knock knock, RabbitMQ
     connection = get_rabbitmq_connection()
-    channel = connection.channel()  # Make sure our queue exists
-    channel.queue_declare(queue=RABBITMQ_QUEUE, durable=True)
 
-    # One at a time please - we're not in a rush
-    channel.basic_qos(prefetch_count=1)  # Tell RabbitMQ to call us when messages arrive
-    channel.basic_consume(
-        queue=RABBITMQ_QUEUE, on_message_callback=process_notification
-    )
+    # Set up every provider now rather than on the first message
+    registry.start_all()
+    for notification_type, healthy in registry.health().items():
+        if not healthy:
+            logger.warning(f"{notification_type} provider is not healthy at startup")
+
+    lanes = ", ".join(f"{lane.name}={lane.weight}" for lane in LANES)
+    if CONSUMER_BATCH_SIZE > 1:
+        logger.info(f"🔔 Notification handler is awake and listening in batches ({lanes})...")
+    else:
+        logger.info(f"🔔 Notification handler is awake and listening ({lanes})...")
+
+    if digests.enabled:
+        logger.info(
+            f"📬 Holding {', '.join(sorted(digests.types))} notifications for digests "
+            f"({DIGEST_WINDOW_SECONDS:g}s window)"
+        )
+        if DEDUP_ENABLED and DIGEST_WINDOW_SECONDS >= DEDUP_LEASE_SECONDS:
+            logger.warning(
+                "DIGEST_WINDOW_SECONDS outlasts DEDUP_LEASE_SECONDS - held claims will expire"
+            )
 
-    logger.info("🔔 Notification handler is awake and listening...")
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    # docker stop - wind down the same way as Ctrl+C
+    signal.signal(signal.SIGTERM, stop)
 
-    # Start consuming messages
     try:
-        channel.start_consuming()
+        consume_lanes(connection)
     except KeyboardInterrupt:
-        channel.stop_consuming()
+        pass
+
+    # Don't leave anyone's digest sitting unacked
+    if digests.enabled:
+        flush_digests(digests.drain())
 
     connection.close()
+    registry.close()
 
 
 if __name__ == "__main__":
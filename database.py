@@ -1,10 +1,25 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ReturnDocument
+from pymongo.errors import (
+    BulkWriteError,
+    DuplicateKeyError,
+    OperationFailure,
+    PyMongoError,
+)
 import json
+import base64
 import datetime
+from collections import Counter, defaultdict
 import warnings
 import logging
 from bson.objectid import ObjectId
-from config import MONGODB_URI, MONGODB_DATABASE
+from cache import inbox_cache
+from config import (
+    MONGODB_URI,
+    MONGODB_DATABASE,
+    INGESTION_MODE,
+    EXPORT_BATCH_SIZE,
+    DEDUP_LEASE_SECONDS,
+)
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -16,27 +31,324 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 client = MongoClient(MONGODB_URI)
 db = client[MONGODB_DATABASE]
 notifications_collection = db["notifications"]
+# Per-user counts by status and type, kept up to date on every write
+counters_collection = db["notification_counters"]
+# Registered notification templates, keyed by template id
+templates_collection = db["notification_templates"]
+# Fan-out jobs (one request, many users) and the stored audiences they can target
+fanout_jobs_collection = db["fanout_jobs"]
+segment_members_collection = db["segment_members"]
 
+# In write-behind mode a status update can beat the record itself to Mongo,
+# so status writes upsert and the persister fills in the rest later
+STATUS_UPSERT = INGESTION_MODE == "write_behind"
 
-def init_db():
+
+# The indexes our hot queries need. init_db creates whatever is missing.
+NOTIFICATION_INDEXES = [
+    {
+        # Inbox pages: filter on user, sort newest first, tie-break on _id
+        "name": "user_inbox",
+        "keys": [("user_id", 1), ("created_at", -1), ("_id", -1)],
+    },
+    {
+        # Inbox pages filtered by status (?status=failed)
+        "name": "user_inbox_by_status",
+        "keys": [("user_id", 1), ("status", 1), ("created_at", -1), ("_id", -1)],
+    },
+    {
+        # Sweepers looking for stuck pending notifications - only indexes
+        # the (small) pending set, not the whole history
+        "name": "pending_by_age",
+        "keys": [("status", 1), ("created_at", 1)],
+        "partialFilterExpression": {"status": "pending"},
+    },
+    {
+        # The scheduler's "what's due soon" query - only scheduled
+        # notifications are in it, and they leave once they're published
+        "name": "scheduled_due",
+        "keys": [("due_at", 1)],
+        "partialFilterExpression": {"status": "scheduled"},
+    },
+    {
+        # One notification per user per fan-out job, so re-running a chunk
+        # after a crash can't create duplicates
+        "name": "fanout_recipient",
+        "keys": [("fanout_job_id", 1), ("user_id", 1)],
+        "unique": True,
+        "partialFilterExpression": {"fanout_job_id": {"$exists": True}},
+    },
+]
+
+SEGMENT_MEMBER_INDEXES = [
+    {
+        # Walking a segment in user_id order, a chunk at a time
+        "name": "segment_member",
+        "keys": [("segment_id", 1), ("user_id", 1)],
+        "unique": True,
+    },
+]
+
+# Mongo error codes for "an index like that already exists, but different"
+INDEX_CONFLICT_CODES = (85, 86)
+DUPLICATE_KEY_CODE = 11000
+
+
+def init_db(check_coverage=False):
+    """
+    Get the database ready for traffic
+
+    MongoDB creates collections on the fly, but it won't invent the
+    compound indexes our queries need - so we make sure they exist. Run it
+    once per deploy (init_indexes.py), not in every API worker. With
+    check_coverage the hot queries are explained too, to check they actually
+    use them - that's for CI.
+
+    Returns the names of the hot queries no index serves (always empty
+    without check_coverage). Raises PyMongoError if Mongo isn't having it.
+    """
+    ensure_indexes()
+    ensure_indexes(segment_members_collection, SEGMENT_MEMBER_INDEXES)
+    if not check_coverage:
+        return []
+
+    uncovered = []
+    for query_name, report in check_query_coverage().items():
+        if not report["covered"]:
+            logger.warning(f"Query '{query_name}' is not covered by an index: {report}")
+            uncovered.append(query_name)
+    return uncovered
+
+
+def ensure_indexes(collection=None, indexes=NOTIFICATION_INDEXES):
+    """
+    Create any missing indexes from `indexes` (NOTIFICATION_INDEXES by
+    default) and verify them
+
+    An existing index with the same name but a different definition is
+    dropped and rebuilt. Returns the names of the indexes that are in place.
+    """
+    collection = collection if collection is not None else notifications_collection
+
+    for spec in indexes:
+        options = {key: value for key, value in spec.items() if key != "keys"}
+        try:
+            collection.create_index(spec["keys"], **options)
+        except OperationFailure as e:
+            if e.code not in INDEX_CONFLICT_CODES:
+                raise
+            logger.warning(f"Rebuilding index {spec['name']}: {str(e)}")
+            collection.drop_index(spec["name"])
+            collection.create_index(spec["keys"], **options)
+
+    existing = collection.index_information()
+    verified = []
+    for spec in indexes:
+        index = existing.get(spec["name"])
+        if index is None or [tuple(key) for key in index["key"]] != spec["keys"]:
+            raise PyMongoError(f"Index {spec['name']} is missing or has the wrong keys")
+        verified.append(spec["name"])
+    return verified
+
+
+def summarize_plan(explain):
+    """
+    Boil an explain() result down to what we care about
+
+    Returns:
+        dict: indexes used, whether there was a collection scan or an
+        in-memory sort, and "covered" if neither happened
+    """
+    planner = explain["queryPlanner"]
+    winning = planner["winningPlan"]
+    # Newer servers (slot-based engine) nest the classic plan one level down
+    winning = winning.get("queryPlan", winning)
+
+    stages = []
+    indexes = []
+    todo = [winning]
+    while todo:
+        stage = todo.pop()
+        stages.append(stage.get("stage"))
+        if stage.get("indexName"):
+            indexes.append(stage["indexName"])
+        if "inputStage" in stage:
+            todo.append(stage["inputStage"])
+        todo.extend(stage.get("inputStages", []))
+
+    collection_scan = "COLLSCAN" in stages
+    in_memory_sort = "SORT" in stages
+    return {
+        "indexes": indexes,
+        "collection_scan": collection_scan,
+        "in_memory_sort": in_memory_sort,
+        "covered": bool(indexes) and not collection_scan and not in_memory_sort,
+    }
+
+
+def check_query_coverage(collection=None):
+    """
+    Explain the hot queries and report whether indexes serve them
+
+    The sample values don't matter - the planner picks the same plan shape
+    for any user
+    """
+    collection = collection if collection is not None else notifications_collection
+    inbox_sort = [("created_at", -1), ("_id", -1)]
+
+    hot_queries = {
+        "inbox": collection.find({"user_id": 0}).sort(inbox_sort).limit(51),
+        "inbox_by_status": collection.find({"user_id": 0, "status": "failed"})
+        .sort(inbox_sort)
+        .limit(51),
+        "pending_sweep": collection.find(
+            {"status": "pending", "created_at": {"$lt": datetime.datetime.now()}}
+        )
+        .sort("created_at", 1)
+        .limit(100),
+        "scheduler_due": collection.find(
+            {"status": "scheduled", "due_at": {"$lt": datetime.datetime.now()}}
+        )
+        .sort("due_at", 1)
+        .limit(100),
+    }
+    return {name: summarize_plan(cursor.explain()) for name, cursor in hot_queries.items()}
+
+
+def insert_deltas(documents):
+    """Counter changes for freshly inserted notifications"""
+    deltas = defaultdict(Counter)
+    for document in documents:
+        deltas[document["user_id"]][f"status.{counted_status(document['status'])}"] += 1
+        deltas[document["user_id"]][f"type.{document['type']}"] += 1
+    return deltas
+
+
+def counted_status(status):
+    """
+    The status a notification is counted under
+
+    "sending" is just a pending notification someone is working on right
+    now, and "scheduled" one that isn't due yet - so badge counts don't
+    flicker, and claims and the scheduler's hand-off cost no counter writes
+    """
+    return "pending" if status in ("sending", "scheduled") else status
+
+
+def status_change_deltas(before_documents, new_statuses):
+    """
+    Counter changes for status updates
+
+    Args:
+        before_documents (list): documents as they were (need _id, user_id, status)
+        new_statuses (dict): ObjectId -> new status
+    """
+    deltas = defaultdict(Counter)
+    for document in before_documents:
+        old_status = counted_status(document.get("status"))
+        new_status = counted_status(new_statuses.get(document["_id"]))
+        if "user_id" not in document or new_status is None or new_status == old_status:
+            continue
+        if old_status:
+            deltas[document["user_id"]][f"status.{old_status}"] -= 1
+        deltas[document["user_id"]][f"status.{new_status}"] += 1
+    return deltas
+
+
+def counter_operations(deltas):
+    """Turn counter deltas into one $inc upsert per user"""
+    now = datetime.datetime.now()
+    return [
+        UpdateOne(
+            {"_id": user_id},
+            {"$inc": dict(changes), "$set": {"updated_at": now}},
+            upsert=True,
+        )
+        for user_id, changes in deltas.items()
+        if any(changes.values())
+    ]
+
+
+def apply_counter_deltas(deltas):
+    operations = counter_operations(deltas)
+    if operations:
+        counters_collection.bulk_write(operations, ordered=False)
+
+
+def content_fields(notification):
+    """
+    What a notification says: its content, or its template and variables
+
+    Templated notifications are stored and queued without the rendered
+    text - the consumer renders it just before sending
     """
-    Nothing to do here - MongoDB is cool like that
+    if notification.get("content") or not notification.get("template_id"):
+        return {"content": notification.get("content")}
+    return {
+        "template_id": notification["template_id"],
+        "variables": notification.get("variables") or {},
+    }
+
+
+def template_fields(notification):
+    """save_notification's template_id/variables arguments, for templated notifications"""
+    if not notification.get("template_id"):
+        return {}
+    return {
+        "template_id": notification["template_id"],
+        "variables": notification.get("variables"),
+    }
+
+
+def tenant_fields(notification):
+    """
+    {"tenant_id": ...} for a notification sent on a tenant's behalf, else {}
+
+    Goes on the record and in every queue message, so the consumer can give
+    each tenant its own rate-limit bucket
+    """
+    tenant_id = notification.get("tenant_id")
+    return {} if tenant_id is None else {"tenant_id": tenant_id}
 
-    No need for complicated setup steps, tables, or schemas
-    MongoDB just creates stuff on the fly
+
+def schedule_fields(send_at=None, priority=None):
+    """
+    The status a new notification starts in, plus its schedule if it has one
+
+    Scheduled notifications wait in Mongo until scheduler.py publishes them,
+    so they keep their priority lane with them. due_at is when the scheduler
+    should next look at one (its claims push it forward).
     """
-    # MongoDB is lazy (in a good way)
-    pass
+    if send_at is None:
+        return {"status": "pending"}
+    fields = {"status": "scheduled", "send_at": send_at, "due_at": send_at}
+    if priority:
+        fields["priority"] = priority
+    return fields
 
 
-def save_notification(user_id, notification_type, content):
+def save_notification(
+    user_id,
+    notification_type,
+    content,
+    template_id=None,
+    variables=None,
+    send_at=None,
+    priority=None,
+    tenant_id=None,
+):
     """
     Store a notification in MongoDB
 
     Args:
         user_id (int): ID of the user receiving the notification
         notification_type (str): Type of notification (email, sms, in-app)
-        content (str): Content of the notification
+        content (str): Content of the notification (None when templated)
+        template_id (str): Template to render the content from instead
+        variables (dict): Values for the template
+        send_at (datetime): Send it then instead of now
+        priority (str): Lane to publish a scheduled notification to
+        tenant_id (str): Tenant it's sent on behalf of, if any
 
     Returns:
         str: ID of the inserted notification
@@ -44,28 +356,881 @@ def save_notification(user_id, notification_type, content):
     notification = {
         "user_id": user_id,
         "type": notification_type,
-        "content": content,
-        "status": "pending",
+        **content_fields(
+            {"content": content, "template_id": template_id, "variables": variables}
+        ),
+        **tenant_fields({"tenant_id": tenant_id}),
+        **schedule_fields(send_at, priority),
         "created_at": datetime.datetime.now(),
     }
 
     result = notifications_collection.insert_one(notification)
+    apply_counter_deltas(insert_deltas([notification]))
+    inbox_cache.invalidate(user_id)
     return str(result.inserted_id)
 
 
-def update_notification_status(notification_id, status):
+def save_notifications(notifications):
+    """
+    Store a whole batch of notifications with a single insert_many
+
+    Args:
+        notifications (list): dicts with user_id, type and content (or
+        template_id and variables), and optionally send_at (a datetime),
+        priority and tenant_id
+
+    Returns:
+        list: one (notification_id, error) pair per input, in the same order.
+        The insert is unordered, so one bad document doesn't stop the rest.
+    """
+    now = datetime.datetime.now()
+    documents = [
+        {
+            "_id": ObjectId(),
+            "user_id": notification["user_id"],
+            "type": notification["type"],
+            **content_fields(notification),
+            **tenant_fields(notification),
+            **schedule_fields(notification.get("send_at"), notification.get("priority")),
+            "created_at": now,
+        }
+        for notification in notifications
+    ]
+    if not documents:
+        return []
+
+    failed = {}
+    try:
+        notifications_collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        for write_error in e.details.get("writeErrors", []):
+            failed[write_error["index"]] = write_error.get("errmsg", "write failed")
+    finally:
+        inbox_cache.invalidate(*(document["user_id"] for document in documents))
+
+    apply_counter_deltas(
+        insert_deltas(
+            document
+            for index, document in enumerate(documents)
+            if index not in failed
+        )
+    )
+    return [
+        (None, failed[index]) if index in failed else (str(document["_id"]), None)
+        for index, document in enumerate(documents)
+    ]
+
+
+def new_notification_document(
+    user_id, notification_type, content, template_id=None, variables=None, tenant_id=None
+):
+    """
+    Build a pending notification with its ObjectId picked on our side
+
+    Used by write-behind ingestion, where the id goes out to the client and
+    the queue before the record reaches Mongo
+    """
+    return {
+        "_id": ObjectId(),
+        "user_id": user_id,
+        "type": notification_type,
+        **content_fields(
+            {"content": content, "template_id": template_id, "variables": variables}
+        ),
+        **tenant_fields({"tenant_id": tenant_id}),
+        "status": "pending",
+        "created_at": datetime.datetime.now(),
+    }
+
+
+def message_to_document(notification_data):
+    """
+    Rebuild the Mongo record from a write-behind message
+
+    Messages without created_at were saved by the API already (the batch
+    endpoint still inserts up front), so there's nothing to persist
+    """
+    if not notification_data.get("created_at"):
+        return None
+
+    return {
+        "_id": ObjectId(notification_data["id"]),
+        "user_id": notification_data["user_id"],
+        "type": notification_data["type"],
+        **content_fields(notification_data),
+        **tenant_fields(notification_data),
+        "status": "pending",
+        "created_at": datetime.datetime.fromisoformat(notification_data["created_at"]),
+    }
+
+
+def upsert_fields(notification_data):
+    """
+    The rest of a write-behind record, for a status or claim upsert
+
+    The consumer can get to a record before the persister does. Its upsert
+    then writes the whole record ($setOnInsert, all but the status it's
+    setting anyway), so it's counted right there and the persister's own
+    upsert just finds it. Empty outside write-behind mode, without the
+    message, or for messages the API saved itself.
+    """
+    if not STATUS_UPSERT or not notification_data:
+        return {}
+    document = message_to_document(notification_data)
+    if document is None:
+        return {}
+    return {key: value for key, value in document.items() if key not in ("_id", "status")}
+
+
+def status_update(status, inserting=None):
+    update = {"$set": {"status": status}}
+    if inserting:
+        update["$setOnInsert"] = inserting
+    return update
+
+
+def persist_notifications(documents):
+    """
+    Write-behind persistence: upsert a batch of records keyed on _id
+
+    Safe to run twice for the same record. Status is only set on insert, so
+    if the consumer already marked a notification delivered we don't drag it
+    back to pending.
+
+    Raises BulkWriteError if Mongo refused some of the records. The rest
+    are written (and counted) by then - its details say which ones failed.
+    """
+    if not documents:
+        return
+
+    operations = [
+        UpdateOne(
+            {"_id": document["_id"]},
+            {
+                "$set": {
+                    "user_id": document["user_id"],
+                    "type": document["type"],
+                    **content_fields(document),
+                    **tenant_fields(document),
+                    "created_at": document["created_at"],
+                },
+                "$setOnInsert": {"status": document.get("status", "pending")},
+            },
+            upsert=True,
+        )
+        for document in documents
+    ]
+    error = None
+    try:
+        upserted = notifications_collection.bulk_write(operations, ordered=False).upserted_ids
+    except BulkWriteError as e:
+        # Unordered, so everything but the writeErrors went in regardless
+        upserted = {entry["index"]: entry["_id"] for entry in e.details.get("upserted", [])}
+        error = e
+
+    # Only count the ones that were actually new (upserted_ids is keyed by
+    # position). A status or claim upsert that beat us here wrote and
+    # counted the whole record already - see upsert_fields.
+    apply_counter_deltas(insert_deltas(documents[index] for index in upserted))
+    inbox_cache.invalidate(*(document["user_id"] for document in documents))
+    if error is not None:
+        raise error
+
+
+def update_notification_status(notification_id, status, notification=None):
     """
     Mark a notification as delivered or failed
 
     Just needs:
     - which notification (by ID)
     - what happened to it (status)
+
+    In write-behind mode pass the queue message as `notification` too, in
+    case we get there before the persister (see upsert_fields)
+    """
+    object_id = ObjectId(notification_id)
+    inserting = upsert_fields(notification)
+    try:
+        # Hands back the old document so we can move the counters and know
+        # whose cached inbox just went stale
+        before = notifications_collection.find_one_and_update(
+            {"_id": object_id},
+            status_update(status, inserting),
+            projection={"user_id": 1, "status": 1},
+            upsert=STATUS_UPSERT,
+            return_document=ReturnDocument.BEFORE,
+        )
+    except DuplicateKeyError:
+        # The persister inserted it between our lookup and our insert -
+        # it's there now, so a plain update does it
+        before = notifications_collection.find_one_and_update(
+            {"_id": object_id},
+            status_update(status),
+            projection={"user_id": 1, "status": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+    if before is None and inserting:
+        # Nothing there, so the upsert just created the whole record
+        apply_counter_deltas(insert_deltas([{**inserting, "status": status}]))
+        inbox_cache.invalidate(inserting["user_id"])
+    elif before and "user_id" in before:
+        apply_counter_deltas(status_change_deltas([before], {before["_id"]: status}))
+        inbox_cache.invalidate(before["user_id"])
+
+
+def update_notification_statuses(statuses, notifications=None):
+    """
+    Write a whole batch of status changes in one round-trip
+
+    Args:
+        statuses (dict): notification_id -> new status
+        notifications (dict): notification_id -> queue message, for
+            write-behind mode (see update_notification_status)
     """
-    notifications_collection.update_one(
-        {"_id": ObjectId(notification_id)}, {"$set": {"status": status}}
+    if not statuses:
+        return
+
+    notifications = notifications or {}
+    ids = [ObjectId(notification_id) for notification_id in statuses]
+    new_statuses = dict(zip(ids, statuses.values()))
+    inserting = [upsert_fields(notifications.get(notification_id)) for notification_id in statuses]
+    # Where things stand now, for the counters (a race here is what the
+    # reconciliation job is for)
+    before = list(
+        notifications_collection.find(
+            {"_id": {"$in": ids}}, {"user_id": 1, "status": 1}
+        )
+    )
+    try:
+        upserted = notifications_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": object_id},
+                    status_update(new_statuses[object_id], fields),
+                    upsert=STATUS_UPSERT,
+                )
+                for object_id, fields in zip(ids, inserting)
+            ],
+            ordered=False,
+        ).upserted_ids
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != DUPLICATE_KEY_CODE for error in errors):
+            raise
+        upserted = {entry["index"]: entry["_id"] for entry in e.details.get("upserted", [])}
+        # Upserts that raced the persister - they're there now, so plain
+        # updates do it
+        raced = [ids[error["index"]] for error in errors]
+        before.extend(
+            notifications_collection.find(
+                {"_id": {"$in": raced}}, {"user_id": 1, "status": 1}
+            )
+        )
+        notifications_collection.bulk_write(
+            [
+                UpdateOne({"_id": object_id}, status_update(new_statuses[object_id]))
+                for object_id in raced
+            ],
+            ordered=False,
+        )
+
+    # Records the upserts created whole are new, not status changes
+    created = [
+        {**inserting[index], "status": new_statuses[ids[index]]}
+        for index in upserted
+        if inserting[index]
+    ]
+    deltas = status_change_deltas(before, new_statuses)
+    for user_id, changes in insert_deltas(created).items():
+        deltas[user_id].update(changes)
+    apply_counter_deltas(deltas)
+    inbox_cache.invalidate(
+        *(document["user_id"] for document in before + created)
     )
 
 
+def claimable_filter(now):
+    """Pending, or stuck in sending by someone whose lease has run out"""
+    return {
+        "$or": [
+            {"status": "pending"},
+            {"status": "sending", "lease_until": {"$lt": now}},
+        ]
+    }
+
+
+def claim_update(now, token, lease_seconds, inserting=None):
+    update = status_update("sending", inserting)
+    update["$set"].update(
+        {"lease_until": now + datetime.timedelta(seconds=lease_seconds), "claim": token}
+    )
+    return update
+
+
+def claim_state(document, token):
+    """What an unclaimed notification's current document says about it"""
+    if document is None or document.get("claim") == token:
+        # Nothing stored to guard (or we got it after all) - go ahead
+        return "claimed"
+    if document.get("status") in ("sending", "scheduled"):
+        # "scheduled" is a message the scheduler published but hasn't
+        # marked yet - it'll be claimable in a moment, so don't drop it
+        return "in_flight"
+    return "duplicate"
+
+
+def claim_notification(notification_id, lease_seconds=DEDUP_LEASE_SECONDS, notification=None):
+    """
+    Atomically move a notification from pending to sending before sending it
+
+    Returns:
+        str: "claimed" (go ahead and send), "duplicate" (it already has a
+        final status - just ack it) or "in_flight" (another consumer holds
+        a live lease on it - try again later)
+
+    A consumer that dies mid-send leaves its lease behind, and the
+    notification becomes claimable again once the lease runs out. Pass the
+    queue message as `notification` in write-behind mode (see
+    update_notification_status).
+    """
+    now = datetime.datetime.now()
+    token = ObjectId()
+    object_id = ObjectId(notification_id)
+    inserting = upsert_fields(notification)
+    try:
+        # With write-behind the record may not be there yet - the upsert
+        # creates it, and a duplicate key means it's there but not claimable
+        result = notifications_collection.update_one(
+            {"_id": object_id, **claimable_filter(now)},
+            claim_update(now, token, lease_seconds, inserting),
+            upsert=STATUS_UPSERT,
+        )
+        if result.upserted_id is not None:
+            count_claim_inserts([inserting])
+            return "claimed"
+        if result.matched_count:
+            return "claimed"
+    except DuplicateKeyError:
+        pass
+
+    return claim_state(
+        notifications_collection.find_one(
+            {"_id": object_id}, {"status": 1, "claim": 1}
+        ),
+        token,
+    )
+
+
+def claim_notifications(
+    notification_ids, lease_seconds=DEDUP_LEASE_SECONDS, notifications=None
+):
+    """
+    claim_notification for a whole batch in two round trips
+
+    Every claim in the batch carries the same token, so one find afterwards
+    tells us which ones we actually got. `notifications` maps ids to queue
+    messages in write-behind mode.
+
+    Returns:
+        dict: notification id -> "claimed", "duplicate" or "in_flight"
+    """
+    if not notification_ids:
+        return {}
+
+    notifications = notifications or {}
+    now = datetime.datetime.now()
+    token = ObjectId()
+    ids = [ObjectId(notification_id) for notification_id in notification_ids]
+    inserting = [
+        upsert_fields(notifications.get(notification_id))
+        for notification_id in notification_ids
+    ]
+    try:
+        upserted = notifications_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": object_id, **claimable_filter(now)},
+                    claim_update(now, token, lease_seconds, fields),
+                    upsert=STATUS_UPSERT,
+                )
+                for object_id, fields in zip(ids, inserting)
+            ],
+            ordered=False,
+        ).upserted_ids
+    except BulkWriteError as e:
+        # Duplicate keys are upserts that found an unclaimable record -
+        # anything else is a real problem
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != DUPLICATE_KEY_CODE for error in errors):
+            raise
+        upserted = {entry["index"]: entry["_id"] for entry in e.details.get("upserted", [])}
+    count_claim_inserts(inserting[index] for index in upserted)
+
+    documents = {
+        document["_id"]: document
+        for document in notifications_collection.find(
+            {"_id": {"$in": ids}}, {"status": 1, "claim": 1}
+        )
+    }
+    return {
+        str(object_id): claim_state(documents.get(object_id), token) for object_id in ids
+    }
+
+
+def count_claim_inserts(inserted):
+    """Count the records claim upserts created whole (a claim is still pending)"""
+    created = [{**fields, "status": "sending"} for fields in inserted if fields]
+    if created:
+        apply_counter_deltas(insert_deltas(created))
+        inbox_cache.invalidate(*(document["user_id"] for document in created))
+
+
+def release_notifications(notification_ids):
+    """
+    Hand claims back (sending -> pending) after a send blew up
+
+    So the retry can claim it straight away instead of waiting out the lease
+    """
+    if not notification_ids:
+        return
+    notifications_collection.update_many(
+        {
+            "_id": {
+                "$in": [ObjectId(notification_id) for notification_id in notification_ids]
+            },
+            "status": "sending",
+        },
+        {"$set": {"status": "pending"}, "$unset": {"lease_until": "", "claim": ""}},
+    )
+
+
+def save_template(template_id, content):
+    """
+    Register a template, or replace the one with this id
+
+    Returns:
+        int: the template's version, bumped on every save. Consumers pick
+        up a new version once their cached copy expires.
+    """
+    template = templates_collection.find_one_and_update(
+        {"_id": template_id},
+        {
+            "$set": {"content": content, "updated_at": datetime.datetime.now()},
+            "$inc": {"version": 1},
+        },
+        projection={"version": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return template["version"]
+
+
+def get_template(template_id):
+    """A template document (content, version, updated_at), or None"""
+    return templates_collection.find_one({"_id": template_id})
+
+
+def create_fanout_job(job):
+    """
+    Store a new fan-out job and return its id as a string
+
+    `job` has the message (type, content or template, priority) and the
+    audience: a sorted list of user_ids or a segment_id
+    """
+    now = datetime.datetime.now()
+    document = {
+        **job,
+        "status": "queued",
+        "expanded": 0,
+        "checkpoint": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+    return str(fanout_jobs_collection.insert_one(document).inserted_id)
+
+
+def get_fanout_job(job_id):
+    return fanout_jobs_collection.find_one({"_id": ObjectId(job_id)})
+
+
+def update_fanout_job(job_id, status=None, checkpoint=None, expanded=0, error=None):
+    """
+    Record a fan-out job's progress
+
+    `checkpoint` is the last user_id whose notification is saved and
+    published; an expansion that crashes picks up after it
+    """
+    update = {"$set": {"updated_at": datetime.datetime.now()}}
+    if status is not None:
+        update["$set"]["status"] = status
+    if checkpoint is not None:
+        update["$set"]["checkpoint"] = checkpoint
+    if error is not None:
+        update["$set"]["error"] = error
+    if expanded:
+        update["$inc"] = {"expanded": expanded}
+    fanout_jobs_collection.update_one({"_id": ObjectId(job_id)}, update)
+
+
+def add_segment_members(segment_id, user_ids):
+    """Add users to a segment (already-there ones are left alone) - returns how many were new"""
+    if not user_ids:
+        return 0
+    result = segment_members_collection.bulk_write(
+        [
+            UpdateOne(
+                {"segment_id": segment_id, "user_id": user_id},
+                {"$setOnInsert": {"added_at": datetime.datetime.now()}},
+                upsert=True,
+            )
+            for user_id in user_ids
+        ],
+        ordered=False,
+    )
+    return result.upserted_count
+
+
+def count_segment_members(segment_id):
+    return segment_members_collection.count_documents({"segment_id": segment_id})
+
+
+def get_segment_members(segment_id, after=None, limit=1000):
+    """The next `limit` user ids of a segment after `after`, in order (keyset paging)"""
+    query = {"segment_id": segment_id}
+    if after is not None:
+        query["user_id"] = {"$gt": after}
+    cursor = segment_members_collection.find(
+        query, {"user_id": 1, "_id": 0}, sort=[("user_id", 1)], limit=limit
+    )
+    return [document["user_id"] for document in cursor]
+
+
+def save_fanout_notifications(job, user_ids):
+    """
+    Create one pending notification per user for a fan-out job
+
+    Upserts keyed on (fanout_job_id, user_id), so running the same chunk
+    twice - after a crash, say - finds the notifications from the first
+    time instead of making new ones
+
+    Returns:
+        list: (notification_id, user_id) pairs, in user_ids order
+    """
+    if not user_ids:
+        return []
+
+    now = datetime.datetime.now()
+    fields = {
+        "type": job["type"],
+        **content_fields(job),
+        **tenant_fields(job),
+        "status": "pending",
+        "created_at": now,
+    }
+    result = notifications_collection.bulk_write(
+        [
+            UpdateOne(
+                {"fanout_job_id": job["_id"], "user_id": user_id},
+                {"$setOnInsert": fields},
+                upsert=True,
+            )
+            for user_id in user_ids
+        ],
+        ordered=False,
+    )
+
+    ids = {user_ids[index]: object_id for index, object_id in result.upserted_ids.items()}
+    if len(ids) < len(user_ids):
+        # Saved on an earlier run - look their ids up
+        for document in notifications_collection.find(
+            {"fanout_job_id": job["_id"], "user_id": {"$in": user_ids}},
+            {"_id": 1, "user_id": 1},
+        ):
+            ids.setdefault(document["user_id"], document["_id"])
+
+    apply_counter_deltas(
+        insert_deltas({"user_id": user_ids[index], **fields} for index in result.upserted_ids)
+    )
+    inbox_cache.invalidate(*user_ids)
+    return [(str(ids[user_id]), user_id) for user_id in user_ids]
+
+
+def claim_due_notifications(horizon, lease_until, limit):
+    """
+    Claim up to `limit` scheduled notifications due before `horizon`
+
+    Claiming pushes due_at out to `lease_until`, which takes them out of
+    every scheduler's window. If we die holding them, they come back into
+    view once that passes.
+
+    Returns:
+        tuple: (claimed documents in due order, the claim token)
+    """
+    token = ObjectId()
+    due = {"status": "scheduled", "due_at": {"$lt": horizon}}
+    documents = list(
+        notifications_collection.find(due, sort=[("due_at", 1)], limit=limit)
+    )
+    if not documents:
+        return [], token
+
+    ids = [document["_id"] for document in documents]
+    notifications_collection.update_many(
+        {"_id": {"$in": ids}, **due},
+        {"$set": {"due_at": lease_until, "schedule_claim": token}},
+    )
+    # Another scheduler may have got some of them first
+    claimed = {
+        document["_id"]
+        for document in notifications_collection.find(
+            {"_id": {"$in": ids}, "schedule_claim": token}, {"_id": 1}
+        )
+    }
+    return [document for document in documents if document["_id"] in claimed], token
+
+
+def mark_scheduled_published(documents, token):
+    """
+    Scheduled notifications went out - they're ordinary pending ones now
+
+    Only touches ones still scheduled under our claim: a fast consumer may
+    already have marked them delivered. Counts don't change (scheduled is
+    counted as pending).
+    """
+    if not documents:
+        return
+    notifications_collection.update_many(
+        {
+            "_id": {"$in": [document["_id"] for document in documents]},
+            "status": "scheduled",
+            "schedule_claim": token,
+        },
+        {"$set": {"status": "pending"}, "$unset": {"due_at": "", "schedule_claim": ""}},
+    )
+    inbox_cache.invalidate(*(document["user_id"] for document in documents))
+
+
+def release_scheduled_notifications(notification_ids, token):
+    """Hand claims back (scheduler shutting down) so another scheduler can load them now"""
+    if not notification_ids:
+        return
+    notifications_collection.update_many(
+        {
+            "_id": {"$in": list(notification_ids)},
+            "status": "scheduled",
+            "schedule_claim": token,
+        },
+        {"$set": {"due_at": datetime.datetime.now()}, "$unset": {"schedule_claim": ""}},
+    )
+
+
+def summarize_counters(counters):
+    """
+    Turn a notification_counters document into the summary the API returns
+
+    Returns:
+        dict: total plus counts by status and by type
+    """
+    counters = counters or {}
+    # Drift can briefly push a counter below zero - nobody wants a -1 badge
+    by_status = {key: max(0, value) for key, value in counters.get("status", {}).items()}
+    by_type = {key: max(0, value) for key, value in counters.get("type", {}).items()}
+    return {
+        "total": sum(by_type.values()),
+        "by_status": by_status,
+        "by_type": by_type,
+    }
+
+
+def get_notification_summary(user_id):
+    """Badge counts for a user, straight from the precomputed counters"""
+    return summarize_counters(counters_collection.find_one({"_id": user_id}))
+
+
+def reconcile_notification_counters(user_ids=None):
+    """
+    Rebuild counters from the notifications themselves
+
+    Fixes any drift from crashes or races between a write and its counter
+    update. Pass user_ids to fix just a few users, or nothing to sweep
+    everyone. Returns how many users were rewritten.
+    """
+    match = {"user_id": {"$in": list(user_ids)}} if user_ids else {}
+    pipeline = [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": {"user_id": "$user_id", "status": "$status", "type": "$type"},
+                "count": {"$sum": 1},
+            }
+        },
+    ]
+
+    actual = defaultdict(lambda: {"status": Counter(), "type": Counter()})
+    for row in notifications_collection.aggregate(pipeline, allowDiskUse=True):
+        key = row["_id"]
+        if key.get("status"):
+            status = counted_status(key["status"])
+            actual[key["user_id"]]["status"][status] += row["count"]
+        if key.get("type"):
+            actual[key["user_id"]]["type"][key["type"]] += row["count"]
+
+    # Users we were asked about who have no notifications at all get zeroed
+    for user_id in user_ids or ():
+        actual.setdefault(user_id, {"status": Counter(), "type": Counter()})
+
+    now = datetime.datetime.now()
+    operations = [
+        UpdateOne(
+            {"_id": user_id},
+            {
+                "$set": {
+                    "status": dict(counts["status"]),
+                    "type": dict(counts["type"]),
+                    "updated_at": now,
+                }
+            },
+            upsert=True,
+        )
+        for user_id, counts in actual.items()
+    ]
+    if operations:
+        counters_collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def serialize_notification(doc):
+    """
+    Turn a Mongo document into the shape the API hands out
+
+    Fields left out by a projection are just left out here too
+    """
+    notification = {"id": str(doc["_id"])}
+    for field in ("type", "content", "template_id", "variables", "status"):
+        if field in doc:
+            notification[field] = doc[field]
+    for field in ("created_at", "send_at"):
+        if field in doc:
+            notification[field] = doc[field].isoformat()
+    return notification
+
+
+def encode_cursor(doc):
+    """An opaque page token pointing at a notification (created_at + _id)"""
+    raw = f"{doc['created_at'].isoformat()}|{doc['_id']}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Back to (created_at, ObjectId) - raises ValueError for junk tokens"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        created_at, notification_id = raw.split("|")
+        return datetime.datetime.fromisoformat(created_at), ObjectId(notification_id)
+    except Exception:
+        raise ValueError("invalid cursor")
+
+
+def build_inbox_query(
+    user_id, limit, before=None, after=None, status=None, notification_type=None, fields=None
+):
+    """
+    The find() arguments for one page of a user's inbox
+
+    Keyset pagination on (created_at, _id), newest first. `before` walks to
+    older notifications, `after` to newer ones. Asks for one extra document
+    so we know whether there's another page.
+
+    Returns:
+        dict: filter, projection, sort and limit for find()
+    """
+    query = {"user_id": user_id}
+    if status:
+        query["status"] = status
+    if notification_type:
+        query["type"] = notification_type
+
+    direction = -1
+    if before or after:
+        created_at, notification_id = decode_cursor(before or after)
+        op = "$lt" if before else "$gt"
+        direction = -1 if before else 1
+        query["$or"] = [
+            {"created_at": {op: created_at}},
+            {"created_at": created_at, "_id": {op: notification_id}},
+        ]
+
+    projection = None
+    if fields:
+        # created_at is needed for the cursor even if nobody asked for it
+        projection = {field: 1 for field in fields}
+        projection["created_at"] = 1
+
+    return {
+        "filter": query,
+        "projection": projection,
+        "sort": [("created_at", direction), ("_id", direction)],
+        "limit": limit + 1,
+    }
+
+
+def build_inbox_page(docs, limit, after=None, fields=None):
+    """
+    Turn the raw documents for a page into the API response
+
+    Returns:
+        dict: notifications plus next_cursor (older, use with ?before=) and
+        prev_cursor (newer, use with ?after=)
+    """
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    if after:
+        # We walked forwards in time - put it back to newest first
+        docs.reverse()
+
+    notifications = [serialize_notification(doc) for doc in docs]
+    if fields:
+        keep = set(fields) | {"id"}
+        notifications = [
+            {key: value for key, value in notification.items() if key in keep}
+            for notification in notifications
+        ]
+
+    next_cursor = None
+    if docs and (has_more or after):
+        next_cursor = encode_cursor(docs[-1])
+
+    return {
+        "notifications": notifications,
+        "next_cursor": next_cursor,
+        "prev_cursor": encode_cursor(docs[0]) if docs else after,
+    }
+
+
+def get_user_notifications_page(user_id, limit, **options):
+    """
+    One page of someone's notifications
+
+    Options: before/after cursors, status, notification_type and fields
+    (the projection) - see build_inbox_query. Pages are served from the
+    inbox cache when we have them; writes for the user invalidate it.
+    """
+    page_key = inbox_cache.page_key(limit, options)
+    page = inbox_cache.get(user_id, page_key)
+    if page is not None:
+        return page
+
+    query = build_inbox_query(user_id, limit, **options)
+    cursor = notifications_collection.find(
+        query["filter"], query["projection"], sort=query["sort"], limit=query["limit"]
+    )
+    page = build_inbox_page(
+        list(cursor), limit, after=options.get("after"), fields=options.get("fields")
+    )
+    inbox_cache.set(user_id, page_key, page)
+    return page
+
+
 def get_user_notifications(user_id):
     """
     Pull up all the notifications for someone
@@ -74,16 +1239,37 @@ def get_user_notifications(user_id):
     they've been sent, newest first
     """
     cursor = notifications_collection.find({"user_id": user_id}).sort("created_at", -1)
-    notifications = []
-
-    for doc in cursor:
-        notification = {
-            "id": str(doc["_id"]),
-            "type": doc["type"],
-            "content": doc["content"],
-            "status": doc["status"],
-            "created_at": doc["created_at"].isoformat(),
-        }
-        notifications.append(notification)
+    return [serialize_notification(doc) for doc in cursor]
+
+
+def build_export_filter(user_id, start=None, end=None):
+    """Query for a user's history, optionally limited to [start, end)"""
+    query = {"user_id": user_id}
+    if start is not None or end is not None:
+        query["created_at"] = {}
+        if start is not None:
+            query["created_at"]["$gte"] = start
+        if end is not None:
+            query["created_at"]["$lt"] = end
+    return query
+
 
-    return notifications
+def iter_user_notifications(user_id, start=None, end=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Walk someone's whole history, oldest first, one document at a time
+
+    Unlike get_user_notifications nothing is collected into a list - the
+    cursor pulls `batch_size` documents per round trip and we hand them out
+    as we go, so memory stays flat for users with millions of notifications
+    """
+    cursor = (
+        notifications_collection.find(build_export_filter(user_id, start, end))
+        .sort([("created_at", 1), ("_id", 1)])
+        .batch_size(batch_size)
+    )
+    try:
+        for doc in cursor:
+            yield serialize_notification(doc)
+    finally:
+        # Client went away mid-download - don't leave the cursor open on the server
+        cursor.close()
@@ -0,0 +1,70 @@
+"""Skip redelivered notifications that were already sent (or are being sent)."""
+
+import threading
+from collections import OrderedDict
+from prometheus_client import Counter
+from config import DEDUP_CACHE_SIZE
+
+DEDUP_SKIPPED = Counter(
+    "dedup_skipped_total",
+    "Deliveries skipped because the notification was already handled",
+    ["reason"],
+)
+
+
+class RecentIds:
+    """
+    An LRU set of notification ids this process finished recently
+
+    Redeliveries of those get acked without even asking Mongo. It's only a
+    shortcut - the claim in Mongo is what actually guarantees one send.
+    """
+
+    def __init__(self, max_size=DEDUP_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, notification_id):
+        with self._lock:
+            if notification_id not in self._ids:
+                return False
+            self._ids.move_to_end(notification_id)
+            return True
+
+    def add(self, *notification_ids):
+        with self._lock:
+            for notification_id in notification_ids:
+                self._ids[notification_id] = None
+                self._ids.move_to_end(notification_id)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+
+recently_completed = RecentIds()
+
+
+def seen_recently(notification_id):
+    """Did this process finish this notification lately? (no Mongo involved)"""
+    if notification_id in recently_completed:
+        DEDUP_SKIPPED.labels(reason="recent").inc()
+        return True
+    return False
+
+
+def note_claim(notification_id, state):
+    """
+    Record what a claim came back with, and pass it through
+
+    "duplicate" ids go into the recent set so the next redelivery doesn't
+    even need the claim
+    """
+    if state != "claimed":
+        DEDUP_SKIPPED.labels(reason=state).inc()
+    if state == "duplicate":
+        recently_completed.add(notification_id)
+    return state
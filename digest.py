@@ -0,0 +1,146 @@
+"""
+Digests: hold bursts of notifications per (user_id, type) and send them as one
+
+When an upstream system goes haywire and fires hundreds of notifications at
+one user, each one would be its own provider call (and its own charge).
+For the types in DIGEST_TYPES the consumer instead parks each notification
+here, unacked, for up to DIGEST_WINDOW_SECONDS. Whatever piled up for that
+user and type in the meantime goes out as a single message, and all of it
+gets its status in one bulk write.
+
+This module only keeps the buffers; consumer.py does the sending and acking.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from prometheus_client import Counter, Gauge
+from config import DIGEST_TYPES, DIGEST_WINDOW_SECONDS, DIGEST_MAX_ITEMS, DIGEST_MAX_BUFFERED
+
+DIGEST_DELIVERIES = Counter(
+    "digest_deliveries_total", "Digests sent, by why they went out", ["reason"]
+)
+DIGEST_COALESCED = Counter(
+    "digest_coalesced_notifications_total", "Notifications sent as part of a digest"
+)
+DIGEST_BUFFERED = Gauge(
+    "digest_buffered_notifications", "Notifications waiting in a digest buffer"
+)
+
+
+class DigestBuffer:
+    """The notifications waiting to go out together for one (user_id, type)"""
+
+    def __init__(self, key, deadline):
+        self.key = key
+        self.deadline = deadline
+        self.entries = []  # whatever the consumer needs to send and ack each one
+        self.reason = "window"
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class DigestCoalescer:
+    """
+    Digest buffers by (user_id, type), oldest first
+
+    A buffer goes out when its window is up, when it holds `max_items`, or -
+    once `max_buffered` notifications are held altogether - to make room,
+    oldest first. So memory stays bounded however many users are involved.
+    Every method returns the buffers that have to be sent now.
+    """
+
+    def __init__(
+        self,
+        types=DIGEST_TYPES,
+        window=DIGEST_WINDOW_SECONDS,
+        max_items=DIGEST_MAX_ITEMS,
+        max_buffered=DIGEST_MAX_BUFFERED,
+        clock=time.monotonic,
+    ):
+        self.types = set(types)
+        self.window = window
+        self.max_items = max_items
+        self.max_buffered = max_buffered
+        self.clock = clock
+        # Same window for everyone, so insertion order is deadline order
+        self._buffers = OrderedDict()
+        self._held = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.types)
+
+    def __len__(self):
+        return self._held
+
+    def wants(self, notification_data):
+        """Should this notification wait for a digest?"""
+        return notification_data["type"] in self.types
+
+    def add(self, notification_data, entry):
+        """Hold `entry` in its user's buffer"""
+        key = (notification_data["user_id"], notification_data["type"])
+        ready = []
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                buffer = self._buffers[key] = DigestBuffer(key, self.clock() + self.window)
+            buffer.entries.append(entry)
+            self._held += 1
+
+            if len(buffer) >= self.max_items:
+                buffer.reason = "full"
+                ready.append(self._pop(key))
+            while self._held > self.max_buffered:
+                oldest = next(iter(self._buffers))
+                self._buffers[oldest].reason = "memory"
+                ready.append(self._pop(oldest))
+        DIGEST_BUFFERED.set(self._held)
+        return ready
+
+    def due(self, now=None):
+        """Take the buffers whose window is up"""
+        now = self.clock() if now is None else now
+        ready = []
+        with self._lock:
+            while self._buffers:
+                key, buffer = next(iter(self._buffers.items()))
+                if buffer.deadline > now:
+                    break
+                ready.append(self._pop(key))
+        DIGEST_BUFFERED.set(self._held)
+        return ready
+
+    def drain(self):
+        """Take every buffer, window or not (for shutdown)"""
+        with self._lock:
+            ready = [self._pop(key) for key in list(self._buffers)]
+            for buffer in ready:
+                buffer.reason = "shutdown"
+        DIGEST_BUFFERED.set(0)
+        return ready
+
+    def holding(self, predicate):
+        """Is any held entry one that predicate(entry) is true for?"""
+        with self._lock:
+            return any(
+                predicate(entry) for buffer in self._buffers.values() for entry in buffer.entries
+            )
+
+    def _pop(self, key):
+        buffer = self._buffers.pop(key)
+        self._held -= len(buffer)
+        return buffer
+
+
+def digest_content(notifications):
+    """One message standing in for several notifications' content"""
+    lines = [f"You have {len(notifications)} new notifications:"]
+    lines.extend(f"- {notification_data['content']}" for notification_data in notifications)
+    return "\n".join(lines)
+
+
+digests = DigestCoalescer()
@@ -0,0 +1,68 @@
+"""NDJSON (optionally gzipped) encoding for streaming exports."""
+
+import json
+import zlib
+from config import EXPORT_CHUNK_BYTES
+
+
+class NdjsonChunker:
+    """
+    Buffers NDJSON lines and hands them back in reasonably sized chunks
+
+    One tiny write per notification would mean one tiny HTTP chunk per
+    notification, so lines are collected until there's `chunk_bytes` worth.
+    With compress=True the chunks are pieces of a single gzip stream.
+    Shared by the Flask (sync) and ASGI (async) export routes.
+    """
+
+    def __init__(self, compress=False, chunk_bytes=EXPORT_CHUNK_BYTES):
+        self.chunk_bytes = chunk_bytes
+        self._buffer = []
+        self._size = 0
+        # wbits=31 means "write a gzip header", so the output is a .gz file
+        self._compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def write(self, record):
+        """Add one record; returns a chunk to send, or b"" if still buffering"""
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        self._buffer.append(line)
+        self._size += len(line)
+        if self._size < self.chunk_bytes:
+            return b""
+        return self._encode(b"".join(self._drain()))
+
+    def finish(self):
+        """Whatever is left, plus the gzip trailer when compressing"""
+        data = self._encode(b"".join(self._drain()))
+        if self._compressor is not None:
+            data += self._compressor.flush()
+        return data
+
+    def _drain(self):
+        lines, self._buffer, self._size = self._buffer, [], 0
+        return lines
+
+    def _encode(self, data):
+        if self._compressor is None:
+            return data
+        return self._compressor.compress(data)
+
+
+def stream_ndjson(records, compress=False, chunk_bytes=EXPORT_CHUNK_BYTES):
+    """Generator of response chunks for an iterable of records"""
+    chunker = NdjsonChunker(compress, chunk_bytes)
+    for record in records:
+        chunk = chunker.write(record)
+        if chunk:
+            yield chunk
+    yield chunker.finish()
+
+
+async def stream_ndjson_async(records, compress=False, chunk_bytes=EXPORT_CHUNK_BYTES):
+    """Same as stream_ndjson, for an async iterable (Motor cursors)"""
+    chunker = NdjsonChunker(compress, chunk_bytes)
+    async for record in records:
+        chunk = chunker.write(record)
+        if chunk:
+            yield chunk
+    yield chunker.finish()
@@ -0,0 +1,180 @@
+"""
+Fan-out worker: expands one-request-many-users jobs into notifications
+
+The API stores a fan-out job (the message plus a list of user ids or a
+segment id) and queues just its id. This worker walks the audience in
+user_id order, FANOUT_CHUNK_SIZE users at a time. Each chunk is one bulk
+upsert into Mongo and one publish_many into the job's priority lane, then a
+checkpoint. If the worker dies, the job message is redelivered and the
+expansion picks up after the last checkpoint instead of starting over.
+"""
+
+import bisect
+import json
+import logging
+import time
+import warnings
+from prometheus_client import Counter
+from consumer import get_rabbitmq_connection
+from database import (
+    get_fanout_job,
+    update_fanout_job,
+    get_segment_members,
+    save_fanout_notifications,
+    content_fields,
+    tenant_fields,
+)
+from lanes import get_lane
+from latency import stamp
+from metrics import start_metrics_server
+from publisher import get_publisher, PublishError
+from retries import schedule_retry, declare_retry_topology
+from config import LOG_LEVEL, RABBITMQ_FANOUT_QUEUE, FANOUT_CHUNK_SIZE
+
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+warnings.filterwarnings("ignore", category=UserWarning)
+
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL),
+    format="%(levelname)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+FANOUT_JOBS = Counter("fanout_jobs_total", "Fan-out jobs finished, by outcome", ["status"])
+FANOUT_NOTIFICATIONS = Counter(
+    "fanout_notifications_total", "Notifications created and queued by fan-out jobs"
+)
+
+
+def audience_chunks(job, chunk_size=FANOUT_CHUNK_SIZE):
+    """
+    The job's user ids after its checkpoint, chunk_size at a time, in order
+
+    A user_ids job keeps its (sorted) list in the job itself; a segment is
+    paged through with a keyset query, so it never has to fit in memory
+    """
+    after = job.get("checkpoint")
+    if "user_ids" in job:
+        user_ids = job["user_ids"]
+        start = 0 if after is None else bisect.bisect_right(user_ids, after)
+        for offset in range(start, len(user_ids), chunk_size):
+            yield user_ids[offset : offset + chunk_size]
+        return
+
+    while True:
+        chunk = get_segment_members(job["segment_id"], after=after, limit=chunk_size)
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1]
+
+
+def expand_job(job_id, publisher=None, chunk_size=FANOUT_CHUNK_SIZE, sleep=time.sleep):
+    """
+    Turn a fan-out job into notifications, resuming from its checkpoint
+
+    Raises if Mongo or the broker fail part way; everything up to the last
+    checkpoint stays done. A chunk that was saved but not checkpointed is
+    saved again as a no-op (the upserts find the existing notifications)
+    and published again - consumers with DEDUP_ENABLED skip the repeats.
+
+    Returns how many notifications this run queued
+    """
+    job = get_fanout_job(job_id)
+    if job is None:
+        logger.warning(f"Fan-out job {job_id} doesn't exist, skipping")
+        return 0
+    if job["status"] == "done":
+        return 0
+
+    publisher = publisher or get_publisher()
+    routing_key = get_lane(job.get("priority")).queue
+    fields = {**content_fields(job), **tenant_fields(job)}
+    update_fanout_job(job_id, status="running")
+
+    queued = 0
+    for user_ids in audience_chunks(job, chunk_size):
+        received = time.time()
+        saved = save_fanout_notifications(job, user_ids)
+        persisted = time.time()
+        messages = [
+            stamp(
+                {
+                    "id": notification_id,
+                    "user_id": user_id,
+                    "type": job["type"],
+                    **fields,
+                    "timestamps": {"received": received, "persisted": persisted},
+                },
+                "published",
+            )
+            for notification_id, user_id in saved
+        ]
+        errors = [error for error in publisher.publish_many(messages, routing_key) if error]
+        if errors:
+            raise PublishError(f"{len(errors)} of {len(messages)} publishes failed: {errors[0]}")
+
+        update_fanout_job(job_id, checkpoint=user_ids[-1], expanded=len(user_ids))
+        FANOUT_NOTIFICATIONS.inc(len(user_ids))
+        queued += len(user_ids)
+        # Keep the broker connection's heartbeats going during long expansions
+        sleep(0)
+
+    update_fanout_job(job_id, status="done")
+    FANOUT_JOBS.labels(status="done").inc()
+    logger.info(f"Fan-out job {job_id} done ({queued} notifications this run)")
+    return queued
+
+
+def process_fanout_job(ch, method, properties, body):
+    """
+    Handle one job message from the fan-out queue
+
+    Failures go through the usual delay queues and land in the dead-letter
+    queue after RETRY_MAX_ATTEMPTS; each retry resumes from the checkpoint
+    """
+    try:
+        job_id = json.loads(body)["job_id"]
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f"Dropping unreadable fan-out message: {str(e)}")
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+
+    try:
+        expand_job(job_id, sleep=ch.connection.sleep)
+    except Exception as e:
+        logger.error(f"Fan-out job {job_id} stopped: {str(e)}")
+        FANOUT_JOBS.labels(status="interrupted").inc()
+        try:
+            update_fanout_job(job_id, status="retrying", error=str(e))
+        except Exception:
+            pass
+        schedule_retry(ch, method, properties, body, e, queue=RABBITMQ_FANOUT_QUEUE)
+        return
+
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+def start_fanout_worker():
+    """Expand fan-out jobs one at a time, for as long as there are any"""
+    start_metrics_server()
+    connection = get_rabbitmq_connection()
+    channel = connection.channel()
+    channel.queue_declare(queue=RABBITMQ_FANOUT_QUEUE, durable=True)
+    declare_retry_topology(channel, RABBITMQ_FANOUT_QUEUE)
+    # A job can take a while - don't sit on others another worker could start
+    channel.basic_qos(prefetch_count=1)
+    channel.basic_consume(queue=RABBITMQ_FANOUT_QUEUE, on_message_callback=process_fanout_job)
+
+    logger.info("📣 Fan-out worker is awake and listening...")
+    try:
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        pass
+
+    connection.close()
+    get_publisher().close()
+
+
+if __name__ == "__main__":
+    start_fanout_worker()
@@ -12,7 +12,8 @@ bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
 backlog = 2048
 
 # Worker process settings
-worker_class = "sync"
+# "uvicorn.workers.UvicornWorker" serves the async entry point (asgi:app)
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
 worker_connections = 1000
 timeout = 30
 keepalive = 2
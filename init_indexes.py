@@ -0,0 +1,37 @@
+"""
+Create (and check) the MongoDB indexes the service's queries rely on
+
+Run it once per deploy, before the API and consumers start - the
+init-indexes service in docker-compose does:
+
+    python init_indexes.py                    # create anything missing
+    python init_indexes.py --check-coverage   # and explain the hot queries (CI)
+
+Exits non-zero if Mongo can't be reached, an index can't be built, or (with
+--check-coverage) a hot query isn't served by an index.
+"""
+
+import logging
+import sys
+from pymongo.errors import PyMongoError
+from database import init_db
+from config import LOG_LEVEL
+
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL),
+    format="%(levelname)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    check_coverage = "--check-coverage" in sys.argv[1:]
+    try:
+        uncovered = init_db(check_coverage=check_coverage)
+    except PyMongoError as e:
+        logger.error(f"Could not set up MongoDB indexes: {str(e)}")
+        sys.exit(1)
+    if uncovered:
+        logger.error(f"Queries not covered by an index: {', '.join(uncovered)}")
+        sys.exit(1)
+    logger.info("MongoDB indexes are in place")
@@ -0,0 +1,64 @@
+"""Delivery timestamps carried in each message, and the per-stage histograms built from them."""
+
+import time
+from prometheus_client import Histogram
+
+# (stage, from timestamp, to timestamp). A message only records the stages
+# whose timestamps it actually carries.
+STAGES = (
+    ("persist", "received", "persisted"),
+    ("publish", "persisted", "published"),
+    ("queue_wait", "published", "consumed"),
+    ("send", "consumed", "sent"),
+    ("status_write", "sent", "status_written"),
+    ("end_to_end", "received", "status_written"),
+)
+
+NOTIFICATION_STAGE_SECONDS = Histogram(
+    "notification_stage_seconds",
+    "Time a notification spent in each stage from API request to status written",
+    ["stage", "type"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+
+
+def stamp(notification_data, *names, now=None):
+    """
+    Record that a notification reached one or more stages
+
+    Timestamps are wall-clock seconds (time.time()), since they're compared
+    across the API and consumer hosts. They live under "timestamps" in the
+    message itself.
+    """
+    now = time.time() if now is None else now
+    timestamps = notification_data.setdefault("timestamps", {})
+    for name in names:
+        timestamps[name] = now
+    return notification_data
+
+
+def stage_durations(timestamps):
+    """
+    {stage: seconds} for every stage both ends of which are known
+
+    Write-behind messages are published before they're persisted, so their
+    publish stage starts at "received" instead
+    """
+    timestamps = timestamps or {}
+    durations = {}
+    for stage, start, end in STAGES:
+        if stage == "publish" and start not in timestamps:
+            start = "received"
+        if start in timestamps and end in timestamps:
+            # Clocks on different hosts can be a little apart - never go negative
+            durations[stage] = max(0.0, timestamps[end] - timestamps[start])
+    return durations
+
+
+def observe_stages(notification_data):
+    """Feed a finished notification's stage timings into the histograms"""
+    notification_type = notification_data.get("type", "unknown")
+    for stage, seconds in stage_durations(notification_data.get("timestamps")).items():
+        NOTIFICATION_STAGE_SECONDS.labels(stage=stage, type=notification_type).observe(
+            seconds
+        )
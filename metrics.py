@@ -0,0 +1,40 @@
+"""Prometheus metrics shared by the Flask and ASGI front ends, and the consumers' /metrics server."""
+
+import logging
+from prometheus_client import Counter, Histogram, start_http_server
+from config import CONSUMER_METRICS_PORT, CONSUMER_MAX_WORKERS
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATIONS_SENT = Counter(
+    "notifications_sent_total", "Total number of notifications sent", ["type"]
+)
+NOTIFICATION_DURATION = Histogram(
+    "notification_processing_seconds", "Time spent processing notification requests"
+)
+API_REQUESTS = Counter(
+    "api_requests_total", "Total API requests", ["endpoint", "method", "status"]
+)
+QUEUE_ERRORS = Counter("queue_errors_total", "Total number of queue errors")
+
+
+def start_metrics_server(port=CONSUMER_METRICS_PORT, tries=CONSUMER_MAX_WORKERS):
+    """
+    Serve this process's metrics on a background thread
+
+    Consumers have no web app of their own, so prometheus_client's little
+    HTTP server does the job. Under the supervisor several workers share a
+    box, so each takes the first free port from `port` up. Returns the port,
+    or None when it's turned off or nothing was free.
+    """
+    if not port:
+        return None
+    for candidate in range(port, port + max(tries, 1)):
+        try:
+            start_http_server(candidate)
+        except OSError:
+            continue
+        logger.info(f"Serving consumer metrics on :{candidate}/metrics")
+        return candidate
+    logger.warning(f"No free port for consumer metrics in {port}-{port + tries - 1}")
+    return None
@@ -16,9 +16,7 @@ db.createUser({
 // Create collection for notifications
 db.createCollection("notifications");
 
-// Create indexes
-db.notifications.createIndex({ user_id: 1 });
-db.notifications.createIndex({ created_at: -1 });
-db.notifications.createIndex({ status: 1 });
+// Indexes are created by `python init_indexes.py` (the init-indexes service
+// in docker-compose), so they stay in sync with the queries in the code.
 
 print("MongoDB initialization completed successfully!");
@@ -1,6 +1,18 @@
+import asyncio
+import importlib
 import json
 import logging
+import os
+import threading
 import warnings
+from importlib.metadata import entry_points
+from config import (
+    NOTIFICATION_PROVIDER_MODULES,
+    PROVIDER_HTTP_TIMEOUT,
+    PROVIDER_HTTP_POOL_SIZE,
+    EMAIL_BATCH_MAX_RECIPIENTS,
+    SMS_BATCH_MAX_RECIPIENTS,
+)
 
 # Silence the warnings we don't care about
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -14,7 +26,23 @@ logger = logging.getLogger(__name__)
 
 
 class NotificationService:
-    """The parent of all notification types - like a blueprint"""
+    """
+    The parent of all notification types - like a blueprint
+
+    The registry makes one of each per process and keeps it around, so
+    anything expensive (clients, tokens, TLS setup) belongs in startup()
+    rather than in send(). close() is the place to let go of it again.
+    """
+
+    def startup(self):
+        """Called once, right after the registry creates the service"""
+
+    def health(self):
+        """Is the provider usable right now? Override for a real check"""
+        return True
+
+    def close(self):
+        """Called when the process shuts down (or the registry is reset)"""
 
     def send(self, user_id, content):
         """
@@ -28,7 +56,226 @@ class NotificationService:
         """
         raise NotImplementedError("Subclasses must implement this method")
 
+    async def send_async(self, user_id, content):
+        """
+        The asyncio flavour of send, for the async consumer
+
+        By default it just runs send in a worker thread so it doesn't block
+        the event loop. Providers with a proper async client should override
+        this and await their HTTP call directly.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.send, user_id, content)
+
+    def send_batch(self, items):
+        """
+        Send a bunch of notifications at once
+
+        items is a list of (user_id, content) pairs. Returns one result per
+        item, in the same order: True, False, or the exception that item
+        hit (so one bad recipient doesn't sink the rest).
+
+        This default just calls send for each one. Providers with a bulk
+        API should override it and cover many items per request.
+        """
+        results = []
+        for user_id, content in items:
+            try:
+                results.append(self.send(user_id, content))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+def group_for_bulk_send(items, max_recipients):
+    """
+    Split batch items into bulk requests: same content, many recipients
+
+    Bulk APIs (SendGrid personalizations, Twilio Notify bindings) send one
+    body to a list of recipients, so items are grouped by content and each
+    group is capped at max_recipients.
+
+    Yields:
+        tuple: (content, [indexes into items])
+    """
+    by_content = {}
+    for index, (user_id, content) in enumerate(items):
+        by_content.setdefault(content, []).append(index)
+
+    for content, indexes in by_content.items():
+        for start in range(0, len(indexes), max_recipients):
+            yield content, indexes[start : start + max_recipients]
+
+
+class HTTPNotificationService(NotificationService):
+    """
+    Base for providers that talk to an HTTP API (SendGrid, Twilio, ...)
+
+    Holds one pooled httpx.Client for the life of the process, so
+    connections and TLS sessions get reused between messages. Subclasses
+    set base_url (and health_url if the provider has one) and use
+    self.client in send().
+    """
+
+    base_url = ""
+    health_url = None
+    headers = {}
+
+    def __init__(self, timeout=PROVIDER_HTTP_TIMEOUT, pool_size=PROVIDER_HTTP_POOL_SIZE):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.client = None
+
+    def startup(self):
+        import httpx
 
+        self.client = httpx.Client(
+            base_url=self.base_url,
+            headers=self.headers,
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+            ),
+        )
+
+    def health(self):
+        if self.client is None:
+            return False
+        if not self.health_url:
+            return True
+        try:
+            return self.client.get(self.health_url).is_success
+        except Exception as e:
+            logger.warning(f"Health check for {type(self).__name__} failed: {str(e)}")
+            return False
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+class ServiceRegistry:
+    """
+    Keeps one instance of each notification service per process
+
+    New channel types can be added without touching this file:
+    - decorate a NotificationService subclass with @registry.register("push")
+      in a module listed in NOTIFICATION_PROVIDER_MODULES, or
+    - publish it as a "notification_service.providers" entry point
+
+    Plugins are loaded the first time anyone asks for a service or the list
+    of types. Instances are created on first use; after a fork the child
+    starts with none, since clients and sockets don't survive fork well.
+    """
+
+    ENTRY_POINT_GROUP = "notification_service.providers"
+
+    def __init__(self, plugin_modules=()):
+        self._factories = {}
+        self._instances = {}
+        self._plugin_modules = plugin_modules
+        self._plugins_loaded = False
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+
+    def register(self, notification_type, factory=None):
+        """
+        Add a channel type - usable directly or as a class decorator
+
+        factory is anything that returns a NotificationService when called
+        with no arguments (usually the class itself)
+        """
+        if factory is None:
+            return lambda cls: self.register(notification_type, cls)
+        with self._lock:
+            self._factories[notification_type] = factory
+            stale = self._instances.pop(notification_type, None)
+        if stale is not None:
+            stale.close()
+        return factory
+
+    def types(self):
+        """Every notification type we can send, in registration order"""
+        self._load_plugins()
+        return list(self._factories)
+
+    def get(self, notification_type):
+        """The shared service for a type, started up on first use"""
+        self._load_plugins()
+        with self._lock:
+            self._check_pid()
+            service = self._instances.get(notification_type)
+            if service is not None:
+                return service
+
+            factory = self._factories.get(notification_type)
+            if factory is None:
+                raise ValueError(f"Unsupported notification type: {notification_type}")
+            service = factory()
+            service.startup()
+            self._instances[notification_type] = service
+            return service
+
+    def start_all(self):
+        """Create every service up front, so the first message isn't slow"""
+        for notification_type in self.types():
+            self.get(notification_type)
+
+    def health(self):
+        """Health of each service that has been started (type -> bool)"""
+        with self._lock:
+            self._check_pid()
+            instances = dict(self._instances)
+        return {name: bool(service.health()) for name, service in instances.items()}
+
+    def close(self):
+        """Close every started service; they'll be recreated if used again"""
+        with self._lock:
+            instances, self._instances = self._instances, {}
+        for name, service in instances.items():
+            try:
+                service.close()
+            except Exception as e:
+                logger.error(f"Error closing {name} notification service: {str(e)}")
+
+    def _check_pid(self):
+        # Forked child - the parent's clients aren't ours to use (or close)
+        if self._pid != os.getpid():
+            self._instances = {}
+            self._pid = os.getpid()
+
+    def _load_plugins(self):
+        if self._plugins_loaded:
+            return
+        with self._lock:
+            if self._plugins_loaded:
+                return
+            # One broken plugin shouldn't take the others down with it - its
+            # types just stay unknown, and the log says why
+            for module in self._plugin_modules:
+                try:
+                    # Registers itself with @registry.register on import
+                    importlib.import_module(module)
+                except Exception as e:
+                    logger.error(
+                        f"Could not load notification provider module {module}: {str(e)}"
+                    )
+            for entry_point in entry_points(group=self.ENTRY_POINT_GROUP):
+                try:
+                    self.register(entry_point.name, entry_point.load())
+                except Exception as e:
+                    logger.error(
+                        f"Could not load notification provider {entry_point.name}: {str(e)}"
+                    )
+            self._plugins_loaded = True
+
+
+registry = ServiceRegistry(NOTIFICATION_PROVIDER_MODULES)
+
+
+@registry.register("email")
 class EmailNotificationService(NotificationService):
     """The email sender - gets stuff to your inbox"""
 
@@ -38,7 +285,19 @@ class EmailNotificationService(NotificationService):
         # Let's pretend it worked
         return True
 
+    def send_batch(self, items, max_recipients=EMAIL_BATCH_MAX_RECIPIENTS):
+        """One provider request per distinct content, up to max_recipients each"""
+        results = [None] * len(items)
+        for content, indexes in group_for_bulk_send(items, max_recipients):
+            user_ids = [items[index][0] for index in indexes]
+            # One SendGrid call with a personalization per recipient, in real life
+            logger.info(f"Shooting one email to {len(user_ids)} users: {content}")
+            for index in indexes:
+                results[index] = True
+        return results
+
 
+@registry.register("sms")
 class SMSNotificationService(NotificationService):
     """The text messenger - pings your phone"""
 
@@ -48,7 +307,19 @@ class SMSNotificationService(NotificationService):
         # All good on our end!
         return True
 
+    def send_batch(self, items, max_recipients=SMS_BATCH_MAX_RECIPIENTS):
+        """One provider request per distinct content, up to max_recipients each"""
+        results = [None] * len(items)
+        for content, indexes in group_for_bulk_send(items, max_recipients):
+            user_ids = [items[index][0] for index in indexes]
+            # Would be a single Twilio Notify call with one binding per user
+            logger.info(f"Texting {len(user_ids)} users at once: {content}")
+            for index in indexes:
+                results[index] = True
+        return results
 
+
+@registry.register("in-app")
 class InAppNotificationService(NotificationService):
     """The popup maker - catches you in the app"""
 
@@ -66,15 +337,7 @@ def get_notification_service(notification_type):
     Tells you which sender to use based on what kind of notification
     you want to send (email, text, or in-app pop-up)
 
-    Will complain if you try something weird we don't support
+    Will complain if you try something weird we don't support. The same
+    instance comes back every time (per process), see ServiceRegistry
     """
-    notification_services = {
-        "email": EmailNotificationService(),
-        "sms": SMSNotificationService(),
-        "in-app": InAppNotificationService(),
-    }
-
-    if notification_type not in notification_services:
-        raise ValueError(f"Unsupported notification type: {notification_type}")
-
-    return notification_services[notification_type]
+    return registry.get(notification_type)
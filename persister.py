@@ -0,0 +1,94 @@
+import json
+import logging
+import warnings
+from pymongo.errors import BulkWriteError
+from consumer import consume_in_batches
+from database import persist_notifications, message_to_document
+from publisher import get_rabbitmq_connection
+from retries import schedule_retry, declare_retry_topology
+from config import (
+    LOG_LEVEL,
+    RABBITMQ_PERSIST_QUEUE,
+    PERSIST_BATCH_SIZE,
+    PERSIST_BATCH_TIMEOUT_MS,
+)
+
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+warnings.filterwarnings("ignore", category=UserWarning)
+
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL),
+    format="%(levelname)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+def persist_batch(ch, deliveries):
+    """
+    Upsert a batch of write-behind records, then ack them all at once
+
+    Records Mongo refuses go off for a delayed retry on their own, so one
+    bad record doesn't drag the rest of its batch around with it. If Mongo
+    is unavailable the whole batch waits out a retry delay instead of
+    coming straight back round. Either way they end up in the dead-letter
+    queue after RETRY_MAX_ATTEMPTS.
+    """
+    persisting = []  # ((method, properties, body), document)
+    for delivery in deliveries:
+        try:
+            document = message_to_document(json.loads(delivery[2]))
+            if document is not None:
+                persisting.append((delivery, document))
+        except (ValueError, KeyError, TypeError) as e:
+            # Never going to work - don't let it block the queue
+            logger.error(f"Dropping unpersistable message: {str(e)}")
+
+    last_tag = max(method.delivery_tag for method, _, _ in deliveries)
+    try:
+        persist_notifications([document for _, document in persisting])
+        failed = []
+    except BulkWriteError as e:
+        failed = [
+            (persisting[error["index"]][0], error.get("errmsg", "write error"))
+            for error in e.details.get("writeErrors", [])
+        ]
+        logger.error(f"Mongo refused {len(failed)} of {len(persisting)} records in a batch")
+    except Exception as e:
+        logger.error(f"Error persisting notification batch: {str(e)}")
+        failed = [(delivery, e) for delivery, _ in persisting]
+
+    for (method, properties, body), error in failed:
+        schedule_retry(
+            ch, method, properties, body, error, ack=False, queue=RABBITMQ_PERSIST_QUEUE
+        )
+
+    # One ack for the whole group (nacked tags are already settled)
+    ch.basic_ack(delivery_tag=last_tag, multiple=True)
+
+
+def start_persister():
+    """Write-behind persistence stage - drains the persist queue into Mongo"""
+    connection = get_rabbitmq_connection()
+    channel = connection.channel()
+    channel.queue_declare(queue=RABBITMQ_PERSIST_QUEUE, durable=True)
+    declare_retry_topology(channel, RABBITMQ_PERSIST_QUEUE)
+    channel.basic_qos(prefetch_count=PERSIST_BATCH_SIZE * 2)
+
+    logger.info("💾 Notification persister is awake and listening...")
+    try:
+        consume_in_batches(
+            connection,
+            channel,
+            queue=RABBITMQ_PERSIST_QUEUE,
+            handler=persist_batch,
+            batch_size=PERSIST_BATCH_SIZE,
+            batch_timeout_ms=PERSIST_BATCH_TIMEOUT_MS,
+        )
+    except KeyboardInterrupt:
+        pass
+
+    connection.close()
+
+
+if __name__ == "__main__":
+    start_persister()
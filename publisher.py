@@ -0,0 +1,610 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
+import pika
+from prometheus_client import Counter, Gauge, Histogram
+from lanes import LANES
+from config import (
+    RABBITMQ_HOST,
+    RABBITMQ_PORT,
+    RABBITMQ_USER,
+    RABBITMQ_PASSWORD,
+    RABBITMQ_URL,
+    RABBITMQ_QUEUE,
+    RABBITMQ_PERSIST_QUEUE,
+    RABBITMQ_FANOUT_QUEUE,
+    RABBITMQ_INGEST_EXCHANGE,
+    INGESTION_MODE,
+    PUBLISHER_MAX_RECONNECTS,
+    PUBLISHER_CONFIRMS,
+    PUBLISHER_MAX_IN_FLIGHT,
+    PUBLISHER_MAX_RETRIES,
+    PUBLISHER_CONFIRM_TIMEOUT,
+    PUBLISHER_RECONNECT_DELAY,
+)
+
+logger = logging.getLogger(__name__)
+
+# Publisher metrics - these show up on the API's /metrics endpoint
+PUBLISHER_CONNECTIONS_OPENED = Counter(
+    "publisher_connections_opened_total", "RabbitMQ connections opened by the publisher"
+)
+PUBLISHER_RECONNECTS = Counter(
+    "publisher_reconnects_total",
+    "Times the publisher had to reconnect after losing the broker",
+)
+PUBLISHER_MESSAGES = Counter(
+    "publisher_messages_total", "Messages published to RabbitMQ", ["status"]
+)
+PUBLISHER_OPEN_CONNECTIONS = Gauge(
+    "publisher_open_connections", "Publisher connections currently open in this process"
+)
+PUBLISHER_IN_FLIGHT = Gauge(
+    "publisher_in_flight_messages", "Published messages still waiting for a broker confirm"
+)
+PUBLISHER_RETRIES = Counter(
+    "publisher_retries_total", "Publishes retried after a nack or lost connection"
+)
+PUBLISHER_CONFIRM_SECONDS = Histogram(
+    "publisher_confirm_seconds", "Time from basic_publish to the broker's ack/nack"
+)
+
+# The things pika throws at us when the broker goes away under our feet
+CONNECTION_ERRORS = (
+    pika.exceptions.AMQPConnectionError,
+    pika.exceptions.AMQPChannelError,
+    pika.exceptions.StreamLostError,
+    ConnectionError,
+)
+
+
+class PublishError(Exception):
+    """The broker refused a message and we ran out of retries"""
+
+
+def get_rabbitmq_parameters():
+    """Connection parameters for RabbitMQ"""
+    # Use URL-based connection if available, otherwise use parameters
+    if RABBITMQ_URL:
+        return pika.URLParameters(RABBITMQ_URL)
+
+    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
+    return pika.ConnectionParameters(
+        host=RABBITMQ_HOST, port=RABBITMQ_PORT, credentials=credentials
+    )
+
+
+def get_rabbitmq_connection():
+    """Open a fresh blocking connection to RabbitMQ"""
+    return pika.BlockingConnection(get_rabbitmq_parameters())
+
+
+def topology_declarations(queue, exchange="", bindings=(), queues=()):
+    """
+    The exchange, queues and bindings a publisher needs, in declaration order
+
+    `queues` are extra queues to declare (the other priority lanes). Returns (channel method name, kwargs) pairs so the blocking and the
+    asynchronous publisher can both walk the same list
+    """
+    declarations = []
+    if exchange:
+        declarations.append(
+            (
+                "exchange_declare",
+                {"exchange": exchange, "exchange_type": "direct", "durable": True},
+            )
+        )
+    for name in dict.fromkeys([queue, *queues] + [bound for bound, _ in bindings]):
+        declarations.append(("queue_declare", {"queue": name, "durable": True}))
+    for bound, routing_key in bindings:
+        declarations.append(
+            (
+                "queue_bind",
+                {"queue": bound, "exchange": exchange, "routing_key": routing_key},
+            )
+        )
+    return declarations
+
+
+class RabbitMQPublisher:
+    """
+    One long-lived connection and channel, shared by every thread in the process
+
+    pika's BlockingConnection isn't thread-safe, so publishes are serialized
+    behind a lock. That's still way cheaper than a TCP + AMQP handshake per
+    request. If the broker drops us, we reconnect and try again.
+    """
+
+    def __init__(
+        self,
+        connection_factory=None,
+        queue=RABBITMQ_QUEUE,
+        exchange="",
+        bindings=(),
+        queues=(),
+    ):
+        self.connection_factory = connection_factory or get_rabbitmq_connection
+        self.queue = queue
+        self.exchange = exchange
+        self.declarations = topology_declarations(queue, exchange, bindings, queues)
+        self._lock = threading.Lock()
+        self._connection = None
+        self._channel = None
+        self._connected_once = False
+
+    def _ensure_channel(self):
+        """Connect (and declare the queue) only if we don't already have a live channel"""
+        if self._channel is not None and self._channel.is_open:
+            # Lets pika answer heartbeats we might have missed while idle
+            self._connection.process_data_events(time_limit=0)
+            return self._channel
+
+        self._close_quietly()
+        if self._connected_once:
+            PUBLISHER_RECONNECTS.inc()
+            logger.warning("Publisher lost its RabbitMQ connection, reconnecting")
+
+        self._connection = self.connection_factory()
+        self._channel = self._connection.channel()
+        for method_name, kwargs in self.declarations:
+            getattr(self._channel, method_name)(**kwargs)
+        self._connected_once = True
+        PUBLISHER_CONNECTIONS_OPENED.inc()
+        PUBLISHER_OPEN_CONNECTIONS.inc()
+        return self._channel
+
+    def _close_quietly(self):
+        """Throw away the current connection, ignoring whatever state it's in"""
+        if self._connection is None:
+            return
+        try:
+            if self._connection.is_open:
+                self._connection.close()
+        except Exception:
+            pass
+        PUBLISHER_OPEN_CONNECTIONS.dec()
+        self._connection = None
+        self._channel = None
+
+    def publish(self, notification_data, routing_key=None):
+        """
+        Push one notification onto the queue (or `routing_key`, if given)
+
+        Reconnects up to PUBLISHER_MAX_RECONNECTS times if the connection
+        turns out to be dead; after that the error goes back to the caller
+        """
+        message = json.dumps(notification_data)
+
+        with self._lock:
+            for attempt in range(PUBLISHER_MAX_RECONNECTS + 1):
+                try:
+                    channel = self._ensure_channel()
+                    channel.basic_publish(
+                        exchange=self.exchange,
+                        routing_key=routing_key or self.queue,
+                        body=message,
+                        properties=pika.BasicProperties(
+                            delivery_mode=2
+                        ),  # make message persistent
+                    )
+                    PUBLISHER_MESSAGES.labels(status="published").inc()
+                    return
+                except CONNECTION_ERRORS as e:
+                    logger.warning(f"Publish attempt {attempt + 1} failed: {str(e)}")
+                    self._close_quietly()
+                    if attempt == PUBLISHER_MAX_RECONNECTS:
+                        PUBLISHER_MESSAGES.labels(status="failed").inc()
+                        raise
+
+    def publish_many(self, notifications, routing_key=None):
+        """
+        Push a batch of notifications over the same channel
+
+        Returns one error (or None) per notification. A dropped connection
+        reconnects and carries on from the message that failed.
+        """
+        errors = [None] * len(notifications)
+
+        with self._lock:
+            index = 0
+            attempt = 0
+            while index < len(notifications):
+                try:
+                    channel = self._ensure_channel()
+                    channel.basic_publish(
+                        exchange=self.exchange,
+                        routing_key=routing_key or self.queue,
+                        body=json.dumps(notifications[index]),
+                        properties=pika.BasicProperties(delivery_mode=2),
+                    )
+                    PUBLISHER_MESSAGES.labels(status="published").inc()
+                    index += 1
+                except CONNECTION_ERRORS as e:
+                    self._close_quietly()
+                    attempt += 1
+                    if attempt > PUBLISHER_MAX_RECONNECTS:
+                        # Broker is really gone - fail whatever is left
+                        for remaining in range(index, len(notifications)):
+                            errors[remaining] = str(e)
+                        PUBLISHER_MESSAGES.labels(status="failed").inc(
+                            len(notifications) - index
+                        )
+                        break
+
+        return errors
+
+    def close(self):
+        """Shut the connection down cleanly (worker exit, tests)"""
+        with self._lock:
+            self._close_quietly()
+
+
+class _PendingPublish:
+    """A message on its way to the broker, plus the future its caller is waiting on"""
+
+    __slots__ = ("body", "routing_key", "future", "attempts", "sent_at", "cancelled")
+
+    def __init__(self, body, routing_key):
+        self.body = body
+        self.routing_key = routing_key
+        self.future = Future()
+        self.attempts = 0
+        self.sent_at = None
+        self.cancelled = False  # the caller gave up waiting - don't (re)send it
+
+
+def _resolve(future, result=None, error=None):
+    """Settle a future unless the other side (I/O or request thread) got there first"""
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class ConfirmingPublisher:
+    """
+    Publisher confirms with lots of messages in flight at once
+
+    A background thread owns an asynchronous (SelectConnection) connection
+    in confirm mode. Request threads hand messages over and get a future
+    back; the I/O thread publishes them without waiting, then matches the
+    broker's acks/nacks to them by delivery tag (one ack can cover many
+    messages when the broker sets "multiple").
+
+    Nacked messages and messages that were in flight when the connection
+    dropped are retried here, with a short backoff, up to
+    PUBLISHER_MAX_RETRIES times.
+    """
+
+    def __init__(
+        self,
+        parameters_factory=None,
+        queue=RABBITMQ_QUEUE,
+        exchange="",
+        bindings=(),
+        queues=(),
+        max_in_flight=PUBLISHER_MAX_IN_FLIGHT,
+        max_retries=PUBLISHER_MAX_RETRIES,
+        confirm_timeout=PUBLISHER_CONFIRM_TIMEOUT,
+    ):
+        self.parameters_factory = parameters_factory or get_rabbitmq_parameters
+        self.queue = queue
+        self.exchange = exchange
+        self.declarations = topology_declarations(queue, exchange, bindings, queues)
+        self.max_retries = max_retries
+        self.confirm_timeout = confirm_timeout
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._outbox = deque()
+        self._outbox_lock = threading.Lock()
+        # Only ever touched from the I/O thread
+        self._unconfirmed = {}
+        self._delivery_tag = 0
+        self._connection = None
+        self._channel = None
+        self._ready = False
+        self._stopping = False
+        self._thread = None
+
+    # --- called from request threads ---
+
+    def start(self):
+        """Kick off the I/O thread (safe to call more than once)"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="rabbitmq-publisher", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def publish_async(self, notification_data, routing_key=None):
+        """
+        Queue a message for publishing and return a future
+
+        The future resolves to True once the broker confirms the message, or
+        raises PublishError if it keeps getting nacked
+        """
+        return self._enqueue(notification_data, routing_key).future
+
+    def publish(self, notification_data, routing_key=None):
+        """Publish and block until the broker has confirmed the message"""
+        item = self._enqueue(notification_data, routing_key)
+        try:
+            return item.future.result(timeout=self.confirm_timeout)
+        except FutureTimeoutError:
+            self._cancel(item)
+            return item.future.result(timeout=0)
+
+    def publish_many(self, notifications, routing_key=None):
+        """
+        Put a whole batch in flight, then wait for all of the confirms
+
+        Returns one error (or None) per notification
+        """
+        items = [self._enqueue(notification, routing_key) for notification in notifications]
+        deadline = time.monotonic() + self.confirm_timeout
+        errors = []
+        for item in items:
+            try:
+                try:
+                    item.future.result(timeout=max(0, deadline - time.monotonic()))
+                except FutureTimeoutError:
+                    self._cancel(item)
+                    item.future.result(timeout=0)
+                errors.append(None)
+            except Exception as e:
+                errors.append(str(e) or type(e).__name__)
+        return errors
+
+    def close(self):
+        """Stop the I/O thread and close the connection"""
+        self._stopping = True
+        connection = self._connection
+        if connection is not None:
+            connection.ioloop.add_callback_threadsafe(self._close_connection)
+        if self._thread is not None:
+            self._thread.join(timeout=self.confirm_timeout)
+
+    def _enqueue(self, notification_data, routing_key):
+        if not self._slots.acquire(timeout=self.confirm_timeout):
+            raise PublishError("Too many messages waiting for broker confirms")
+
+        item = _PendingPublish(json.dumps(notification_data), routing_key or self.queue)
+        item.future.add_done_callback(lambda _: self._slots.release())
+        with self._outbox_lock:
+            self._outbox.append(item)
+        self._wake_io_thread()
+        return item
+
+    def _cancel(self, item):
+        """
+        Give up on a message whose confirm didn't come in time
+
+        The caller is about to report a failure (and a client will likely
+        retry), so a message still sitting in the outbox must not go out
+        afterwards. One that was already sent can't be taken back, but it
+        won't be retried either. If the confirm raced us and won, the future
+        keeps its real outcome.
+        """
+        with self._outbox_lock:
+            item.cancelled = True
+            try:
+                self._outbox.remove(item)
+                sent = False
+            except ValueError:
+                sent = True
+
+        message = "Timed out waiting for the broker to confirm the message"
+        if sent:
+            message += " (it may still have been published)"
+        _resolve(item.future, error=PublishError(message))
+
+    def _wake_io_thread(self):
+        connection = self._connection
+        if connection is None or not self._ready:
+            # Nothing to do - whatever is in the outbox goes out once we connect
+            return
+        try:
+            connection.ioloop.add_callback_threadsafe(self._drain_outbox)
+        except Exception:
+            # Connection is on its way down; reconnecting will drain the outbox
+            pass
+
+    # --- everything below runs on the I/O thread ---
+
+    def _run(self):
+        while not self._stopping:
+            self._connection = pika.SelectConnection(
+                self.parameters_factory(),
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_open_error,
+                on_close_callback=self._on_connection_closed,
+            )
+            self._connection.ioloop.start()
+            if not self._stopping:
+                PUBLISHER_RECONNECTS.inc()
+                time.sleep(PUBLISHER_RECONNECT_DELAY)
+
+    def _on_connection_open(self, connection):
+        PUBLISHER_CONNECTIONS_OPENED.inc()
+        PUBLISHER_OPEN_CONNECTIONS.inc()
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        logger.warning(f"Publisher could not connect to RabbitMQ: {str(error)}")
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        PUBLISHER_OPEN_CONNECTIONS.dec()
+        self._ready = False
+        self._channel = None
+        if not self._stopping:
+            logger.warning(f"Publisher lost its RabbitMQ connection: {str(reason)}")
+        self._requeue_unconfirmed()
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._delivery_tag = 0
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(ack_nack_callback=self._on_delivery_confirmation)
+        self._declare(self.declarations)
+
+    def _on_channel_closed(self, channel, reason):
+        logger.warning(f"Publisher channel closed: {str(reason)}")
+        self._ready = False
+        self._channel = None
+        self._close_connection()
+
+    def _declare(self, declarations):
+        """Run the declarations one after another, then start publishing"""
+        if not declarations:
+            self._ready = True
+            self._drain_outbox()
+            return
+
+        method_name, kwargs = declarations[0]
+        getattr(self._channel, method_name)(
+            callback=lambda frame: self._declare(declarations[1:]), **kwargs
+        )
+
+    def _close_connection(self):
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def _drain_outbox(self):
+        """Publish everything waiting in the outbox without waiting for confirms"""
+        while self._ready and self._channel is not None:
+            with self._outbox_lock:
+                if not self._outbox:
+                    return
+                item = self._outbox.popleft()
+            if item.cancelled:
+                continue
+
+            self._delivery_tag += 1
+            item.sent_at = time.monotonic()
+            self._unconfirmed[self._delivery_tag] = item
+            PUBLISHER_IN_FLIGHT.inc()
+            self._channel.basic_publish(
+                exchange=self.exchange,
+                routing_key=item.routing_key,
+                body=item.body,
+                properties=pika.BasicProperties(delivery_mode=2),
+            )
+
+    def _on_delivery_confirmation(self, frame):
+        """Resolve (or retry) every message covered by an ack/nack"""
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        retry_needed = False
+        now = time.monotonic()
+        for tag in tags:
+            item = self._unconfirmed.pop(tag, None)
+            if item is None:
+                continue
+            PUBLISHER_IN_FLIGHT.dec()
+            PUBLISHER_CONFIRM_SECONDS.observe(now - item.sent_at)
+
+            if acked:
+                PUBLISHER_MESSAGES.labels(status="published").inc()
+                _resolve(item.future, result=True)
+            else:
+                retry_needed = self._retry(item) or retry_needed
+
+        if retry_needed:
+            self._connection.ioloop.call_later(
+                PUBLISHER_RECONNECT_DELAY, self._drain_outbox
+            )
+
+    def _retry(self, item):
+        """Put a message back in the outbox, unless it's been tried enough already"""
+        if item.cancelled:
+            # Its caller has already been told it failed
+            return False
+
+        item.attempts += 1
+        if item.attempts > self.max_retries:
+            PUBLISHER_MESSAGES.labels(status="failed").inc()
+            _resolve(
+                item.future,
+                error=PublishError(f"Broker rejected message after {item.attempts} attempts"),
+            )
+            return False
+
+        PUBLISHER_RETRIES.inc()
+        with self._outbox_lock:
+            self._outbox.append(item)
+        return True
+
+    def _requeue_unconfirmed(self):
+        """The connection died with messages in flight - we'll never hear about them"""
+        for tag in sorted(self._unconfirmed):
+            PUBLISHER_IN_FLIGHT.dec()
+            self._retry(self._unconfirmed[tag])
+        self._unconfirmed.clear()
+
+
+def get_publisher_topology():
+    """
+    Where API messages go
+
+    Normally straight into the delivery queue of the message's priority
+    lane (the routing key is the lane's queue). In write-behind mode they go
+    through a direct exchange that copies each message into both that
+    delivery queue and the persistence queue. Fan-out jobs go to the
+    fan-out queue either way.
+    """
+    lane_queues = [lane.queue for lane in LANES]
+    if INGESTION_MODE == "write_behind":
+        return {
+            "exchange": RABBITMQ_INGEST_EXCHANGE,
+            "bindings": [(queue, queue) for queue in lane_queues]
+            + [(RABBITMQ_PERSIST_QUEUE, queue) for queue in lane_queues]
+            + [(RABBITMQ_FANOUT_QUEUE, RABBITMQ_FANOUT_QUEUE)],
+        }
+    return {
+        "queues": [queue for queue in lane_queues if queue != RABBITMQ_QUEUE]
+        + [RABBITMQ_FANOUT_QUEUE]
+    }
+
+
+_publisher = None
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    """
+    The process-wide publisher
+
+    Created lazily so each gunicorn worker gets its own connection after the
+    fork - sharing a socket between processes would end badly. Uses publisher
+    confirms unless PUBLISHER_CONFIRMS is switched off.
+    """
+    global _publisher, _publisher_pid
+
+    pid = os.getpid()
+    if _publisher is not None and _publisher_pid == pid:
+        return _publisher
+
+    with _publisher_lock:
+        if _publisher is None or _publisher_pid != pid:
+            if PUBLISHER_CONFIRMS:
+                _publisher = ConfirmingPublisher(**get_publisher_topology()).start()
+            else:
+                _publisher = RabbitMQPublisher(**get_publisher_topology())
+            _publisher_pid = pid
+    return _publisher
@@ -0,0 +1,277 @@
+"""Token-bucket rate limiting per notification type (and optionally per tenant)."""
+
+import asyncio
+import logging
+import threading
+import time
+from prometheus_client import Counter, Gauge
+from config import (
+    CHANNEL_RATE_LIMITS,
+    TENANT_RATE_LIMITS,
+    RATE_LIMIT_MAX_TENANTS,
+    RATE_LIMIT_MAX_THROTTLE_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_CONFIGURED = Gauge(
+    "rate_limit_per_second", "Configured send rate", ["channel", "scope"]
+)
+RATE_LIMIT_THROTTLED = Counter(
+    "rate_limit_throttled_total",
+    "Sends that had to wait for a token",
+    ["channel", "scope"],
+)
+RATE_LIMIT_WAIT_SECONDS = Counter(
+    "rate_limit_wait_seconds_total", "Time spent waiting for tokens", ["channel"]
+)
+RATE_LIMIT_PROVIDER_THROTTLES = Counter(
+    "rate_limit_provider_throttles_total",
+    "Times a provider told us to slow down anyway",
+    ["channel"],
+)
+
+
+class ProviderThrottled(Exception):
+    """
+    Raised by a provider when the remote API says "too many requests"
+
+    retry_after is how long it asked us to back off, in seconds
+    """
+
+    def __init__(self, message="provider throttled", retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_rate_limits(spec):
+    """
+    Read a limit spec like "email=100,sms=10:20" into {type: (rate, burst)}
+
+    rate is tokens per second and has to be positive (at 0 nothing would
+    ever refill); burst defaults to one second's worth and can't be below 1
+    (no send would ever fit in the bucket)
+    """
+    limits = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        name, _, value = entry.partition("=")
+        rate, _, burst = value.partition(":")
+        rate = float(rate)
+        burst = float(burst) if burst else max(rate, 1.0)
+        if rate <= 0:
+            raise ValueError(f"rate limit rate for {name.strip()} must be above 0")
+        if burst < 1:
+            raise ValueError(f"rate limit burst for {name.strip()} must be at least 1")
+        limits[name.strip()] = (rate, burst)
+    return limits
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens a second, holding at most `burst`
+
+    Not thread-safe on its own - RateLimiter does the locking
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost):
+        """Seconds until `cost` tokens are available (0 if they are now)"""
+        self.refill()
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost):
+        self.tokens -= cost
+
+    def drain(self, seconds):
+        """Act as if the next `seconds` worth of tokens were already spent"""
+        self.refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class RateLimiter:
+    """
+    Paces sends so providers never have to throttle us
+
+    Each notification type can have its own bucket, and each (type, tenant)
+    pair can have one too - a send needs a token from both. Types without a
+    configured limit are never slowed down.
+
+    Callers ask for a reservation and sleep however long they're told,
+    while the message stays unacked in the prefetch window. Nothing goes
+    back to the queue, so there's no requeue loop.
+    """
+
+    def __init__(
+        self,
+        channel_limits=None,
+        tenant_limits=None,
+        max_tenants=RATE_LIMIT_MAX_TENANTS,
+        clock=time.monotonic,
+    ):
+        self.channel_limits = (
+            parse_rate_limits(CHANNEL_RATE_LIMITS)
+            if channel_limits is None
+            else channel_limits
+        )
+        self.tenant_limits = (
+            parse_rate_limits(TENANT_RATE_LIMITS) if tenant_limits is None else tenant_limits
+        )
+        self.max_tenants = max_tenants
+        self.clock = clock
+        self._channels = {
+            name: TokenBucket(rate, burst, clock)
+            for name, (rate, burst) in self.channel_limits.items()
+        }
+        self._tenants = {}  # (type, tenant) -> TokenBucket, oldest first
+        self._lock = threading.Lock()
+
+        for name, (rate, _) in self.channel_limits.items():
+            RATE_LIMIT_CONFIGURED.labels(channel=name, scope="channel").set(rate)
+        for name, (rate, _) in self.tenant_limits.items():
+            RATE_LIMIT_CONFIGURED.labels(channel=name, scope="tenant").set(rate)
+
+    def max_cost(self, notification_type, tenant=None):
+        """Most tokens one reservation can ask for (the smallest burst)"""
+        with self._lock:
+            buckets = self._buckets(notification_type, tenant)
+        return int(min(bucket.burst for _, bucket in buckets)) if buckets else None
+
+    def reserve(self, notification_type, tenant=None, cost=1):
+        """
+        Try to take `cost` tokens for a send
+
+        Returns 0 when the tokens were taken, otherwise how many seconds to
+        wait before asking again (nothing is taken in that case)
+        """
+        with self._lock:
+            buckets = self._buckets(notification_type, tenant)
+            waits = [(scope, bucket.wait_time(cost)) for scope, bucket in buckets]
+            wait = max((seconds for _, seconds in waits), default=0.0)
+            if wait > 0:
+                for scope, seconds in waits:
+                    if seconds > 0:
+                        RATE_LIMIT_THROTTLED.labels(
+                            channel=notification_type, scope=scope
+                        ).inc()
+                return wait
+            for _, bucket in buckets:
+                bucket.take(cost)
+            return 0.0
+
+    def acquire(self, notification_type, tenant=None, cost=1, sleep=time.sleep):
+        """Block (using `sleep`) until `cost` tokens have been taken"""
+        while True:
+            wait = self.reserve(notification_type, tenant, cost)
+            if wait <= 0:
+                return
+            RATE_LIMIT_WAIT_SECONDS.labels(channel=notification_type).inc(wait)
+            sleep(wait)
+
+    def run(
+        self,
+        notification_type,
+        call,
+        tenant=None,
+        cost=1,
+        sleep=time.sleep,
+        max_retries=RATE_LIMIT_MAX_THROTTLE_RETRIES,
+    ):
+        """
+        Make a provider call once the limiter allows it
+
+        If the provider throttles us anyway, back off and try again right
+        here (up to max_retries times) instead of sending the message round
+        the queue again. After that the ProviderThrottled is raised as usual.
+        """
+        attempt = 0
+        while True:
+            self.acquire(notification_type, tenant, cost, sleep)
+            try:
+                return call()
+            except ProviderThrottled as e:
+                attempt += 1
+                if attempt > max_retries:
+                    raise
+                logger.warning(
+                    f"{notification_type} provider throttled us, backing off {e.retry_after}s"
+                )
+                self.backoff(notification_type, e.retry_after)
+                sleep(e.retry_after)
+
+    async def run_async(
+        self,
+        notification_type,
+        call,
+        tenant=None,
+        cost=1,
+        max_retries=RATE_LIMIT_MAX_THROTTLE_RETRIES,
+    ):
+        """Same as run, for a coroutine function, waiting with asyncio.sleep"""
+        attempt = 0
+        while True:
+            wait = self.reserve(notification_type, tenant, cost)
+            if wait > 0:
+                RATE_LIMIT_WAIT_SECONDS.labels(channel=notification_type).inc(wait)
+                await asyncio.sleep(wait)
+                continue
+            try:
+                return await call()
+            except ProviderThrottled as e:
+                attempt += 1
+                if attempt > max_retries:
+                    raise
+                logger.warning(
+                    f"{notification_type} provider throttled us, backing off {e.retry_after}s"
+                )
+                self.backoff(notification_type, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
+    def backoff(self, notification_type, seconds):
+        """
+        A provider throttled us anyway - stop sending this type for `seconds`
+
+        Drains the type's bucket so every other send of that type waits too.
+        The caller still sleeps it off itself (there may be no bucket).
+        """
+        RATE_LIMIT_PROVIDER_THROTTLES.labels(channel=notification_type).inc()
+        with self._lock:
+            bucket = self._channels.get(notification_type)
+            if bucket is not None:
+                bucket.drain(seconds)
+
+    def _buckets(self, notification_type, tenant):
+        """The (scope, bucket) pairs a send has to get through - caller holds the lock"""
+        buckets = []
+        if notification_type in self._channels:
+            buckets.append(("channel", self._channels[notification_type]))
+        if tenant is not None and notification_type in self.tenant_limits:
+            key = (notification_type, tenant)
+            bucket = self._tenants.pop(key, None)
+            if bucket is None:
+                rate, burst = self.tenant_limits[notification_type]
+                bucket = TokenBucket(rate, burst, self.clock)
+            # Re-insert so the dict stays ordered by last use
+            self._tenants[key] = bucket
+            while len(self._tenants) > self.max_tenants:
+                # Forgetting an idle tenant just gives them a fresh (full) bucket
+                del self._tenants[next(iter(self._tenants))]
+            buckets.append(("tenant", bucket))
+        return buckets
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,26 @@
+"""
+Rebuild the per-user notification counters from the notifications themselves
+
+Run it on a schedule (cron, k8s CronJob) to clean up any drift, or by hand
+for a few users:
+
+    python reconcile_counters.py            # everyone
+    python reconcile_counters.py 123 456    # just these users
+"""
+
+import logging
+import sys
+from database import reconcile_notification_counters
+from config import LOG_LEVEL
+
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL),
+    format="%(levelname)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    user_ids = [int(user_id) for user_id in sys.argv[1:]] or None
+    rewritten = reconcile_notification_counters(user_ids)
+    logger.info(f"Reconciled notification counters for {rewritten} user(s)")
@@ -0,0 +1,305 @@
+"""Delayed retries with exponential backoff, and the dead-letter queue behind them."""
+
+import datetime
+import json
+import logging
+import random
+import pika
+from prometheus_client import Counter
+from publisher import get_rabbitmq_connection
+from config import (
+    RABBITMQ_QUEUE,
+    RABBITMQ_RETRY_EXCHANGE,
+    RABBITMQ_DEAD_LETTER_QUEUE,
+    RETRY_ENABLED,
+    RETRY_MAX_ATTEMPTS,
+    RETRY_BASE_DELAY_MS,
+    RETRY_MAX_DELAY_MS,
+    RETRY_JITTER,
+    DEAD_LETTER_LIST_MAX,
+)
+
+logger = logging.getLogger(__name__)
+
+RETRIES_SCHEDULED = Counter(
+    "notification_retries_total", "Messages sent to a delay queue", ["attempt"]
+)
+DEAD_LETTERED = Counter(
+    "notification_dead_letters_total", "Messages that ran out of retries"
+)
+DEAD_LETTERS_REPLAYED = Counter(
+    "notification_dead_letters_replayed_total", "Dead letters put back on the main queue"
+)
+
+ATTEMPT_HEADER = "x-attempt"
+
+
+def delay_queue_name(attempt, queue=RABBITMQ_QUEUE):
+    return f"{queue}.retry.{attempt}"
+
+
+def base_delay_ms(attempt, base=RETRY_BASE_DELAY_MS, cap=RETRY_MAX_DELAY_MS):
+    """1s, 2s, 4s, ... for attempts 1, 2, 3, ... (capped)"""
+    return min(cap, base * 2 ** (attempt - 1))
+
+
+def backoff_delay_ms(attempt, jitter=RETRY_JITTER):
+    """The base delay for an attempt, spread by +/- jitter so retries don't stampede"""
+    return int(base_delay_ms(attempt) * (1 - jitter + 2 * jitter * random.random()))
+
+
+def retry_topology(queue=RABBITMQ_QUEUE, max_attempts=RETRY_MAX_ATTEMPTS):
+    """
+    The exchange, delay queues and dead-letter queue, in declaration order
+
+    One delay queue per attempt. Each dead-letters back into `queue` when a
+    message expires. The delay is only ever the message's own expiration:
+    a queue TTL would be derived from the retry settings, and redeclaring a
+    queue with different arguments fails with PRECONDITION_FAILED, so
+    changing RETRY_BASE_DELAY_MS would take every consumer down. Keeping the
+    attempts in separate queues means a short delay never waits behind a
+    long one (RabbitMQ only expires messages at the head of a queue).
+
+    Same (channel method name, kwargs) shape as publisher.topology_declarations
+    """
+    declarations = [
+        (
+            "exchange_declare",
+            {
+                "exchange": RABBITMQ_RETRY_EXCHANGE,
+                "exchange_type": "direct",
+                "durable": True,
+            },
+        )
+    ]
+    for attempt in range(1, max_attempts + 1):
+        name = delay_queue_name(attempt, queue)
+        declarations.append(
+            (
+                "queue_declare",
+                {
+                    "queue": name,
+                    "durable": True,
+                    "arguments": {
+                        "x-dead-letter-exchange": "",
+                        "x-dead-letter-routing-key": queue,
+                    },
+                },
+            )
+        )
+        declarations.append(
+            (
+                "queue_bind",
+                {"queue": name, "exchange": RABBITMQ_RETRY_EXCHANGE, "routing_key": name},
+            )
+        )
+    declarations.append(
+        ("queue_declare", {"queue": RABBITMQ_DEAD_LETTER_QUEUE, "durable": True})
+    )
+    declarations.append(
+        (
+            "queue_bind",
+            {
+                "queue": RABBITMQ_DEAD_LETTER_QUEUE,
+                "exchange": RABBITMQ_RETRY_EXCHANGE,
+                "routing_key": RABBITMQ_DEAD_LETTER_QUEUE,
+            },
+        )
+    )
+    return declarations
+
+
+def declare_retry_topology(channel, queue=RABBITMQ_QUEUE):
+    """
+    Declare everything from retry_topology on a pika channel
+
+    Also puts the channel in confirm mode, so schedule_retry's publish is
+    confirmed by the broker before the original gets acked
+    """
+    for method_name, kwargs in retry_topology(queue):
+        getattr(channel, method_name)(**kwargs)
+    channel.confirm_delivery()
+
+
+def plan_retry(
+    headers,
+    error,
+    queue=RABBITMQ_QUEUE,
+    max_attempts=RETRY_MAX_ATTEMPTS,
+    count_attempt=True,
+):
+    """
+    Work out where a failed message goes next
+
+    count_attempt=False is for "not now" rather than "that failed" (another
+    consumer is mid-send): it waits again at the current attempt's delay
+    without using one up
+
+    Returns:
+        tuple: (routing key on the retry exchange, new headers, expiration
+        in ms or None for the dead-letter queue)
+    """
+    headers = dict(headers or {})
+    attempt = int(headers.get(ATTEMPT_HEADER, 0))
+    attempt = attempt + 1 if count_attempt else max(attempt, 1)
+    headers["x-last-error"] = str(error)[:500]
+
+    if attempt > max_attempts:
+        headers["x-dead-at"] = datetime.datetime.now().isoformat()
+        headers["x-original-queue"] = queue
+        DEAD_LETTERED.inc()
+        return RABBITMQ_DEAD_LETTER_QUEUE, headers, None
+
+    headers[ATTEMPT_HEADER] = attempt
+    RETRIES_SCHEDULED.labels(attempt=str(attempt)).inc()
+    return delay_queue_name(attempt, queue), headers, backoff_delay_ms(attempt)
+
+
+def schedule_retry(
+    ch,
+    method,
+    properties,
+    body,
+    error,
+    ack=True,
+    queue=RABBITMQ_QUEUE,
+    count_attempt=True,
+):
+    """
+    Take a failed delivery off the main queue and try it again later
+
+    Replaces basic_nack(requeue=True): the message goes to the next delay
+    queue (or the dead-letter queue once it's out of attempts) and the
+    original is acked. The channel is in confirm mode (declare_retry_topology),
+    so the publish is confirmed before the ack goes out. If the broker
+    refuses it, the original is nacked back onto its queue instead, the way
+    replay_dead_letters does it. Pass ack=False when the caller acks a whole
+    batch itself, and count_attempt=False to just postpone it.
+    """
+    if not RETRY_ENABLED:
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        return
+
+    routing_key, headers, expiration = plan_retry(
+        getattr(properties, "headers", None), error, queue, count_attempt=count_attempt
+    )
+    try:
+        ch.basic_publish(
+            exchange=RABBITMQ_RETRY_EXCHANGE,
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+                headers=headers,
+                expiration=str(expiration) if expiration is not None else None,
+            ),
+            mandatory=True,
+        )
+    except (pika.exceptions.UnroutableError, pika.exceptions.NackError) as e:
+        # The retry never made it anywhere - keep the original rather than
+        # ack it away
+        logger.error(f"Broker refused a retry, requeueing the message: {str(e)}")
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        return
+    if routing_key == RABBITMQ_DEAD_LETTER_QUEUE:
+        logger.error(f"Message gave up after {RETRY_MAX_ATTEMPTS} attempts: {error}")
+    else:
+        logger.warning(
+            f"Retrying message (attempt {headers[ATTEMPT_HEADER]}) in {expiration}ms: {error}"
+        )
+    if ack:
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+def describe_dead_letter(properties, body):
+    """A dead letter as the API shows it"""
+    headers = properties.headers or {}
+    try:
+        notification = json.loads(body)
+    except ValueError:
+        notification = body.decode("utf-8", errors="replace")
+    return {
+        "notification": notification,
+        "attempts": headers.get(ATTEMPT_HEADER, 0),
+        "error": headers.get("x-last-error"),
+        "dead_at": headers.get("x-dead-at"),
+    }
+
+
+def list_dead_letters(limit=100, connection_factory=get_rabbitmq_connection):
+    """
+    Peek at the oldest dead letters without taking them off the queue
+
+    Messages are fetched unacked and handed back when the connection
+    closes, so they stay where they were
+    """
+    limit = min(limit, DEAD_LETTER_LIST_MAX)
+    connection = connection_factory()
+    try:
+        channel = connection.channel()
+        total = channel.queue_declare(
+            queue=RABBITMQ_DEAD_LETTER_QUEUE, durable=True
+        ).method.message_count
+        dead_letters = []
+        for _ in range(limit):
+            method, properties, body = channel.basic_get(
+                RABBITMQ_DEAD_LETTER_QUEUE, auto_ack=False
+            )
+            if method is None:
+                break
+            dead_letters.append(describe_dead_letter(properties, body))
+        return total, dead_letters
+    finally:
+        connection.close()
+
+
+def replay_dead_letters(
+    limit=100, queue=RABBITMQ_QUEUE, connection_factory=get_rabbitmq_connection
+):
+    """
+    Move up to `limit` dead letters back onto their queue for a fresh start
+
+    That's the priority lane queue they gave up on (x-original-queue), or
+    `queue` for messages that don't say.
+
+    Each one is published with confirms before it's acked off the
+    dead-letter queue, so a crash halfway can duplicate but never lose
+    messages. Returns how many were replayed.
+    """
+    connection = connection_factory()
+    replayed = 0
+    try:
+        channel = connection.channel()
+        channel.queue_declare(queue=RABBITMQ_DEAD_LETTER_QUEUE, durable=True)
+        channel.confirm_delivery()
+        for _ in range(limit):
+            method, properties, body = channel.basic_get(
+                RABBITMQ_DEAD_LETTER_QUEUE, auto_ack=False
+            )
+            if method is None:
+                break
+            # Start the attempt count over, but keep the history around
+            headers = {
+                key: value
+                for key, value in (properties.headers or {}).items()
+                if key != ATTEMPT_HEADER
+            }
+            headers["x-replayed-at"] = datetime.datetime.now().isoformat()
+            try:
+                channel.basic_publish(
+                    exchange="",
+                    routing_key=headers.get("x-original-queue", queue),
+                    body=body,
+                    properties=pika.BasicProperties(delivery_mode=2, headers=headers),
+                    mandatory=True,
+                )
+            except (pika.exceptions.UnroutableError, pika.exceptions.NackError) as e:
+                logger.error(f"Replay stopped, broker refused a message: {str(e)}")
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                break
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            replayed += 1
+    finally:
+        DEAD_LETTERS_REPLAYED.inc(replayed)
+        connection.close()
+    return replayed
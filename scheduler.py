@@ -0,0 +1,250 @@
+"""
+Scheduler: publishes notifications booked with send_at once they're due
+
+Rather than asking Mongo about every notification, each poll claims
+everything due within the next SCHEDULER_LOOKAHEAD_SECONDS in batches (one
+indexed range query on due_at) and holds it in a min-heap keyed on firing
+time. The loop sleeps until the earlier of the next firing time and the
+next poll, so firing is accurate to well under a second while Mongo sees a
+couple of queries per poll, however many millions of notifications are
+booked further out. Each notification fires at its send_at plus a random
+0-SCHEDULER_JITTER_SECONDS, so a burst booked for the top of the hour
+reaches the queue spread out instead of all in one go.
+
+Run as many as you like: claims keep them from publishing the same
+notification twice, and a scheduler that dies leaves its claims to run out
+for the others to pick up.
+"""
+
+import datetime
+import heapq
+import itertools
+import logging
+import random
+import signal
+import time
+import warnings
+from prometheus_client import Counter, Gauge, Histogram
+from database import (
+    claim_due_notifications,
+    mark_scheduled_published,
+    release_scheduled_notifications,
+    content_fields,
+    tenant_fields,
+)
+from lanes import get_lane
+from metrics import start_metrics_server
+from publisher import get_publisher
+from config import (
+    LOG_LEVEL,
+    SCHEDULER_LOOKAHEAD_SECONDS,
+    SCHEDULER_POLL_INTERVAL,
+    SCHEDULER_BATCH_SIZE,
+    SCHEDULER_MAX_PENDING,
+    SCHEDULER_JITTER_SECONDS,
+    SCHEDULER_LEASE_SECONDS,
+)
+
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+warnings.filterwarnings("ignore", category=UserWarning)
+
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL),
+    format="%(levelname)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+SCHEDULED_PUBLISHED = Counter(
+    "scheduled_notifications_published_total", "Scheduled notifications published"
+)
+SCHEDULED_LATENESS = Histogram(
+    "scheduled_notification_lateness_seconds",
+    "How long after its send_at a scheduled notification was published (jitter included)",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+SCHEDULER_HELD = Gauge(
+    "scheduler_held_notifications", "Claimed notifications waiting in memory for their time"
+)
+
+
+def scheduled_message(document, published):
+    """
+    The queue message for a scheduled notification
+
+    "received" is its send_at, so end-to-end latency counts from when it
+    was meant to go out, and the publish stage is how late the scheduler was
+    """
+    return {
+        "id": str(document["_id"]),
+        "user_id": document["user_id"],
+        "type": document["type"],
+        **content_fields(document),
+        **tenant_fields(document),
+        "timestamps": {"received": document["send_at"].timestamp(), "published": published},
+    }
+
+
+def lane_queue(priority):
+    """The queue for a stored priority - the default lane if that lane's gone since"""
+    try:
+        return get_lane(priority).queue
+    except ValueError:
+        logger.warning(f"Lane {priority} no longer exists, using the default lane")
+        return get_lane().queue
+
+
+class Scheduler:
+    """
+    Claimed notifications in a min-heap on firing time, topped up every poll
+
+    At most `max_held` are held at once; past that, the rest of the window
+    waits in Mongo (in due order) for the next poll.
+    """
+
+    def __init__(
+        self,
+        publisher=None,
+        lookahead=SCHEDULER_LOOKAHEAD_SECONDS,
+        poll_interval=SCHEDULER_POLL_INTERVAL,
+        batch_size=SCHEDULER_BATCH_SIZE,
+        max_held=SCHEDULER_MAX_PENDING,
+        jitter=SCHEDULER_JITTER_SECONDS,
+        lease=SCHEDULER_LEASE_SECONDS,
+        clock=time.time,
+    ):
+        self.publisher = publisher
+        self.lookahead = lookahead
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_held = max_held
+        self.jitter = jitter
+        self.lease = lease
+        self.clock = clock
+        self._heap = []  # (fire_at, sequence, document, claim token)
+        self._sequence = itertools.count()
+        self._next_poll = 0
+        self.stopping = False
+
+    def __len__(self):
+        return len(self._heap)
+
+    def poll(self, now):
+        """Claim what's due before now + lookahead, batch by batch. Returns how many."""
+        horizon = datetime.datetime.fromtimestamp(now + self.lookahead)
+        # Long enough to publish everything in the window before anyone else may
+        lease_until = horizon + datetime.timedelta(seconds=self.lease)
+        loaded = 0
+        while len(self._heap) < self.max_held:
+            limit = min(self.batch_size, self.max_held - len(self._heap))
+            documents, token = claim_due_notifications(horizon, lease_until, limit)
+            for document in documents:
+                fire_at = max(document["send_at"].timestamp(), now)
+                fire_at += random.uniform(0, self.jitter)
+                heapq.heappush(self._heap, (fire_at, next(self._sequence), document, token))
+            loaded += len(documents)
+            if len(documents) < limit:
+                break
+        SCHEDULER_HELD.set(len(self._heap))
+        return loaded
+
+    def fire(self, now):
+        """Publish everything whose time has come, one publish_many per lane. Returns how many."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+        if not due:
+            return 0
+
+        lanes = {}
+        for entry in due:
+            lanes.setdefault(lane_queue(entry[2].get("priority")), []).append(entry)
+
+        published_count = 0
+        for queue, entries in lanes.items():
+            published = time.time()
+            messages = [scheduled_message(document, published) for _, _, document, _ in entries]
+            try:
+                errors = self.publisher.publish_many(messages, queue)
+            except Exception as e:
+                errors = [str(e)] * len(messages)
+
+            published_by_token = {}
+            for entry, error in zip(entries, errors):
+                _, _, document, token = entry
+                if error:
+                    # Try again next time round
+                    logger.warning(
+                        f"Publishing scheduled notification {document['_id']} failed: {error}"
+                    )
+                    heapq.heappush(
+                        self._heap,
+                        (now + self.poll_interval, next(self._sequence), document, token),
+                    )
+                    continue
+                published_by_token.setdefault(token, []).append(document)
+                SCHEDULED_LATENESS.observe(max(0.0, published - document["send_at"].timestamp()))
+
+            for token, documents in published_by_token.items():
+                # A dedup consumer that gets in before this sees "scheduled"
+                # and postpones the message rather than dropping it. If this
+                # fails the claim runs out and they're published again
+                mark_scheduled_published(documents, token)
+                SCHEDULED_PUBLISHED.inc(len(documents))
+                published_count += len(documents)
+
+        SCHEDULER_HELD.set(len(self._heap))
+        return published_count
+
+    def release(self):
+        """Hand back everything still held, so another scheduler can have it straight away"""
+        by_token = {}
+        for _, _, document, token in self._heap:
+            by_token.setdefault(token, []).append(document["_id"])
+        for token, notification_ids in by_token.items():
+            release_scheduled_notifications(notification_ids, token)
+        self._heap.clear()
+        SCHEDULER_HELD.set(0)
+
+    def run(self, sleep=time.sleep):
+        """Poll, fire, sleep until the next thing to do - until `stopping` is set"""
+        while not self.stopping:
+            now = self.clock()
+            try:
+                if now >= self._next_poll:
+                    self.poll(now)
+                    self._next_poll = now + self.poll_interval
+                self.fire(self.clock())
+            except Exception as e:
+                # Mongo or the broker hiccuped - claims keep everything safe meanwhile
+                logger.error(f"Scheduler round failed: {str(e)}")
+                self._next_poll = now + self.poll_interval
+
+            wake = self._next_poll
+            if self._heap:
+                wake = min(wake, self._heap[0][0])
+            sleep(max(0.0, wake - self.clock()))
+
+        self.release()
+
+
+def start_scheduler():
+    """Publish scheduled notifications as they come due, until SIGTERM"""
+    start_metrics_server()
+    scheduler = Scheduler(get_publisher())
+
+    def stop(signum, frame):
+        scheduler.stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+
+    logger.info("⏰ Notification scheduler is awake and watching the clock...")
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        scheduler.release()
+
+    get_publisher().close()
+
+
+if __name__ == "__main__":
+    start_scheduler()
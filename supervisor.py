@@ -0,0 +1,230 @@
+import logging
+import math
+import multiprocessing
+import signal
+import time
+import warnings
+import pika
+from lanes import LANES
+from publisher import get_rabbitmq_connection
+from config import (
+    LOG_LEVEL,
+    CONSUMER_ENGINE,
+    CONSUMER_WORKERS,
+    CONSUMER_MIN_WORKERS,
+    CONSUMER_MAX_WORKERS,
+    CONSUMER_AUTOSCALE,
+    CONSUMER_SCALE_INTERVAL,
+    CONSUMER_MESSAGES_PER_WORKER,
+    CONSUMER_METRICS_PORT,
+)
+
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+warnings.filterwarnings("ignore", category=UserWarning)
+
+logging.basicConfig(
+    level=getattr(logging, LOG_LEVEL),
+    format="%(levelname)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# Don't restart a crashing worker more often than this (seconds)
+RESTART_DELAY = 1.0
+
+
+def desired_worker_count(
+    queue_depth,
+    minimum=CONSUMER_MIN_WORKERS,
+    maximum=CONSUMER_MAX_WORKERS,
+    messages_per_worker=CONSUMER_MESSAGES_PER_WORKER,
+):
+    """
+    How many consumers the backlog calls for
+
+    One worker per `messages_per_worker` waiting messages, kept between
+    `minimum` and `maximum`
+    """
+    wanted = math.ceil(queue_depth / max(messages_per_worker, 1))
+    return max(minimum, min(maximum, wanted))
+
+
+def get_queue_depth(queues=None):
+    """
+    Ask RabbitMQ how many messages are waiting across every priority lane
+    (passive declares, no side effects)
+
+    Messages in the retry delay queues don't count - nobody can work on
+    them until they're back in their lane
+    """
+    queues = [lane.queue for lane in LANES] if queues is None else queues
+    connection = get_rabbitmq_connection()
+    try:
+        depth = 0
+        channel = connection.channel()
+        for queue in queues:
+            try:
+                result = channel.queue_declare(queue=queue, durable=True, passive=True)
+            except pika.exceptions.ChannelClosedByBroker:
+                # Not declared yet (no consumer has started) - nothing waiting there
+                channel = connection.channel()
+                continue
+            depth += result.method.message_count
+        return depth
+    finally:
+        connection.close()
+
+
+def _stop_on_sigterm(signum, frame):
+    # The consumers already clean up on KeyboardInterrupt
+    raise KeyboardInterrupt
+
+
+def run_worker(engine=CONSUMER_ENGINE, metrics_port=None):
+    """
+    Body of each child process
+
+    The consumer modules are imported here, after the fork, so every child
+    builds its own Mongo and RabbitMQ clients. metrics_port is the worker's
+    own /metrics port.
+    """
+    signal.signal(signal.SIGTERM, _stop_on_sigterm)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if engine == "async":
+        from async_consumer import start_async_consumer
+
+        start_async_consumer(metrics_port=metrics_port)
+    else:
+        from consumer import start_consumer
+
+        try:
+            start_consumer(metrics_port=metrics_port)
+        except KeyboardInterrupt:
+            pass
+
+
+class ConsumerSupervisor:
+    """
+    Runs N consumer processes on one box and keeps them running
+
+    - restarts children that die
+    - optionally grows/shrinks the pool with the queue depth
+    - passes SIGTERM on to every child when it's time to go
+
+    Each worker has a slot (0, 1, ...) and serves /metrics on
+    CONSUMER_METRICS_PORT + slot. A restarted worker takes the lowest free
+    slot, so the ports Prometheus scrapes stay put.
+    """
+
+    def __init__(
+        self,
+        workers=CONSUMER_WORKERS,
+        autoscale=CONSUMER_AUTOSCALE,
+        scale_interval=CONSUMER_SCALE_INTERVAL,
+        target=run_worker,
+        metrics_port=CONSUMER_METRICS_PORT,
+    ):
+        self.target_workers = max(1, workers)
+        self.autoscale = autoscale
+        self.scale_interval = scale_interval
+        self.target = target
+        self.metrics_port = metrics_port
+        self.workers = []
+        self._running = False
+        self._last_scale_check = 0.0
+
+    def spawn(self):
+        taken = {process.slot for process in self.workers}
+        slot = next(slot for slot in range(len(self.workers) + 1) if slot not in taken)
+        # 0 turns metrics off for every worker
+        metrics_port = self.metrics_port + slot if self.metrics_port else 0
+        process = multiprocessing.Process(
+            target=self.target, kwargs={"metrics_port": metrics_port}, daemon=False
+        )
+        process.slot = slot
+        process.start()
+        self.workers.append(process)
+        logger.info(
+            f"Started consumer worker pid={process.pid} (slot {slot}, metrics on :{metrics_port})"
+        )
+        return process
+
+    def reap(self):
+        """Replace any workers that have died since we last looked"""
+        alive = []
+        for process in self.workers:
+            if process.is_alive():
+                alive.append(process)
+            else:
+                logger.warning(
+                    f"Consumer worker pid={process.pid} exited with code {process.exitcode}"
+                )
+        restarted = len(self.workers) - len(alive)
+        self.workers = alive
+        return restarted
+
+    def scale_to(self, count):
+        """Start or stop workers until there are exactly `count`"""
+        while len(self.workers) < count:
+            self.spawn()
+        while len(self.workers) > count:
+            # Newest first - the old ones have warm caches
+            process = self.workers.pop()
+            logger.info(f"Scaling down, stopping worker pid={process.pid}")
+            process.terminate()
+            process.join(timeout=30)
+
+    def check_queue_depth(self):
+        try:
+            depth = get_queue_depth()
+        except Exception as e:
+            logger.warning(f"Could not read queue depth: {str(e)}")
+            return
+        wanted = desired_worker_count(depth)
+        if wanted != self.target_workers:
+            logger.info(
+                f"Queue depth {depth}: scaling from {self.target_workers} to {wanted} workers"
+            )
+            self.target_workers = wanted
+
+    def tick(self):
+        """One round of the supervision loop"""
+        if self.reap():
+            time.sleep(RESTART_DELAY)
+
+        now = time.monotonic()
+        if self.autoscale and now - self._last_scale_check >= self.scale_interval:
+            self._last_scale_check = now
+            self.check_queue_depth()
+
+        self.scale_to(self.target_workers)
+
+    def stop(self, *args):
+        self._running = False
+
+    def shutdown(self):
+        """SIGTERM every worker, give them time to drain, then make sure they're gone"""
+        for process in self.workers:
+            process.terminate()
+        for process in self.workers:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.kill()
+        self.workers = []
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self._running = True
+
+        logger.info(f"🔔 Supervising {self.target_workers} consumer worker(s)...")
+        try:
+            while self._running:
+                self.tick()
+                time.sleep(1)
+        finally:
+            self.shutdown()
+
+
+if __name__ == "__main__":
+    ConsumerSupervisor().run()
@@ -0,0 +1,135 @@
+"""Notification templates: sandboxed Jinja2, compiled once and kept in an LRU."""
+
+import threading
+import time
+from collections import OrderedDict
+from jinja2 import StrictUndefined, TemplateError, TemplateNotFound
+from jinja2.sandbox import SandboxedEnvironment
+from prometheus_client import Counter
+from config import TEMPLATE_CACHE_SIZE, TEMPLATE_CACHE_TTL_SECONDS
+
+TEMPLATE_CACHE_LOOKUPS = Counter(
+    "template_cache_lookups_total", "Compiled template lookups", ["result"]
+)
+TEMPLATE_RENDER_ERRORS = Counter(
+    "template_render_errors_total", "Notifications whose template couldn't be rendered"
+)
+
+# Templates come from API callers, so they only get the sandbox: no
+# attribute tricks, no imports. A variable the caller forgot is an error,
+# not an empty string in someone's email.
+environment = SandboxedEnvironment(undefined=StrictUndefined, autoescape=False)
+
+
+def compile_template(source):
+    """Compile template source - raises jinja2.TemplateSyntaxError if it's broken"""
+    return environment.from_string(source)
+
+
+class TemplateCache:
+    """
+    Compiled templates by id, with LRU and TTL eviction
+
+    Compiling is the expensive part of rendering, so each process does it
+    once per template and TTL. Edits to a template reach every process once
+    their entry expires.
+    """
+
+    def __init__(self, max_entries=TEMPLATE_CACHE_SIZE, ttl=TEMPLATE_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # template_id -> (expires_at, compiled)
+        self._lock = threading.Lock()
+
+    def lookup(self, template_id):
+        """The cached compiled template, or None if it has to be loaded"""
+        with self._lock:
+            entry = self._entries.get(template_id)
+            if entry is not None and entry[0] >= time.monotonic():
+                self._entries.move_to_end(template_id)
+                TEMPLATE_CACHE_LOOKUPS.labels(result="hit").inc()
+                return entry[1]
+            self._entries.pop(template_id, None)
+        TEMPLATE_CACHE_LOOKUPS.labels(result="miss").inc()
+        return None
+
+    def store(self, template_id, document):
+        """Compile a template document (or None for "no such template") and cache it"""
+        if document is None:
+            raise TemplateNotFound(template_id)
+        compiled = compile_template(document["content"])
+        with self._lock:
+            self._entries[template_id] = (time.monotonic() + self.ttl, compiled)
+            self._entries.move_to_end(template_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return compiled
+
+    def get(self, template_id, load):
+        """The compiled template, loading the document with load(template_id) on a miss"""
+        compiled = self.lookup(template_id)
+        if compiled is None:
+            compiled = self.store(template_id, load(template_id))
+        return compiled
+
+    async def get_async(self, template_id, load):
+        """get() with an async loader"""
+        compiled = self.lookup(template_id)
+        if compiled is None:
+            compiled = self.store(template_id, await load(template_id))
+        return compiled
+
+    def invalidate(self, template_id):
+        with self._lock:
+            self._entries.pop(template_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+template_cache = TemplateCache()
+
+
+def render(compiled, notification_data):
+    """
+    Fill in notification_data["content"] from its template
+
+    Raises TemplateError (missing variables, sandbox violations) after
+    counting it - those never work on a retry either
+    """
+    try:
+        notification_data["content"] = compiled.render(notification_data.get("variables") or {})
+    except TemplateError:
+        TEMPLATE_RENDER_ERRORS.inc()
+        raise
+    return notification_data
+
+
+def render_notification(notification_data, load, cache=template_cache):
+    """
+    Make sure a notification has its content, right before it's sent
+
+    Notifications that came with content are left alone. Templated ones are
+    rendered with their variables; `load` fetches the template document.
+    """
+    if notification_data.get("content") or not notification_data.get("template_id"):
+        return notification_data
+    try:
+        compiled = cache.get(notification_data["template_id"], load)
+    except TemplateError:
+        TEMPLATE_RENDER_ERRORS.inc()
+        raise
+    return render(compiled, notification_data)
+
+
+async def render_notification_async(notification_data, load, cache=template_cache):
+    """render_notification with an async loader (Motor)"""
+    if notification_data.get("content") or not notification_data.get("template_id"):
+        return notification_data
+    try:
+        compiled = await cache.get_async(notification_data["template_id"], load)
+    except TemplateError:
+        TEMPLATE_RENDER_ERRORS.inc()
+        raise
+    return render(compiled, notification_data)
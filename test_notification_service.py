@@ -1,11 +1,15 @@
 import unittest
+import asyncio
 import json
 import os
-from unittest.mock import patch, MagicMock
-from pymongo import MongoClient
+from unittest.mock import patch, MagicMock, AsyncMock, ANY
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ServerSelectionTimeoutError
 import sys
 import time
-from datetime import datetime
+import gzip
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
 from bson.objectid import ObjectId
 
 # Add the current directory to the path so that we can import our modules
@@ -13,17 +17,73 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from app import app
 from database import (
+    init_db,
     save_notification,
+    save_notifications,
     get_user_notifications,
+    get_user_notifications_page,
+    decode_cursor,
+    ensure_indexes,
+    check_query_coverage,
+    summarize_plan,
+    NOTIFICATION_INDEXES,
     update_notification_status,
+    update_notification_statuses,
+    persist_notifications,
+    get_notification_summary,
+    reconcile_notification_counters,
+    iter_user_notifications,
+    claim_notification,
+    claim_notifications,
+    save_template,
+    get_template,
+    templates_collection,
+    create_fanout_job,
+    get_fanout_job,
+    add_segment_members,
+    notifications_collection,
+    fanout_jobs_collection,
+    segment_members_collection,
+    message_to_document,
 )
 from notification_services import (
     get_notification_service,
     EmailNotificationService,
     SMSNotificationService,
     InAppNotificationService,
+    NotificationService,
+    ServiceRegistry,
 )
-from consumer import process_notification
+from consumer import process_notification, process_batch, consume_lanes, flush_digests
+from digest import DigestCoalescer
+from async_consumer import handle_message, AsyncConsumer
+from starlette.testclient import TestClient
+import asgi
+import async_database
+from async_publisher import AsyncPublisher
+from persister import persist_batch
+from dedup import recently_completed
+from lanes import Lane, parse_lanes, get_lane, WeightedScheduler
+from latency import stage_durations
+from templates import TemplateCache, template_cache
+from fanout import expand_job, audience_chunks
+from scheduler import Scheduler
+from publisher import PublishError
+from metrics import start_metrics_server
+from prometheus_client import REGISTRY
+from rate_limit import RateLimiter, ProviderThrottled, parse_rate_limits
+from retries import (
+    plan_retry,
+    retry_topology,
+    declare_retry_topology,
+    schedule_retry,
+    list_dead_letters,
+    replay_dead_letters,
+)
+from cache import inbox_cache, InboxCache, MemoryCacheBackend
+from supervisor import ConsumerSupervisor, desired_worker_count, get_queue_depth
+from publisher import RabbitMQPublisher, ConfirmingPublisher, PublishError
+import pika
 
 
 class TestNotificationService(unittest.TestCase):
@@ -36,11 +96,14 @@ class TestNotificationService(unittest.TestCase):
         cls.mongo_client = MongoClient("mongodb://localhost:27017/")
         cls.db = cls.mongo_client["notification_service_test"]
         cls.notifications_collection = cls.db["notifications"]
+        cls.counters_collection = cls.db["notification_counters"]
 
     def setUp(self):
         """Set up test case before each test"""
         # Clear the test collection before each test
         self.notifications_collection.delete_many({})
+        self.counters_collection.delete_many({})
+        inbox_cache.clear()
 
     @classmethod
     def tearDownClass(cls):
@@ -108,9 +171,313 @@ class TestNotificationService(unittest.TestCase):
         update_notification_status(notification_id, "delivered")
 
         # Assert
-        mock_collection.update_one.assert_called_once_with(
-            {"_id": ObjectId(notification_id)}, {"$set": {"status": "delivered"}}
+        mock_collection.find_one_and_update.assert_called_once_with(
+            {"_id": ObjectId(notification_id)},
+            {"$set": {"status": "delivered"}},
+            projection={"user_id": 1, "status": 1},
+            upsert=False,
+            return_document=ReturnDocument.BEFORE,
+        )
+
+    @patch("database.counters_collection")
+    @patch("database.notifications_collection")
+    def test_counters_follow_inserts_and_status_changes(
+        self, mock_collection, mock_counters
+    ):
+        """Test that saves and status updates keep the per-user counters in step"""
+        # Setup
+        notification_id = ObjectId("60f8f1b3c2d7a8f9e1d2c3b4")
+        mock_collection.insert_one.return_value.inserted_id = notification_id
+        mock_collection.find_one_and_update.return_value = {
+            "_id": notification_id,
+            "user_id": 123,
+            "status": "pending",
+        }
+
+        # Execute
+        save_notification(123, "email", "Test content")
+        update_notification_status(str(notification_id), "delivered")
+
+        # Assert
+        inserted, changed = [
+            call[0][0][0] for call in mock_counters.bulk_write.call_args_list
+        ]
+        self.assertEqual(inserted._filter, {"_id": 123})
+        self.assertTrue(inserted._upsert)
+        self.assertEqual(inserted._doc["$inc"], {"status.pending": 1, "type.email": 1})
+        self.assertEqual(
+            changed._doc["$inc"], {"status.pending": -1, "status.delivered": 1}
+        )
+
+    @patch("database.STATUS_UPSERT", True)
+    def test_consumer_ahead_of_the_persister_counts_the_record_once(self):
+        """Test that a write-behind record the consumer creates is counted without reconciliation"""
+        # Setup
+        messages = {
+            str(ObjectId()): {"user_id": 123, "type": "email", "content": "Test content"},
+            str(ObjectId()): {"user_id": 123, "type": "sms", "content": "Test content"},
+        }
+        for notification_id, message in messages.items():
+            message.update(id=notification_id, created_at=datetime.now().isoformat())
+        first, second = messages
+
+        with patch("database.notifications_collection", self.notifications_collection), patch(
+            "database.counters_collection", self.counters_collection
+        ):
+            # Execute - claimed and delivered, or just failed, before the persister ran
+            claim_notifications([first], notifications=messages)
+            update_notification_statuses({first: "delivered"}, messages)
+            update_notification_status(second, "failed", messages[second])
+            persist_notifications(
+                [message_to_document(message) for message in messages.values()]
+            )
+
+        # Assert
+        counters = self.counters_collection.find_one({"_id": 123})
+        self.assertEqual(
+            {key: value for key, value in counters["status"].items() if value},
+            {"delivered": 1, "failed": 1},
+        )
+        self.assertEqual(counters["type"], {"email": 1, "sms": 1})
+        stored = self.notifications_collection.find_one({"_id": ObjectId(first)})
+        self.assertEqual(stored["status"], "delivered")
+        self.assertEqual(stored["content"], "Test content")
+
+    @patch("database.STATUS_UPSERT", True)
+    @patch("database.notifications_collection")
+    def test_status_upsert_that_races_the_persister_retries_as_an_update(self, mock_collection):
+        """Test the sync status write survives a duplicate key from beating the persister"""
+        # Setup
+        mock_collection.find_one_and_update.side_effect = [
+            DuplicateKeyError("raced the persister"),
+            None,
+        ]
+
+        # Execute
+        update_notification_status("60f8f1b3c2d7a8f9e1d2c3b4", "delivered")
+
+        # Assert
+        first, retry = mock_collection.find_one_and_update.call_args_list
+        self.assertTrue(first[1]["upsert"])
+        self.assertNotIn("upsert", retry[1])
+
+    @patch("database.counters_collection")
+    @patch("database.notifications_collection")
+    def test_reconcile_notification_counters(self, mock_collection, mock_counters):
+        """Test that reconciliation rewrites counters from an aggregation"""
+        # Setup
+        mock_collection.aggregate.return_value = [
+            {"_id": {"user_id": 123, "status": "pending", "type": "email"}, "count": 2},
+            {"_id": {"user_id": 123, "status": "delivered", "type": "sms"}, "count": 1},
+        ]
+
+        # Execute
+        rewritten = reconcile_notification_counters([123, 456])
+
+        # Assert
+        self.assertEqual(rewritten, 2)
+        operations = mock_counters.bulk_write.call_args[0][0]
+        self.assertEqual(
+            operations[0]._doc["$set"]["status"], {"pending": 2, "delivered": 1}
+        )
+        self.assertEqual(operations[0]._doc["$set"]["type"], {"email": 2, "sms": 1})
+        self.assertEqual(operations[1]._filter, {"_id": 456})
+        self.assertEqual(operations[1]._doc["$set"]["status"], {})
+
+    @patch("database.counters_collection")
+    def test_notification_summary_api(self, mock_counters):
+        """Test the badge count endpoint reads the counters document"""
+        # Setup
+        mock_counters.find_one.return_value = {
+            "_id": 123,
+            "status": {"pending": 2, "delivered": 5, "failed": -1},
+            "type": {"email": 4, "sms": 3},
+        }
+
+        # Execute
+        response = self.app.get("/users/123/notifications/summary")
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        response_data = json.loads(response.data)
+        self.assertEqual(response_data["user_id"], 123)
+        self.assertEqual(response_data["total"], 7)
+        self.assertEqual(response_data["by_status"]["failed"], 0)
+        self.assertEqual(response_data["by_type"], {"email": 4, "sms": 3})
+        mock_counters.find_one.assert_called_once_with({"_id": 123})
+
+    @patch("database.notifications_collection")
+    def test_iter_user_notifications(self, mock_collection):
+        """Test that the export walks a batched cursor and closes it"""
+        # Setup
+        mock_sorted = mock_collection.find.return_value.sort.return_value
+        mock_cursor = mock_sorted.batch_size.return_value
+        mock_cursor.__iter__.return_value = [
+            {
+                "_id": ObjectId("60f8f1b3c2d7a8f9e1d2c3b4"),
+                "type": "email",
+                "content": "Test content",
+                "status": "delivered",
+                "created_at": datetime(2023, 7, 22, 15, 30),
+            }
+        ]
+
+        # Execute
+        result = list(
+            iter_user_notifications(123, start=datetime(2023, 7, 1), batch_size=500)
+        )
+
+        # Assert
+        self.assertEqual(result[0]["id"], "60f8f1b3c2d7a8f9e1d2c3b4")
+        self.assertEqual(result[0]["created_at"], "2023-07-22T15:30:00")
+        mock_collection.find.assert_called_once_with(
+            {"user_id": 123, "created_at": {"$gte": datetime(2023, 7, 1)}}
+        )
+        mock_sorted.batch_size.assert_called_once_with(500)
+        mock_cursor.close.assert_called_once()
+
+    def test_export_user_notifications_api(self):
+        """Test the NDJSON export, plain and gzipped"""
+        # Setup
+        records = [
+            {"id": str(i), "type": "email", "status": "delivered"} for i in range(3)
+        ]
+        with patch("app.iter_user_notifications") as mock_iter:
+            mock_iter.side_effect = lambda *args: iter(records)
+
+            # Execute
+            plain = self.app.get(
+                "/users/123/notifications/export?from=2023-07-01&to=2023-08-01"
+            )
+            zipped = self.app.get("/users/123/notifications/export?format=gzip")
+
+            # Assert
+            self.assertEqual(plain.status_code, 200)
+            self.assertEqual(plain.mimetype, "application/x-ndjson")
+            lines = plain.data.decode("utf-8").splitlines()
+            self.assertEqual([json.loads(line) for line in lines], records)
+            mock_iter.assert_any_call(123, datetime(2023, 7, 1), datetime(2023, 8, 1))
+
+            self.assertEqual(zipped.mimetype, "application/gzip")
+            self.assertEqual(gzip.decompress(zipped.data), plain.data)
+
+        response = self.app.get("/users/123/notifications/export?from=yesterday")
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_accepts_mixed_timezone_bounds(self):
+        """Test an offset-aware from and a naive to are both compared as local time"""
+        with patch("app.iter_user_notifications") as mock_iter:
+            mock_iter.side_effect = lambda *args: iter([])
+
+            # Execute
+            response = self.app.get(
+                "/users/123/notifications/export?from=2024-01-01T00:00:00%2B00:00&to=2024-02-01"
+            )
+            backwards = self.app.get(
+                "/users/123/notifications/export?from=2024-03-01T00:00:00Z&to=2024-02-01"
+            )
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        start, end = mock_iter.call_args[0][1:]
+        self.assertIsNone(start.tzinfo)
+        self.assertEqual(
+            start, datetime(2024, 1, 1, tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
         )
+        self.assertEqual(end, datetime(2024, 2, 1))
+        self.assertEqual(backwards.status_code, 400)
+        self.assertIn("earlier", backwards.get_json()["error"])
+
+    def test_claim_notification_transitions(self):
+        """Test pending -> sending claims, live leases and finished notifications"""
+        # Setup
+        notification_id = self.notifications_collection.insert_one(
+            {"user_id": 123, "type": "email", "content": "Test", "status": "pending"}
+        ).inserted_id
+
+        with patch("database.notifications_collection", self.notifications_collection):
+            # Execute / Assert - first claim wins, a second one sees the lease
+            self.assertEqual(claim_notification(str(notification_id)), "claimed")
+            self.assertEqual(
+                self.notifications_collection.find_one({"_id": notification_id})["status"],
+                "sending",
+            )
+            self.assertEqual(claim_notification(str(notification_id)), "in_flight")
+
+            # A lease that has run out can be taken over
+            self.notifications_collection.update_one(
+                {"_id": notification_id},
+                {"$set": {"lease_until": datetime.now() - timedelta(seconds=1)}},
+            )
+            self.assertEqual(claim_notification(str(notification_id)), "claimed")
+
+            # Once it has a final status, it's a duplicate
+            self.notifications_collection.update_one(
+                {"_id": notification_id}, {"$set": {"status": "delivered"}}
+            )
+            self.assertEqual(
+                claim_notifications([str(notification_id)]),
+                {str(notification_id): "duplicate"},
+            )
+
+    @patch("consumer.DEDUP_ENABLED", True)
+    @patch("consumer.release_notifications")
+    @patch("consumer.claim_notification")
+    @patch("consumer.update_notification_status")
+    @patch("consumer.get_notification_service")
+    def test_process_notification_skips_duplicates(
+        self, mock_get_service, mock_update_status, mock_claim, mock_release
+    ):
+        """Test that redeliveries are acked without calling the provider"""
+        # Setup
+        recently_completed.clear()
+        mock_service = MagicMock()
+        mock_get_service.return_value = mock_service
+        mock_channel = MagicMock()
+        method = MagicMock()
+        method.delivery_tag = "test_tag"
+        body = json.dumps(
+            {
+                "id": "60f8f1b3c2d7a8f9e1d2c3b4",
+                "user_id": 123,
+                "type": "email",
+                "content": "Test content",
+            }
+        ).encode("utf-8")
+
+        # Execute - already delivered according to Mongo
+        mock_claim.return_value = "duplicate"
+        process_notification(mock_channel, method, None, body)
+
+        # Assert
+        mock_service.send.assert_not_called()
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag="test_tag")
+
+        # Execute - now it's in the recent set, Mongo isn't even asked
+        process_notification(mock_channel, method, None, body)
+
+        # Assert
+        mock_claim.assert_called_once()
+        self.assertEqual(mock_channel.basic_ack.call_count, 2)
+
+        # Execute - someone else is mid-send on a different notification
+        recently_completed.clear()
+        mock_claim.return_value = "in_flight"
+        process_notification(mock_channel, method, None, body)
+
+        # Assert - postponed at the same attempt, not nacked
+        retry = mock_channel.basic_publish.call_args[1]
+        self.assertEqual(retry["routing_key"], "notifications.retry.1")
+        mock_service.send.assert_not_called()
+
+        # Execute - claimed, but the provider blows up
+        mock_claim.return_value = "claimed"
+        mock_service.send.side_effect = RuntimeError("provider down")
+        process_notification(mock_channel, method, None, body)
+
+        # Assert - claim handed back for the retry
+        mock_release.assert_called_once_with(["60f8f1b3c2d7a8f9e1d2c3b4"])
+        mock_update_status.assert_not_called()
 
     def test_get_notification_service(self):
         """Test notification service factory method"""
@@ -198,7 +565,7 @@ class TestNotificationService(unittest.TestCase):
         mock_get_service.assert_called_once_with("email")
         mock_service.send.assert_called_once_with(123, "Test content")
         mock_update_status.assert_called_once_with(
-            "60f8f1b3c2d7a8f9e1d2c3b4", "delivered"
+            "60f8f1b3c2d7a8f9e1d2c3b4", "delivered", ANY
         )
         mock_channel.basic_ack.assert_called_once_with(delivery_tag="test_tag")
 
@@ -230,7 +597,7 @@ class TestNotificationService(unittest.TestCase):
         # Assert
         mock_get_service.assert_called_once_with("email")
         mock_service.send.assert_called_once_with(123, "Test content")
-        mock_update_status.assert_called_once_with("60f8f1b3c2d7a8f9e1d2c3b4", "failed")
+        mock_update_status.assert_called_once_with("60f8f1b3c2d7a8f9e1d2c3b4", "failed", ANY)
         mock_channel.basic_ack.assert_called_once_with(delivery_tag="test_tag")
 
     @patch("consumer.get_notification_service")
@@ -262,7 +629,7 @@ class TestNotificationService(unittest.TestCase):
         mock_get_service.assert_called_once_with("email")
         mock_service.send.assert_called_once_with(123, "Test content")
         mock_update_status.assert_called_once_with(
-            "60f8f1b3c2d7a8f9e1d2c3b4", "delivered"
+            "60f8f1b3c2d7a8f9e1d2c3b4", "delivered", ANY
         )
         mock_channel.basic_ack.assert_called_once_with(delivery_tag="test_tag")
 
@@ -298,19 +665,25 @@ class TestNotificationService(unittest.TestCase):
     def test_get_user_notifications_api(self):
         """Test the API endpoint for retrieving user notifications"""
         # Setup
-        with patch("app.get_user_notifications") as mock_get_notifications:
-            mock_get_notifications.return_value = [
-                {
-                    "id": "60f8f1b3c2d7a8f9e1d2c3b4",
-                    "type": "email",
-                    "content": "Test content",
-                    "status": "delivered",
-                    "created_at": "2023-07-22T15:30:45.123456",
-                }
-            ]
+        with patch("app.get_user_notifications_page") as mock_get_page:
+            mock_get_page.return_value = {
+                "notifications": [
+                    {
+                        "id": "60f8f1b3c2d7a8f9e1d2c3b4",
+                        "type": "email",
+                        "content": "Test content",
+                        "status": "delivered",
+                        "created_at": "2023-07-22T15:30:45.123456",
+                    }
+                ],
+                "next_cursor": "next",
+                "prev_cursor": "prev",
+            }
 
             # Execute
-            response = self.app.get("/users/123/notifications")
+            response = self.app.get(
+                "/users/123/notifications?limit=10&before=abc&status=delivered&type=email&fields=type,status"
+            )
 
             # Assert
             self.assertEqual(response.status_code, 200)
@@ -320,8 +693,89 @@ class TestNotificationService(unittest.TestCase):
             self.assertEqual(
                 response_data["notifications"][0]["id"], "60f8f1b3c2d7a8f9e1d2c3b4"
             )
+            self.assertEqual(response_data["next_cursor"], "next")
+
+            mock_get_page.assert_called_once_with(
+                123,
+                10,
+                before="abc",
+                status="delivered",
+                notification_type="email",
+                fields=["type", "status"],
+            )
+
+    def test_get_user_notifications_api_rejects_bad_params(self):
+        """Test that limit and fields are checked before hitting Mongo"""
+        response = self.app.get("/users/123/notifications?limit=0")
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get("/users/123/notifications?fields=password")
+        self.assertEqual(response.status_code, 400)
+
+    @patch("database.notifications_collection")
+    def test_get_user_notifications_page(self, mock_collection):
+        """Test keyset pagination, projection and the next-page cursor"""
+        # Setup
+        created_time = datetime(2023, 7, 22, 15, 30, 45)
+        docs = [
+            {
+                "_id": ObjectId("60f8f1b3c2d7a8f9e1d2c3b%d" % index),
+                "type": "email",
+                "status": "delivered",
+                "created_at": created_time,
+            }
+            for index in (6, 5, 4)
+        ]
+        mock_collection.find.return_value = docs
+
+        # Execute
+        page = get_user_notifications_page(
+            123, 2, status="delivered", fields=["type", "status"]
+        )
+
+        # Assert
+        query, projection = mock_collection.find.call_args[0]
+        self.assertEqual(query, {"user_id": 123, "status": "delivered"})
+        self.assertEqual(projection, {"type": 1, "status": 1, "created_at": 1})
+        self.assertEqual(mock_collection.find.call_args[1]["limit"], 3)
+        self.assertEqual(len(page["notifications"]), 2)
+        self.assertNotIn("created_at", page["notifications"][0])
+        self.assertEqual(decode_cursor(page["next_cursor"]), (created_time, docs[1]["_id"]))
+
+        # The cursor picks up strictly after the last item on the page
+        get_user_notifications_page(123, 2, before=page["next_cursor"])
+        query = mock_collection.find.call_args[0][0]
+        self.assertEqual(
+            query["$or"],
+            [
+                {"created_at": {"$lt": created_time}},
+                {"created_at": created_time, "_id": {"$lt": docs[1]["_id"]}},
+            ],
+        )
+
+    def test_dead_letter_api(self):
+        """Test listing and replaying dead letters through the API"""
+        # Setup
+        with patch("app.list_dead_letters") as mock_list, patch(
+            "app.replay_dead_letters"
+        ) as mock_replay:
+            mock_list.return_value = (1, [{"attempts": 5, "error": "provider down"}])
+            mock_replay.return_value = 1
+
+            # Execute
+            listed = self.app.get("/dead-letters?limit=10")
+            replayed = self.app.post(
+                "/dead-letters/replay",
+                data=json.dumps({"limit": 50}),
+                content_type="application/json",
+            )
+            rejected = self.app.get("/dead-letters?limit=0")
 
-            mock_get_notifications.assert_called_once_with(123)
+            # Assert
+            self.assertEqual(json.loads(listed.data)["total"], 1)
+            mock_list.assert_called_once_with(10)
+            self.assertEqual(json.loads(replayed.data), {"replayed": 1})
+            mock_replay.assert_called_once_with(50)
+            self.assertEqual(rejected.status_code, 400)
 
     def test_health_check_api(self):
         """Test the health check API endpoint"""
@@ -333,6 +787,2059 @@ class TestNotificationService(unittest.TestCase):
         response_data = json.loads(response.data)
         self.assertEqual(response_data["status"], "ok")
 
+    @patch("database.notifications_collection")
+    def test_save_notifications_reports_per_item_errors(self, mock_collection):
+        """Test that one insert_many is used and failed documents are reported"""
+        # Setup
+        mock_collection.insert_many.side_effect = BulkWriteError(
+            {"writeErrors": [{"index": 1, "errmsg": "duplicate key"}]}
+        )
+        items = [
+            {"user_id": 1, "type": "email", "content": "a"},
+            {"user_id": 2, "type": "sms", "content": "b"},
+        ]
+
+        # Execute
+        result = save_notifications(items)
+
+        # Assert
+        mock_collection.insert_many.assert_called_once()
+        self.assertFalse(mock_collection.insert_many.call_args[1]["ordered"])
+        self.assertIsNotNone(result[0][0])
+        self.assertIsNone(result[0][1])
+        self.assertEqual(result[1], (None, "duplicate key"))
+
+    def test_send_notification_batch_api(self):
+        """Test the batch endpoint with a mix of good and bad notifications"""
+        with patch("app.send_batch_to_queue") as mock_send_batch, patch(
+            "app.save_notifications"
+        ) as mock_save_notifications:
+            mock_save_notifications.return_value = [
+                ("60f8f1b3c2d7a8f9e1d2c3b4", None),
+                ("60f8f1b3c2d7a8f9e1d2c3b5", None),
+            ]
+            mock_send_batch.return_value = [None, "broker unavailable"]
+
+            # Execute
+            response = self.app.post(
+                "/notifications/batch",
+                data=json.dumps(
+                    [
+                        {"user_id": 1, "type": "email", "content": "one"},
+                        {"user_id": 2, "type": "fax", "content": "two"},
+                        {"user_id": 3, "type": "sms", "content": "three"},
+                    ]
+                ),
+                content_type="application/json",
+            )
+
+            # Assert
+            self.assertEqual(response.status_code, 200)
+            response_data = json.loads(response.data)
+            self.assertEqual(response_data["accepted"], 1)
+            self.assertEqual(response_data["rejected"], 2)
+            results = response_data["results"]
+            self.assertEqual(results[0]["notification_id"], "60f8f1b3c2d7a8f9e1d2c3b4")
+            self.assertIn("type must be one of", results[1]["error"])
+            self.assertEqual(results[2]["error"], "broker unavailable")
+
+            mock_save_notifications.assert_called_once()
+            self.assertEqual(len(mock_save_notifications.call_args[0][0]), 2)
+            self.assertEqual(len(mock_send_batch.call_args[0][0]), 2)
+
+    def test_send_notification_batch_api_ndjson(self):
+        """Test that the batch endpoint accepts NDJSON bodies"""
+        with patch("app.send_batch_to_queue") as mock_send_batch, patch(
+            "app.save_notifications"
+        ) as mock_save_notifications:
+            mock_save_notifications.return_value = [("60f8f1b3c2d7a8f9e1d2c3b4", None)]
+            mock_send_batch.return_value = [None]
+
+            # Execute
+            response = self.app.post(
+                "/notifications/batch",
+                data='{"user_id": 1, "type": "email", "content": "one"}\nnot json\n',
+                content_type="application/x-ndjson",
+            )
+
+            # Assert
+            self.assertEqual(response.status_code, 200)
+            results = json.loads(response.data)["results"]
+            self.assertEqual(results[0]["notification_id"], "60f8f1b3c2d7a8f9e1d2c3b4")
+            self.assertIn("invalid JSON", results[1]["error"])
+
+    @patch("database.notifications_collection")
+    def test_update_notification_statuses(self, mock_collection):
+        """Test that a batch of status changes is one bulk_write"""
+        # Execute
+        update_notification_statuses(
+            {
+                "60f8f1b3c2d7a8f9e1d2c3b4": "delivered",
+                "60f8f1b3c2d7a8f9e1d2c3b5": "failed",
+            }
+        )
+
+        # Assert
+        mock_collection.bulk_write.assert_called_once()
+        operations = mock_collection.bulk_write.call_args[0][0]
+        self.assertEqual(len(operations), 2)
+        self.assertEqual(
+            operations[1]._filter, {"_id": ObjectId("60f8f1b3c2d7a8f9e1d2c3b5")}
+        )
+        self.assertEqual(operations[1]._doc, {"$set": {"status": "failed"}})
+
+    @patch("consumer.update_notification_statuses")
+    @patch("consumer.get_notification_service")
+    def test_process_batch(self, mock_get_service, mock_update_statuses):
+        """Test that a batch gets one status write and one multiple ack"""
+        # Setup
+        mock_service = MagicMock()
+        mock_service.send_batch.return_value = [
+            True,
+            RuntimeError("provider down"),
+            False,
+        ]
+        mock_get_service.return_value = mock_service
+        mock_channel = MagicMock()
+
+        def delivery(tag, notification_id):
+            method = MagicMock()
+            method.delivery_tag = tag
+            body = json.dumps(
+                {
+                    "id": notification_id,
+                    "user_id": 123,
+                    "type": "email",
+                    "content": "Test content",
+                }
+            ).encode("utf-8")
+            return (method, None, body)
+
+        bad_json = MagicMock()
+        bad_json.delivery_tag = 4
+        deliveries = [
+            delivery(1, "60f8f1b3c2d7a8f9e1d2c3b4"),
+            delivery(2, "60f8f1b3c2d7a8f9e1d2c3b5"),
+            delivery(3, "60f8f1b3c2d7a8f9e1d2c3b6"),
+            (bad_json, None, b"not json"),
+        ]
+
+        # Execute
+        process_batch(mock_channel, deliveries)
+
+        # Assert
+        mock_update_statuses.assert_called_once_with(
+            {
+                "60f8f1b3c2d7a8f9e1d2c3b4": "delivered",
+                "60f8f1b3c2d7a8f9e1d2c3b6": "failed",
+            },
+            ANY,
+        )
+        # The provider error goes to the first delay queue instead of a requeue
+        mock_channel.basic_nack.assert_not_called()
+        retry = mock_channel.basic_publish.call_args[1]
+        self.assertEqual(retry["routing_key"], "notifications.retry.1")
+        self.assertEqual(retry["properties"].headers["x-attempt"], 1)
+        self.assertEqual(
+            mock_channel.basic_ack.call_args_list,
+            [
+                unittest.mock.call(delivery_tag=2),
+                unittest.mock.call(delivery_tag=4, multiple=True),
+            ],
+        )
+        # All three emails went to the provider in one call
+        mock_get_service.assert_called_once_with("email")
+        mock_service.send_batch.assert_called_once_with(
+            [(123, "Test content")] * 3
+        )
+
+    @patch("consumer.update_notification_statuses")
+    @patch("consumer.get_notification_service")
+    def test_process_batch_groups_by_type(self, mock_get_service, mock_update_statuses):
+        """Test that each channel gets a single send_batch call"""
+        # Setup
+        services = {"email": MagicMock(), "sms": MagicMock()}
+        services["email"].send_batch.side_effect = lambda items: [True] * len(items)
+        services["sms"].send_batch.side_effect = lambda items: [False] * len(items)
+        mock_get_service.side_effect = services.get
+        deliveries = []
+        for tag, notification_type in enumerate(["email", "sms", "email"], start=1):
+            method = MagicMock()
+            method.delivery_tag = tag
+            body = json.dumps(
+                {
+                    "id": f"60f8f1b3c2d7a8f9e1d2c3b{tag}",
+                    "user_id": tag,
+                    "type": notification_type,
+                    "content": "Test content",
+                }
+            ).encode("utf-8")
+            deliveries.append((method, None, body))
+
+        # Execute
+        process_batch(MagicMock(), deliveries)
+
+        # Assert
+        services["email"].send_batch.assert_called_once_with(
+            [(1, "Test content"), (3, "Test content")]
+        )
+        services["sms"].send_batch.assert_called_once_with([(2, "Test content")])
+        mock_update_statuses.assert_called_once_with(
+            {
+                "60f8f1b3c2d7a8f9e1d2c3b1": "delivered",
+                "60f8f1b3c2d7a8f9e1d2c3b2": "failed",
+                "60f8f1b3c2d7a8f9e1d2c3b3": "delivered",
+            },
+            ANY,
+        )
+
+    @patch("consumer.update_notification_statuses")
+    @patch("consumer.get_notification_service")
+    def test_short_send_batch_result_counts_as_failed(self, mock_get_service, mock_update_statuses):
+        """Test that notifications send_batch didn't report on are failed, not dropped"""
+        # Setup - a provider that only answers for the first item
+        mock_get_service.return_value.send_batch.return_value = [True]
+        deliveries = []
+        for tag in (1, 2):
+            method = MagicMock()
+            method.delivery_tag = tag
+            body = json.dumps(
+                {
+                    "id": f"60f8f1b3c2d7a8f9e1d2c3b{tag}",
+                    "user_id": tag,
+                    "type": "email",
+                    "content": "Test content",
+                }
+            ).encode("utf-8")
+            deliveries.append((method, None, body))
+
+        # Execute
+        process_batch(MagicMock(), deliveries)
+
+        # Assert
+        mock_update_statuses.assert_called_once_with(
+            {
+                "60f8f1b3c2d7a8f9e1d2c3b1": "delivered",
+                "60f8f1b3c2d7a8f9e1d2c3b2": "failed",
+            },
+            ANY,
+        )
+
+    def test_send_batch_defaults_to_looping_over_send(self):
+        """Test the fallback send_batch keeps per-item results and errors"""
+        # Setup
+        class FlakyService(NotificationService):
+            def send(self, user_id, content):
+                if user_id == 2:
+                    raise RuntimeError("provider down")
+                return user_id == 1
+
+        # Execute
+        results = FlakyService().send_batch(
+            [(1, "Test content"), (2, "Test content"), (3, "Test content")]
+        )
+
+        # Assert
+        self.assertTrue(results[0])
+        self.assertIsInstance(results[1], RuntimeError)
+        self.assertFalse(results[2])
+
+    @patch("notification_services.logger")
+    def test_email_send_batch_groups_recipients(self, mock_logger):
+        """Test that emails with the same content share a bulk request"""
+        # Setup
+        items = [(1, "Hello"), (2, "Hello"), (3, "Bye"), (4, "Hello")]
+
+        # Execute
+        results = EmailNotificationService().send_batch(items, max_recipients=2)
+
+        # Assert
+        self.assertEqual(results, [True] * 4)
+        # Hello x3 split into 2 + 1, plus one for Bye
+        self.assertEqual(mock_logger.info.call_count, 3)
+
+    def test_send_notification_api_write_behind(self):
+        """Test that write-behind mode publishes without touching Mongo"""
+        with patch("app.INGESTION_MODE", "write_behind"), patch(
+            "app.send_to_queue"
+        ) as mock_send_to_queue, patch("app.save_notification") as mock_save:
+
+            # Execute
+            response = self.app.post(
+                "/notifications",
+                data=json.dumps(
+                    {"user_id": 123, "type": "email", "content": "Test content"}
+                ),
+                content_type="application/json",
+            )
+
+            # Assert
+            self.assertEqual(response.status_code, 200)
+            notification_id = json.loads(response.data)["notification_id"]
+            self.assertTrue(ObjectId.is_valid(notification_id))
+            mock_save.assert_not_called()
+            message = mock_send_to_queue.call_args[0][0]
+            self.assertEqual(message["id"], notification_id)
+            self.assertIn("created_at", message)
+
+    @patch("database.notifications_collection")
+    def test_persist_notifications_is_idempotent_upsert(self, mock_collection):
+        """Test that write-behind records are upserted on _id without resetting status"""
+        # Setup
+        notification_id = ObjectId("60f8f1b3c2d7a8f9e1d2c3b4")
+        document = {
+            "_id": notification_id,
+            "user_id": 123,
+            "type": "email",
+            "content": "Test content",
+            "status": "pending",
+            "created_at": datetime.now(),
+        }
+
+        # Execute
+        persist_notifications([document])
+
+        # Assert
+        operation = mock_collection.bulk_write.call_args[0][0][0]
+        self.assertEqual(operation._filter, {"_id": notification_id})
+        self.assertTrue(operation._upsert)
+        self.assertEqual(operation._doc["$setOnInsert"], {"status": "pending"})
+        self.assertNotIn("status", operation._doc["$set"])
+
+    @patch("persister.persist_notifications")
+    def test_persist_batch(self, mock_persist):
+        """Test that the persister writes a batch once and acks it once"""
+        # Setup
+        mock_channel = MagicMock()
+        deliveries = []
+        for tag, created_at in [(1, "2023-07-22T15:30:45.123456"), (2, None)]:
+            method = MagicMock()
+            method.delivery_tag = tag
+            body = json.dumps(
+                {
+                    "id": "60f8f1b3c2d7a8f9e1d2c3b4",
+                    "user_id": 123,
+                    "type": "email",
+                    "content": "Test content",
+                    "created_at": created_at,
+                }
+            )
+            deliveries.append((method, None, body))
+
+        # Execute
+        persist_batch(mock_channel, deliveries)
+
+        # Assert
+        documents = mock_persist.call_args[0][0]
+        self.assertEqual(len(documents), 1)
+        self.assertEqual(documents[0]["_id"], ObjectId("60f8f1b3c2d7a8f9e1d2c3b4"))
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+
+    @patch("persister.schedule_retry")
+    @patch("persister.persist_notifications")
+    def test_persist_batch_failures_wait_out_a_retry_delay(self, mock_persist, mock_retry):
+        """Test that failed records go to the delay queues, not back to the head of the queue"""
+        # Setup
+        mock_channel = MagicMock()
+        deliveries = []
+        for tag in (1, 2, 3):
+            method = MagicMock()
+            method.delivery_tag = tag
+            body = json.dumps(
+                {
+                    "id": str(ObjectId()),
+                    "user_id": tag,
+                    "type": "email",
+                    "content": "Test content",
+                    "created_at": "2023-07-22T15:30:45.123456",
+                }
+            )
+            deliveries.append((method, None, body))
+
+        # Execute - Mongo refuses just the second record
+        mock_persist.side_effect = BulkWriteError(
+            {"writeErrors": [{"index": 1, "errmsg": "document too large"}], "upserted": []}
+        )
+        persist_batch(mock_channel, deliveries)
+
+        # Assert
+        mock_retry.assert_called_once()
+        self.assertEqual(mock_retry.call_args[0][1].delivery_tag, 2)
+        self.assertEqual(mock_retry.call_args[1]["queue"], "notifications.persist")
+        mock_channel.basic_nack.assert_not_called()
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+        # Execute - Mongo is down
+        mock_retry.reset_mock()
+        mock_persist.side_effect = ServerSelectionTimeoutError("no servers")
+        persist_batch(mock_channel, deliveries)
+
+        # Assert
+        self.assertEqual(mock_retry.call_count, 3)
+        mock_channel.basic_nack.assert_not_called()
+
+    def test_summarize_plan(self):
+        """Test spotting collection scans and in-memory sorts in explain output"""
+        scan = {
+            "queryPlanner": {
+                "winningPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}
+            }
+        }
+        indexed = {
+            "queryPlanner": {
+                "winningPlan": {
+                    "queryPlan": {
+                        "stage": "LIMIT",
+                        "inputStage": {
+                            "stage": "FETCH",
+                            "inputStage": {"stage": "IXSCAN", "indexName": "user_inbox"},
+                        },
+                    }
+                }
+            }
+        }
+
+        self.assertFalse(summarize_plan(scan)["covered"])
+        self.assertTrue(summarize_plan(scan)["in_memory_sort"])
+        self.assertTrue(summarize_plan(indexed)["covered"])
+        self.assertEqual(summarize_plan(indexed)["indexes"], ["user_inbox"])
+
+    @patch.object(inbox_cache, "backend", new_callable=MemoryCacheBackend)
+    @patch("database.notifications_collection")
+    def test_inbox_pages_are_cached_until_the_user_gets_a_write(self, mock_collection, _):
+        """Test read-through caching and invalidation from save_notification"""
+        # Setup
+        mock_collection.find.return_value = [
+            {
+                "_id": ObjectId("60f8f1b3c2d7a8f9e1d2c3b4"),
+                "type": "email",
+                "content": "Test content",
+                "status": "pending",
+                "created_at": datetime.now(),
+            }
+        ]
+
+        # Execute - second read is a hit
+        first = get_user_notifications_page(123, 10)
+        second = get_user_notifications_page(123, 10)
+
+        # Assert
+        self.assertEqual(first, second)
+        self.assertEqual(mock_collection.find.call_count, 1)
+
+        # A new notification for the user drops their cached pages
+        save_notification(123, "email", "Another one")
+        get_user_notifications_page(123, 10)
+        self.assertEqual(mock_collection.find.call_count, 2)
+
+    # One backend for the API and the consumer, like Redis in production
+    @patch.object(inbox_cache, "backend", new_callable=MemoryCacheBackend)
+    @patch("consumer.get_notification_service")
+    def test_consumer_status_update_clears_the_cached_inbox(self, mock_get_service, _):
+        """Test that an inbox read after the consumer's status write misses the cache"""
+        # Setup
+        mock_get_service.return_value.send.return_value = True
+        notification_id = save_notification(123, "email", "Test content")
+        client = app.test_client()
+        before = client.get("/users/123/notifications").get_json()
+        body = json.dumps(
+            {"id": notification_id, "user_id": 123, "type": "email", "content": "Test content"}
+        ).encode("utf-8")
+        method = MagicMock()
+        method.delivery_tag = "test_tag"
+
+        # Execute
+        process_notification(MagicMock(), method, None, body)
+        after = client.get("/users/123/notifications").get_json()
+
+        # Assert
+        self.assertEqual(before["notifications"][0]["status"], "pending")
+        self.assertEqual(after["notifications"][0]["status"], "delivered")
+
+    @patch("database.check_query_coverage")
+    @patch("database.ensure_indexes")
+    def test_init_db_only_explains_when_asked(self, mock_ensure, mock_coverage):
+        """Test that index bootstrap skips the explain queries unless it's the CI check"""
+        # Setup
+        mock_coverage.return_value = {
+            "inbox": {"covered": True},
+            "pending_sweep": {"covered": False},
+        }
+
+        # Execute
+        plain = init_db()
+        checked = init_db(check_coverage=True)
+
+        # Assert
+        self.assertEqual(plain, [])
+        self.assertEqual(checked, ["pending_sweep"])
+        mock_coverage.assert_called_once()
+        self.assertEqual(mock_ensure.call_count, 4)
+
+
+class TestServiceRegistry(unittest.TestCase):
+
+    def test_services_are_created_once_per_process(self):
+        """Test that the registry hands back the same started instance"""
+        # Setup
+        registry = ServiceRegistry()
+        factory = MagicMock(return_value=MagicMock(spec=NotificationService))
+        registry.register("email", factory)
+
+        # Execute
+        first = registry.get("email")
+        second = registry.get("email")
+
+        # Assert
+        self.assertIs(first, second)
+        factory.assert_called_once_with()
+        first.startup.assert_called_once_with()
+        with self.assertRaises(ValueError):
+            registry.get("pigeon")
+
+    def test_plugins_register_new_types_and_get_lifecycle_hooks(self):
+        """Test decorator registration plus health and close hooks"""
+        # Setup
+        registry = ServiceRegistry()
+        events = []
+
+        @registry.register("push")
+        class PushNotificationService(NotificationService):
+            def startup(self):
+                events.append("startup")
+
+            def health(self):
+                return False
+
+            def close(self):
+                events.append("close")
+
+            def send(self, user_id, content):
+                return True
+
+        # Execute
+        service = registry.get("push")
+        health = registry.health()
+        registry.close()
+
+        # Assert
+        self.assertIn("push", registry.types())
+        self.assertTrue(service.send(123, "Test content"))
+        self.assertEqual(health, {"push": False})
+        self.assertEqual(events, ["startup", "close"])
+
+    @patch("notification_services.entry_points")
+    def test_broken_plugin_doesnt_stop_the_others_loading(self, mock_entry_points):
+        """Test that one plugin failing to import still registers the rest"""
+        # Setup
+        broken, working = MagicMock(), MagicMock()
+        broken.name, working.name = "pigeon", "push"
+        broken.load.side_effect = ImportError("No module named 'pigeon_sdk'")
+        working.load.return_value = MagicMock(return_value=MagicMock(spec=NotificationService))
+        mock_entry_points.return_value = [broken, working]
+        registry = ServiceRegistry(["no_such_provider_module"])
+
+        # Execute
+        types = registry.types()
+        service = registry.get("push")
+
+        # Assert
+        self.assertIn("push", types)
+        self.assertNotIn("pigeon", types)
+        self.assertIsNotNone(service)
+        mock_entry_points.assert_called_once()
+
+    @patch("notification_services.os.getpid")
+    def test_forked_children_get_their_own_instances(self, mock_getpid):
+        """Test that a pid change drops instances inherited from the parent"""
+        # Setup
+        mock_getpid.return_value = 100
+        registry = ServiceRegistry()
+        registry.register("email", EmailNotificationService)
+        parent = registry.get("email")
+
+        # Execute
+        mock_getpid.return_value = 101
+        child = registry.get("email")
+
+        # Assert
+        self.assertIsNot(parent, child)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.limiter = RateLimiter(
+            channel_limits={"sms": (2.0, 2.0)},
+            tenant_limits={"sms": (1.0, 1.0)},
+            clock=lambda: self.now,
+        )
+
+    def test_token_bucket_paces_sends(self):
+        """Test that a type gets its burst, then has to wait for refills"""
+        # Execute / Assert
+        self.assertEqual(self.limiter.reserve("sms"), 0)
+        self.assertEqual(self.limiter.reserve("sms"), 0)
+        self.assertAlmostEqual(self.limiter.reserve("sms"), 0.5)
+        self.now += 0.5
+        self.assertEqual(self.limiter.reserve("sms"), 0)
+        # Unlimited types never wait
+        self.assertEqual(self.limiter.reserve("email", cost=1000), 0)
+
+    def test_tenants_get_their_own_buckets(self):
+        """Test that one noisy tenant can't use up another's share"""
+        # Execute / Assert
+        self.assertEqual(self.limiter.reserve("sms", tenant="a"), 0)
+        self.assertAlmostEqual(self.limiter.reserve("sms", tenant="a"), 1.0)
+        self.assertEqual(self.limiter.reserve("sms", tenant="b"), 0)
+
+    def test_provider_throttling_is_retried_in_place(self):
+        """Test that a throttled call backs off and retries instead of raising"""
+        # Setup
+        call = MagicMock(side_effect=[ProviderThrottled(retry_after=2.0), True])
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            self.now += seconds
+
+        # Execute
+        result = self.limiter.run("sms", call, sleep=sleep)
+
+        # Assert
+        self.assertTrue(result)
+        self.assertEqual(call.call_count, 2)
+        self.assertEqual(sleeps[0], 2.0)
+
+    @patch("consumer.update_notification_status")
+    @patch("consumer.get_notification_service")
+    def test_consumer_waits_instead_of_requeueing(
+        self, mock_get_service, mock_update_status
+    ):
+        """Test that a rate-limited message is held and sent, not nacked"""
+        # Setup
+        mock_service = MagicMock()
+        mock_service.send.return_value = True
+        mock_get_service.return_value = mock_service
+        mock_channel = MagicMock()
+        mock_channel.connection.sleep.side_effect = lambda seconds: setattr(
+            self, "now", self.now + seconds
+        )
+        method = MagicMock()
+        body = json.dumps(
+            {
+                "id": "60f8f1b3c2d7a8f9e1d2c3b4",
+                "user_id": 123,
+                "type": "sms",
+                "content": "Test content",
+            }
+        ).encode("utf-8")
+
+        # Execute
+        with patch("consumer.rate_limiter", self.limiter):
+            for _ in range(3):
+                process_notification(mock_channel, method, None, body)
+
+        # Assert
+        self.assertEqual(mock_service.send.call_count, 3)
+        mock_channel.connection.sleep.assert_called_once()
+        mock_channel.basic_nack.assert_not_called()
+
+    @patch("consumer.update_notification_status")
+    @patch("consumer.get_notification_service")
+    def test_tenant_id_travels_from_the_api_to_the_limiter(
+        self, mock_get_service, mock_update_status
+    ):
+        """Test a tenant_id given to the API is saved, queued and gets its own bucket"""
+        # Setup
+        client = app.test_client()
+        mock_get_service.return_value.send.return_value = True
+        mock_channel = MagicMock()
+        mock_channel.connection.sleep.side_effect = lambda seconds: setattr(
+            self, "now", self.now + seconds
+        )
+        payload = {"user_id": 123, "type": "sms", "content": "Test content"}
+
+        # Execute
+        with patch("app.send_to_queue") as mock_send_to_queue, patch(
+            "app.save_notification", return_value="60f8f1b3c2d7a8f9e1d2c3b4"
+        ) as mock_save_notification:
+            response = client.post("/notifications", json=dict(payload, tenant_id="acme"))
+            invalid = client.post("/notifications", json=dict(payload, tenant_id=42))
+        message = mock_send_to_queue.call_args[0][0]
+        with patch("consumer.rate_limiter", self.limiter):
+            for _ in range(2):
+                process_notification(
+                    mock_channel, MagicMock(), None, json.dumps(message).encode("utf-8")
+                )
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_save_notification.call_args[1], {"tenant_id": "acme"})
+        self.assertEqual(message["tenant_id"], "acme")
+        self.assertEqual(invalid.status_code, 400)
+        self.assertIn("tenant_id", invalid.get_json()["error"])
+        # The tenant bucket (1/s) is tighter than the channel's (2/s)
+        mock_channel.connection.sleep.assert_called_once_with(1.0)
+
+    def test_burst_below_one_is_rejected(self):
+        """Test a limit that could never fit a single send is refused up front"""
+        self.assertEqual(parse_rate_limits("sms=0.5"), {"sms": (0.5, 1.0)})
+        with self.assertRaises(ValueError):
+            parse_rate_limits("sms=10:0.5")
+
+    def test_rate_must_be_positive(self):
+        """Test a limit that would never refill (or would drain) is refused up front"""
+        for spec in ("sms=0", "sms=-5", "sms=0:10"):
+            with self.assertRaises(ValueError):
+                parse_rate_limits(spec)
+
+
+class TestRetries(unittest.TestCase):
+
+    def test_backoff_grows_per_attempt_then_dead_letters(self):
+        """Test the attempt header, delay queue routing and final dead letter"""
+        # Setup
+        headers = None
+        routes = []
+
+        # Execute
+        with patch("retries.random.random", return_value=0.5):
+            for _ in range(6):
+                routing_key, headers, expiration = plan_retry(
+                    headers, "provider down", max_attempts=5
+                )
+                routes.append((routing_key, expiration))
+
+        # Assert
+        self.assertEqual(
+            routes,
+            [
+                ("notifications.retry.1", 1000),
+                ("notifications.retry.2", 2000),
+                ("notifications.retry.3", 4000),
+                ("notifications.retry.4", 8000),
+                ("notifications.retry.5", 16000),
+                ("notifications.dead", None),
+            ],
+        )
+        self.assertEqual(headers["x-last-error"], "provider down")
+        self.assertIn("x-dead-at", headers)
+
+    def test_delay_queues_dead_letter_back_to_the_main_queue(self):
+        """Test the delay queue arguments in the declared topology"""
+        # Execute
+        declarations = retry_topology(max_attempts=2)
+
+        # Assert
+        queues = {
+            kwargs["queue"]: kwargs.get("arguments")
+            for method, kwargs in declarations
+            if method == "queue_declare"
+        }
+        self.assertEqual(
+            queues["notifications.retry.2"],
+            {
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": "notifications",
+            },
+        )
+        self.assertIn("notifications.dead", queues)
+
+    def test_retry_is_confirmed_before_the_original_is_acked(self):
+        """Test that a retry the broker refuses leaves the original on its queue"""
+        # Setup
+        channel = MagicMock()
+        method = MagicMock(delivery_tag=7)
+        declare_retry_topology(channel)
+
+        # Execute - confirmed
+        schedule_retry(channel, method, None, b"{}", "provider down")
+
+        # Assert
+        channel.confirm_delivery.assert_called_once_with()
+        self.assertTrue(channel.basic_publish.call_args[1]["mandatory"])
+        channel.basic_ack.assert_called_once_with(delivery_tag=7)
+
+        # Execute - nacked by the broker
+        channel.reset_mock()
+        channel.basic_publish.side_effect = pika.exceptions.NackError([])
+        schedule_retry(channel, method, None, b"{}", "provider down")
+
+        # Assert
+        channel.basic_ack.assert_not_called()
+        channel.basic_nack.assert_called_once_with(delivery_tag=7, requeue=True)
+
+    def test_list_and_replay_dead_letters(self):
+        """Test peeking at dead letters and replaying them with fresh attempts"""
+        # Setup
+        connection = MagicMock()
+        channel = connection.channel.return_value
+        channel.queue_declare.return_value.method.message_count = 1
+        dead = (
+            MagicMock(delivery_tag=7),
+            pika.BasicProperties(
+                headers={"x-attempt": 5, "x-last-error": "provider down"}
+            ),
+            json.dumps({"id": "60f8f1b3c2d7a8f9e1d2c3b4"}).encode("utf-8"),
+        )
+        channel.basic_get.side_effect = [dead, (None, None, None)]
+
+        # Execute
+        total, dead_letters = list_dead_letters(10, connection_factory=lambda: connection)
+
+        # Assert
+        self.assertEqual(total, 1)
+        self.assertEqual(dead_letters[0]["attempts"], 5)
+        self.assertEqual(dead_letters[0]["error"], "provider down")
+        channel.basic_ack.assert_not_called()
+
+        # Execute - replay
+        channel.basic_get.side_effect = [dead, (None, None, None)]
+        replayed = replay_dead_letters(10, connection_factory=lambda: connection)
+
+        # Assert
+        self.assertEqual(replayed, 1)
+        published = channel.basic_publish.call_args[1]
+        self.assertEqual(published["routing_key"], "notifications")
+        self.assertNotIn("x-attempt", published["properties"].headers)
+        channel.basic_ack.assert_called_once_with(delivery_tag=7)
+
+
+class TestPriorityLanes(unittest.TestCase):
+
+    def test_parse_lanes_keeps_the_main_queue_for_the_default_lane(self):
+        """Test lane queue names, and that a missing default lane gets added"""
+        # Execute
+        lanes = parse_lanes("transactional=8,bulk=1", "notifications", "default")
+
+        # Assert
+        self.assertEqual(
+            lanes,
+            [
+                Lane("transactional", "notifications.transactional", 8),
+                Lane("bulk", "notifications.bulk", 1),
+                Lane("default", "notifications", 1),
+            ],
+        )
+
+    def test_weighted_scheduler_shares_turns_by_weight(self):
+        """Test smooth weighted round-robin, and that an idle lane sits out"""
+        # Setup
+        scheduler = WeightedScheduler(
+            [Lane("transactional", "t", 8), Lane("bulk", "b", 1)]
+        )
+        for index in range(20):
+            scheduler.push("transactional", index)
+            scheduler.push("bulk", index)
+
+        # Execute
+        turns = []
+        for _ in range(18):
+            lane = scheduler.next_lane()
+            scheduler.take(lane)
+            turns.append(lane)
+
+        # Assert - 8:1 while both are busy, bulk's turns spread out
+        expected = ["transactional"] * 4 + ["bulk"] + ["transactional"] * 4
+        self.assertEqual(turns, expected * 2)
+
+        # Execute - transactional runs dry
+        scheduler.take("transactional", 100)
+
+        # Assert - bulk gets every turn now
+        self.assertEqual([scheduler.next_lane() for _ in range(3)], ["bulk"] * 3)
+        self.assertEqual(len(scheduler), 18)
+
+    @patch("consumer.process_notification")
+    def test_consume_lanes_serves_transactional_ahead_of_a_bulk_backlog(
+        self, mock_process
+    ):
+        """Test that a transactional message arriving behind bulk ones goes first"""
+        # Setup
+        lanes = [Lane("transactional", "q.transactional", 8), Lane("bulk", "q.bulk", 1)]
+        channels = {}
+        connection = MagicMock()
+
+        def open_channel():
+            channel = MagicMock()
+
+            def basic_consume(queue, on_message_callback):
+                channels[queue] = (channel, on_message_callback)
+
+            channel.basic_consume.side_effect = basic_consume
+            return channel
+
+        connection.channel.side_effect = open_channel
+        deliveries = [("q.bulk", tag) for tag in range(1, 6)] + [("q.transactional", 1)]
+
+        def process_data_events(time_limit):
+            if mock_process.call_count >= len(deliveries):
+                raise KeyboardInterrupt
+            if time_limit == 1:
+                # Nothing buffered yet - the whole lot arrives at once
+                for queue, tag in deliveries:
+                    channel, callback = channels[queue]
+                    method = MagicMock()
+                    method.delivery_tag = tag
+                    callback(channel, method, None, queue.encode("utf-8"))
+
+        connection.process_data_events.side_effect = process_data_events
+
+        # Execute
+        with self.assertRaises(KeyboardInterrupt):
+            consume_lanes(connection, lanes, batch_size=1)
+
+        # Assert
+        served = [call[0][3] for call in mock_process.call_args_list]
+        self.assertEqual(served[0], b"q.transactional")
+        self.assertEqual(served[1:], [b"q.bulk"] * 5)
+        self.assertEqual(mock_process.call_args_list[0][1]["lane"], lanes[0])
+        for channel, _ in channels.values():
+            channel.basic_qos.assert_called_once_with(prefetch_count=1)
+
+    @patch("consumer.update_notification_status")
+    @patch("consumer.get_notification_service")
+    def test_failed_notification_retries_within_its_lane(
+        self, mock_get_service, mock_update_status
+    ):
+        """Test that retries go back to the lane the message came from"""
+        # Setup
+        mock_get_service.return_value.send.side_effect = RuntimeError("provider down")
+        mock_channel = MagicMock()
+        method = MagicMock()
+        method.delivery_tag = "test_tag"
+        body = json.dumps(
+            {"id": "60f8f1b3c2d7a8f9e1d2c3b4", "user_id": 123, "type": "sms", "content": "1234"}
+        ).encode("utf-8")
+
+        # Execute
+        process_notification(mock_channel, method, None, body, lane=get_lane("transactional"))
+
+        # Assert
+        self.assertEqual(
+            mock_channel.basic_publish.call_args[1]["routing_key"],
+            "notifications.transactional.retry.1",
+        )
+
+    def test_send_notification_api_routes_by_priority(self):
+        """Test the priority field picks the lane, and unknown lanes are rejected"""
+        client = app.test_client()
+        with patch("app.get_publisher") as mock_get_publisher, patch(
+            "app.save_notification", return_value="60f8f1b3c2d7a8f9e1d2c3b4"
+        ):
+            # Execute
+            response = client.post(
+                "/notifications",
+                json={"user_id": 123, "type": "sms", "content": "1234", "priority": "transactional"},
+            )
+            rejected = client.post(
+                "/notifications",
+                json={"user_id": 123, "type": "sms", "content": "1234", "priority": "urgent"},
+            )
+
+            # Assert
+            self.assertEqual(response.status_code, 200)
+            publish = mock_get_publisher.return_value.publish
+            self.assertEqual(
+                publish.call_args[1]["routing_key"], "notifications.transactional"
+            )
+            self.assertIn("published", publish.call_args[0][0]["timestamps"])
+            self.assertEqual(rejected.status_code, 400)
+            self.assertIn("priority must be one of", rejected.get_json()["error"])
+
+
+class TestLatencyInstrumentation(unittest.TestCase):
+
+    def test_stage_durations(self):
+        """Test stage timings from message timestamps, including write-behind"""
+        # Setup
+        timestamps = {
+            "received": 100.0,
+            "persisted": 100.01,
+            "published": 100.02,
+            "consumed": 102.0,
+            "sent": 102.5,
+            "status_written": 102.51,
+        }
+
+        # Execute
+        durations = stage_durations(timestamps)
+
+        # Assert
+        self.assertAlmostEqual(durations["persist"], 0.01)
+        self.assertAlmostEqual(durations["queue_wait"], 1.98)
+        self.assertAlmostEqual(durations["send"], 0.5)
+        self.assertAlmostEqual(durations["end_to_end"], 2.51)
+
+        # Write-behind publishes before persisting, and skewed clocks clamp to 0
+        durations = stage_durations({"received": 100.0, "published": 100.02, "consumed": 99.0})
+        self.assertAlmostEqual(durations["publish"], 0.02)
+        self.assertEqual(durations["queue_wait"], 0.0)
+        self.assertNotIn("persist", durations)
+
+    @patch("consumer.update_notification_status")
+    @patch("consumer.get_notification_service")
+    def test_process_notification_records_every_stage(
+        self, mock_get_service, mock_update_status
+    ):
+        """Test the consumer stamps consumed/sent/status_written and observes the stages"""
+        # Setup
+        mock_get_service.return_value.send.return_value = True
+        labels = {"stage": "end_to_end", "type": "in-app"}
+        before = REGISTRY.get_sample_value("notification_stage_seconds_count", labels) or 0
+        now = time.time()
+        body = json.dumps(
+            {
+                "id": "60f8f1b3c2d7a8f9e1d2c3b4",
+                "user_id": 123,
+                "type": "in-app",
+                "content": "Test content",
+                "timestamps": {"received": now - 2, "persisted": now - 1.9, "published": now - 1.8},
+            }
+        ).encode("utf-8")
+
+        # Execute
+        process_notification(MagicMock(), MagicMock(), None, body)
+
+        # Assert
+        self.assertEqual(
+            REGISTRY.get_sample_value("notification_stage_seconds_count", labels), before + 1
+        )
+        self.assertGreaterEqual(
+            REGISTRY.get_sample_value(
+                "notification_stage_seconds_sum", {"stage": "queue_wait", "type": "in-app"}
+            ),
+            1.8,
+        )
+
+    @patch("metrics.start_http_server")
+    def test_metrics_server_takes_the_next_free_port(self, mock_start_http_server):
+        """Test that a second worker on the box moves one port up"""
+        # Setup
+        mock_start_http_server.side_effect = [OSError("address in use"), None]
+
+        # Execute
+        port = start_metrics_server(9100, tries=4)
+
+        # Assert
+        self.assertEqual(port, 9101)
+        self.assertIsNone(start_metrics_server(0))
+
+
+class TestTemplates(unittest.TestCase):
+
+    def setUp(self):
+        template_cache.clear()
+
+    def test_template_cache_compiles_once_and_evicts_lru(self):
+        """Test compiled templates are reused, and the least recently used goes first"""
+        # Setup
+        cache = TemplateCache(max_entries=2)
+        load = MagicMock(side_effect=lambda template_id: {"content": template_id + " {{ n }}"})
+
+        # Execute
+        first = cache.get("a", load)
+        again = cache.get("a", load)
+        cache.get("b", load)
+        cache.get("a", load)
+        cache.get("c", load)  # evicts b, the least recently used
+        cache.get("b", load)
+
+        # Assert
+        self.assertIs(first, again)
+        self.assertEqual(first.render(n=1), "a 1")
+        self.assertEqual([call[0][0] for call in load.call_args_list], ["a", "b", "c", "b"])
+
+    def test_save_template_bumps_version(self):
+        """Test that registering the same template again replaces it as a new version"""
+        # Setup
+        templates_collection.delete_many({"_id": "test_welcome"})
+
+        # Execute
+        first = save_template("test_welcome", "Hi {{ name }}")
+        second = save_template("test_welcome", "Hello {{ name }}")
+
+        # Assert
+        self.assertEqual((first, second), (1, 2))
+        self.assertEqual(get_template("test_welcome")["content"], "Hello {{ name }}")
+        templates_collection.delete_many({"_id": "test_welcome"})
+
+    @patch("consumer.get_template")
+    @patch("consumer.update_notification_status")
+    @patch("consumer.get_notification_service")
+    def test_process_notification_renders_before_sending(
+        self, mock_get_service, mock_update_status, mock_get_template
+    ):
+        """Test templated messages are rendered just before the send, and bad ones fail"""
+        # Setup
+        mock_get_template.return_value = {"content": "Hi {{ name }}, your code is {{ code }}"}
+        mock_get_service.return_value.send.return_value = True
+        message = {
+            "id": "60f8f1b3c2d7a8f9e1d2c3b4",
+            "user_id": 123,
+            "type": "sms",
+            "template_id": "login_code",
+            "variables": {"name": "Ada", "code": "4821"},
+        }
+
+        # Execute
+        process_notification(MagicMock(), MagicMock(), None, json.dumps(message).encode("utf-8"))
+        message["variables"] = {"name": "Ada"}
+        process_notification(MagicMock(), MagicMock(), None, json.dumps(message).encode("utf-8"))
+
+        # Assert
+        mock_get_service.return_value.send.assert_called_once_with(
+            123, "Hi Ada, your code is 4821"
+        )
+        mock_get_template.assert_called_once_with("login_code")
+        self.assertEqual(
+            [call[0][1] for call in mock_update_status.call_args_list], ["delivered", "failed"]
+        )
+
+    def test_register_template_and_send_by_reference(self):
+        """Test the template API, and that only the reference and variables are queued"""
+        client = app.test_client()
+        with patch("app.save_template", return_value=1) as mock_save_template, patch(
+            "app.get_template", return_value={"content": "Hi {{ name }}"}
+        ), patch("app.send_to_queue") as mock_send_to_queue, patch(
+            "app.save_notification", return_value="60f8f1b3c2d7a8f9e1d2c3b4"
+        ) as mock_save_notification:
+            # Execute
+            registered = client.post(
+                "/templates", json={"template_id": "welcome", "content": "Hi {{ name }}"}
+            )
+            broken = client.post(
+                "/templates", json={"template_id": "broken", "content": "Hi {{ name"}
+            )
+            response = client.post(
+                "/notifications",
+                json={
+                    "user_id": 123,
+                    "type": "email",
+                    "template_id": "welcome",
+                    "variables": {"name": "Ada"},
+                },
+            )
+
+            # Assert
+            self.assertEqual(registered.get_json(), {"template_id": "welcome", "version": 1})
+            mock_save_template.assert_called_once_with("welcome", "Hi {{ name }}")
+            self.assertEqual(broken.status_code, 400)
+            self.assertIn("does not compile", broken.get_json()["error"])
+            self.assertEqual(response.status_code, 200)
+            mock_save_notification.assert_called_once_with(
+                123, "email", None, template_id="welcome", variables={"name": "Ada"}
+            )
+            queued = mock_send_to_queue.call_args[0][0]
+            self.assertEqual(queued["template_id"], "welcome")
+            self.assertEqual(queued["variables"], {"name": "Ada"})
+            self.assertNotIn("content", queued)
+
+        with patch("app.get_template", return_value=None):
+            unknown = client.post(
+                "/notifications",
+                json={"user_id": 123, "type": "email", "template_id": "nope"},
+            )
+        self.assertEqual(unknown.status_code, 400)
+        self.assertIn("unknown template_id", unknown.get_json()["error"])
+
+
+    def test_template_lookup_failure_is_a_json_500(self):
+        """Test that Mongo failing during the template check is answered like any other 500"""
+        # Setup
+        client = app.test_client()
+        before = REGISTRY.get_sample_value(
+            "api_requests_total",
+            {"endpoint": "/notifications", "method": "POST", "status": "500"},
+        ) or 0
+        payload = {"user_id": 123, "type": "email", "template_id": "not-cached-yet"}
+
+        # Execute
+        with patch("app.get_template", side_effect=ServerSelectionTimeoutError("mongo down")):
+            single = client.post("/notifications", json=payload)
+            batch = client.post("/notifications/batch", json=[payload])
+            fanout = client.post("/notifications/fanout", json=dict(payload, user_ids=[1]))
+
+        # Assert
+        for response in (single, batch, fanout):
+            self.assertEqual(response.status_code, 500)
+            self.assertIn("mongo down", response.get_json()["error"])
+        after = REGISTRY.get_sample_value(
+            "api_requests_total",
+            {"endpoint": "/notifications", "method": "POST", "status": "500"},
+        )
+        self.assertEqual(after, before + 1)
+
+
+class TestFanout(unittest.TestCase):
+
+    def setUp(self):
+        notifications_collection.delete_many({"fanout_job_id": {"$exists": True}})
+        fanout_jobs_collection.delete_many({})
+        segment_members_collection.delete_many({"segment_id": "test_segment"})
+
+    def test_expand_job_resumes_from_checkpoint_without_duplicates(self):
+        """Test a crashed expansion picks up after its checkpoint and re-saves nothing twice"""
+        # Setup
+        job_id = create_fanout_job(
+            {
+                "type": "in-app",
+                "content": "Maintenance tonight",
+                "user_ids": [1, 2, 3, 4, 5],
+                "total": 5,
+            }
+        )
+        flaky = MagicMock()
+        flaky.publish_many.side_effect = [[None, None], ["connection lost", None]]
+        healthy = MagicMock()
+        healthy.publish_many.side_effect = lambda messages, routing_key: [None] * len(messages)
+
+        # Execute
+        with self.assertRaises(PublishError):
+            expand_job(job_id, publisher=flaky, chunk_size=2, sleep=lambda seconds: None)
+        interrupted = get_fanout_job(job_id)
+        queued = expand_job(job_id, publisher=healthy, chunk_size=2, sleep=lambda seconds: None)
+
+        # Assert
+        self.assertEqual((interrupted["checkpoint"], interrupted["expanded"]), (2, 2))
+        self.assertEqual(queued, 3)
+        republished = [
+            [message["user_id"] for message in call[0][0]]
+            for call in healthy.publish_many.call_args_list
+        ]
+        self.assertEqual(republished, [[3, 4], [5]])
+        self.assertEqual(healthy.publish_many.call_args[0][1], "notifications")
+        job = get_fanout_job(job_id)
+        self.assertEqual((job["status"], job["expanded"]), ("done", 5))
+        self.assertEqual(
+            notifications_collection.count_documents({"fanout_job_id": ObjectId(job_id)}), 5
+        )
+
+    def test_segment_audience_is_paged_in_user_id_order(self):
+        """Test segments are walked in chunks after the checkpoint"""
+        # Setup
+        added = add_segment_members("test_segment", [5, 3, 1, 4, 2])
+        add_segment_members("test_segment", [3])
+
+        # Execute
+        chunks = list(
+            audience_chunks({"segment_id": "test_segment", "checkpoint": 2}, chunk_size=2)
+        )
+
+        # Assert
+        self.assertEqual(added, 5)
+        self.assertEqual(chunks, [[3, 4], [5]])
+
+    def test_fanout_api_records_one_job_and_queues_its_id(self):
+        """Test the fan-out endpoint returns right away with a job id"""
+        client = app.test_client()
+        with patch(
+            "app.create_fanout_job", return_value="60f8f1b3c2d7a8f9e1d2c3b4"
+        ) as mock_create, patch("app.get_publisher") as mock_get_publisher:
+            # Execute
+            response = client.post(
+                "/notifications/fanout",
+                json={"type": "email", "content": "Big news", "user_ids": [9, 7, 9, 8]},
+            )
+            rejected = client.post(
+                "/notifications/fanout",
+                json={"type": "email", "content": "Big news", "user_ids": [1], "segment_id": "vip"},
+            )
+
+            # Assert
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.get_json(), {"job_id": "60f8f1b3c2d7a8f9e1d2c3b4", "total": 3})
+            self.assertEqual(mock_create.call_args[0][0]["user_ids"], [7, 8, 9])
+            mock_get_publisher.return_value.publish.assert_called_once_with(
+                {"job_id": "60f8f1b3c2d7a8f9e1d2c3b4"}, routing_key="notifications.fanout"
+            )
+            self.assertEqual(rejected.status_code, 400)
+
+
+class TestScheduledNotifications(unittest.TestCase):
+
+    def setUp(self):
+        notifications_collection.delete_many({"user_id": 4242})
+
+    def test_send_at_in_the_future_is_stored_not_published(self):
+        """Test scheduled notifications wait in Mongo, and past send_at goes out now"""
+        client = app.test_client()
+        send_at = datetime.now() + timedelta(hours=1)
+        with patch("app.send_to_queue") as mock_send_to_queue, patch(
+            "app.save_notification", return_value="60f8f1b3c2d7a8f9e1d2c3b4"
+        ) as mock_save_notification:
+            # Execute
+            scheduled = client.post(
+                "/notifications",
+                json={
+                    "user_id": 123,
+                    "type": "sms",
+                    "content": "Your table is ready",
+                    "priority": "transactional",
+                    "send_at": send_at.isoformat(),
+                },
+            )
+            mock_send_to_queue.assert_not_called()
+            overdue = client.post(
+                "/notifications",
+                json={
+                    "user_id": 123,
+                    "type": "sms",
+                    "content": "Your table is ready",
+                    "send_at": "2020-01-01T00:00:00Z",
+                },
+            )
+            invalid = client.post(
+                "/notifications",
+                json={"user_id": 123, "type": "sms", "content": "1234", "send_at": "tomorrow"},
+            )
+
+            # Assert
+            self.assertEqual(scheduled.get_json()["message"], "Notification scheduled")
+            self.assertEqual(
+                mock_save_notification.call_args_list[0][1],
+                {"send_at": send_at, "priority": "transactional"},
+            )
+            self.assertEqual(overdue.status_code, 200)
+            mock_send_to_queue.assert_called_once()
+            self.assertEqual(invalid.status_code, 400)
+            self.assertIn("send_at", invalid.get_json()["error"])
+
+    def test_scheduler_claims_the_window_and_fires_in_order(self):
+        """Test one poll claims what's due soon, and each notification goes out at its time"""
+        # Setup
+        now = time.time()
+        soon = save_notification(
+            4242, "email", "first", send_at=datetime.fromtimestamp(now + 1)
+        )
+        later = save_notification(
+            4242, "sms", "second", send_at=datetime.fromtimestamp(now + 2), priority="bulk"
+        )
+        far = save_notification(
+            4242, "email", "next week", send_at=datetime.now() + timedelta(days=7)
+        )
+        publisher = MagicMock()
+        publisher.publish_many.side_effect = lambda messages, queue: [None] * len(messages)
+        scheduler = Scheduler(publisher, lookahead=60, jitter=0)
+
+        # Execute
+        loaded = scheduler.poll(now)
+        loaded_elsewhere = Scheduler(MagicMock(), lookahead=60).poll(now)
+        fired_early = scheduler.fire(now + 0.5)
+        fired = scheduler.fire(now + 1.5)
+        scheduler.release()
+
+        # Assert
+        self.assertEqual((loaded, loaded_elsewhere, fired_early, fired), (2, 0, 0, 1))
+        messages, queue = publisher.publish_many.call_args[0]
+        self.assertEqual([message["id"] for message in messages], [soon])
+        self.assertEqual(queue, "notifications")
+        statuses = {
+            str(document["_id"]): document
+            for document in notifications_collection.find({"user_id": 4242})
+        }
+        self.assertEqual(statuses[soon]["status"], "pending")
+        self.assertNotIn("due_at", statuses[soon])
+        self.assertEqual(statuses[later]["status"], "scheduled")
+        self.assertNotIn("schedule_claim", statuses[later])  # released for others
+        self.assertEqual(statuses[far]["status"], "scheduled")
+        # Scheduled notifications are counted as pending all along
+        self.assertEqual(get_notification_summary(4242)["by_status"].get("scheduled"), None)
+
+    @patch("consumer.DEDUP_ENABLED", True)
+    @patch("consumer.get_notification_service")
+    def test_consumer_between_publish_and_mark_retries(self, mock_get_service):
+        """Test a scheduled message consumed before it's marked pending is retried, not dropped"""
+        # Setup
+        recently_completed.clear()
+        mock_get_service.return_value.send.return_value = True
+        now = time.time()
+        notification_id = save_notification(
+            4242, "push", "Doors open", send_at=datetime.fromtimestamp(now + 1)
+        )
+        early_channel = MagicMock()
+        consumed = []
+
+        def publish_many(messages, queue):
+            # A fast consumer gets the message before fire() marks it pending
+            for message in messages:
+                body = json.dumps(message).encode("utf-8")
+                consumed.append(body)
+                process_notification(early_channel, MagicMock(delivery_tag=1), None, body)
+            return [None] * len(messages)
+
+        publisher = MagicMock()
+        publisher.publish_many.side_effect = publish_many
+        scheduler = Scheduler(publisher, lookahead=60, jitter=0)
+
+        # Execute
+        scheduler.poll(now)
+        scheduler.fire(now + 1)
+        # The retry comes back once it's pending
+        process_notification(MagicMock(), MagicMock(delivery_tag=2), None, consumed[0])
+
+        # Assert
+        early_channel.basic_publish.assert_called_once()  # postponed via the delay queue
+        self.assertEqual(
+            early_channel.basic_publish.call_args[1]["routing_key"], "notifications.retry.1"
+        )
+        mock_get_service.return_value.send.assert_called_once_with(4242, "Doors open")
+        document = notifications_collection.find_one({"_id": ObjectId(notification_id)})
+        self.assertEqual(document["status"], "delivered")
+
+
+class TestDigests(unittest.TestCase):
+
+    def test_coalescer_keeps_memory_bounded(self):
+        """Test buffers go out when full, when memory runs out and when their window is up"""
+        # Setup
+        now = [0.0]
+        coalescer = DigestCoalescer(
+            types=["push"], window=10, max_items=3, max_buffered=4, clock=lambda: now[0]
+        )
+
+        def add(user_id):
+            return coalescer.add({"user_id": user_id, "type": "push"}, user_id)
+
+        # Execute
+        early = [add(1), add(1), add(2), add(2)]
+        evicted = add(3)
+        now[0] = 5
+        full = add(2)
+        not_due = coalescer.due()
+        now[0] = 10
+        due = coalescer.due(now[0] + 5)
+
+        # Assert
+        self.assertEqual(early, [[], [], [], []])
+        self.assertEqual([(b.key, b.reason, len(b)) for b in evicted], [((1, "push"), "memory", 2)])
+        self.assertEqual([(b.key, b.reason, len(b)) for b in full], [((2, "push"), "full", 3)])
+        self.assertEqual(not_due, [])
+        self.assertEqual([b.key for b in due], [(3, "push")])
+        self.assertEqual(len(coalescer), 0)
+        self.assertFalse(coalescer.wants({"user_id": 1, "type": "email"}))
+
+    @patch("consumer.update_notification_statuses")
+    @patch("consumer.get_notification_service")
+    def test_burst_goes_out_as_one_digest(self, mock_get_service, mock_update_statuses):
+        """Test a user's burst is held, then sent once with one status write"""
+        # Setup
+        services = {"push": MagicMock(), "email": MagicMock()}
+        services["push"].send.return_value = True
+        services["email"].send_batch.side_effect = lambda items: [True] * len(items)
+        mock_get_service.side_effect = services.get
+        mock_channel = MagicMock()
+        deliveries = []
+        for tag, (user_id, notification_type) in enumerate(
+            [(7, "push"), (7, "push"), (8, "email"), (7, "push")], start=1
+        ):
+            method = MagicMock()
+            method.delivery_tag = tag
+            body = json.dumps(
+                {
+                    "id": f"60f8f1b3c2d7a8f9e1d2c3b{tag}",
+                    "user_id": user_id,
+                    "type": notification_type,
+                    "content": f"Alert {tag}",
+                }
+            ).encode("utf-8")
+            deliveries.append((method, None, body))
+        coalescer = DigestCoalescer(types=["push"], window=30)
+
+        with patch("consumer.digests", coalescer):
+            # Execute
+            process_batch(mock_channel, deliveries)
+            held_acks = list(mock_channel.basic_ack.call_args_list)
+            services["push"].send.assert_not_called()
+            flush_digests(coalescer.drain())
+
+        # Assert
+        # The email went out as usual, acked on its own while the pushes wait
+        self.assertEqual(held_acks, [unittest.mock.call(delivery_tag=3)])
+        services["email"].send_batch.assert_called_once_with([(8, "Alert 3")])
+        services["push"].send.assert_called_once_with(
+            7, "You have 3 new notifications:\n- Alert 1\n- Alert 2\n- Alert 4"
+        )
+        mock_update_statuses.assert_called_with(
+            {
+                "60f8f1b3c2d7a8f9e1d2c3b1": "delivered",
+                "60f8f1b3c2d7a8f9e1d2c3b2": "delivered",
+                "60f8f1b3c2d7a8f9e1d2c3b4": "delivered",
+            },
+            ANY,
+        )
+        self.assertEqual(
+            mock_channel.basic_ack.call_args_list[1:],
+            [unittest.mock.call(delivery_tag=tag) for tag in (1, 2, 4)],
+        )
+
+
+class TestIndexBootstrap(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Needs a local mongod - skipped when there isn't one"""
+        cls.mongo_client = MongoClient(
+            "mongodb://localhost:27017/", serverSelectionTimeoutMS=1000
+        )
+        try:
+            cls.mongo_client.admin.command("ping")
+        except Exception:
+            raise unittest.SkipTest("No local mongod available")
+        cls.collection = cls.mongo_client["notification_service_test"]["index_check"]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.collection.drop()
+
+    def test_hot_queries_are_covered(self):
+        """Test that init_db's indexes serve the inbox and sweeper queries"""
+        # Setup
+        self.collection.insert_many(
+            [
+                {
+                    "user_id": user_id,
+                    "type": "email",
+                    "content": "Test content",
+                    "status": status,
+                    "created_at": datetime.now(),
+                }
+                for user_id in range(20)
+                for status in ("pending", "delivered", "failed")
+            ]
+        )
+
+        # Execute
+        verified = ensure_indexes(self.collection)
+        report = check_query_coverage(self.collection)
+
+        # Assert
+        self.assertEqual(verified, [spec["name"] for spec in NOTIFICATION_INDEXES])
+        for query_name, plan in report.items():
+            self.assertTrue(plan["covered"], f"{query_name}: {plan}")
+
+
+class TestInboxCache(unittest.TestCase):
+
+    def test_memory_backend_evicts_least_recently_used(self):
+        """Test that the cache stays within its size bound"""
+        cache = InboxCache(MemoryCacheBackend(max_entries=2, ttl=60))
+        cache.set(1, "page", {"n": 1})
+        cache.set(2, "page", {"n": 2})
+        cache.get(1, "page")  # 1 is now the most recently used
+        cache.set(3, "page", {"n": 3})
+
+        self.assertEqual(cache.get(1, "page"), {"n": 1})
+        self.assertIsNone(cache.get(2, "page"))
+        self.assertEqual(cache.get(3, "page"), {"n": 3})
+
+    @patch("cache.time.monotonic")
+    def test_memory_backend_expires_entries(self, mock_monotonic):
+        """Test TTL expiry and per-user invalidation"""
+        cache = InboxCache(MemoryCacheBackend(max_entries=10, ttl=30))
+        mock_monotonic.return_value = 100
+        cache.set(1, "a", {"n": 1})
+        cache.set(1, "b", {"n": 2})
+        cache.set(2, "a", {"n": 3})
+
+        mock_monotonic.return_value = 200
+        self.assertIsNone(cache.get(2, "a"))
+
+        mock_monotonic.return_value = 100
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1, "a"))
+        self.assertIsNone(cache.get(1, "b"))
+
+
+class TestRabbitMQPublisher(unittest.TestCase):
+
+    def test_publisher_reuses_connection(self):
+        """Test that the publisher connects and declares the queue only once"""
+        # Setup
+        mock_connection = MagicMock()
+        factory = MagicMock(return_value=mock_connection)
+        publisher = RabbitMQPublisher(connection_factory=factory, queue="test_queue")
+
+        # Execute
+        publisher.publish({"id": "1"})
+        publisher.publish({"id": "2"})
+
+        # Assert
+        factory.assert_called_once()
+        channel = mock_connection.channel.return_value
+        channel.queue_declare.assert_called_once_with(queue="test_queue", durable=True)
+        self.assertEqual(channel.basic_publish.call_count, 2)
+
+    def test_publisher_reconnects_after_connection_loss(self):
+        """Test that a dropped connection is replaced transparently"""
+        # Setup
+        dead_connection = MagicMock()
+        dead_connection.channel.return_value.basic_publish.side_effect = (
+            pika.exceptions.StreamLostError("connection reset")
+        )
+        live_connection = MagicMock()
+        factory = MagicMock(side_effect=[dead_connection, live_connection])
+        publisher = RabbitMQPublisher(connection_factory=factory, queue="test_queue")
+
+        # Execute
+        publisher.publish({"id": "1"})
+
+        # Assert
+        self.assertEqual(factory.call_count, 2)
+        live_connection.channel.return_value.basic_publish.assert_called_once()
+
+    def test_publisher_declares_write_behind_topology(self):
+        """Test that one publish reaches both bound queues through the exchange"""
+        # Setup
+        mock_connection = MagicMock()
+        publisher = RabbitMQPublisher(
+            connection_factory=MagicMock(return_value=mock_connection),
+            queue="notifications",
+            exchange="notifications.ingest",
+            bindings=[
+                ("notifications", "notifications"),
+                ("notifications.persist", "notifications"),
+            ],
+        )
+
+        # Execute
+        publisher.publish({"id": "1"})
+
+        # Assert
+        channel = mock_connection.channel.return_value
+        channel.exchange_declare.assert_called_once_with(
+            exchange="notifications.ingest", exchange_type="direct", durable=True
+        )
+        self.assertEqual(channel.queue_declare.call_count, 2)
+        self.assertEqual(channel.queue_bind.call_count, 2)
+        publish_kwargs = channel.basic_publish.call_args[1]
+        self.assertEqual(publish_kwargs["exchange"], "notifications.ingest")
+        self.assertEqual(publish_kwargs["routing_key"], "notifications")
+
+
+class TestConfirmingPublisher(unittest.TestCase):
+
+    def setUp(self):
+        """Wire up a publisher to a fake, already-open channel"""
+        self.publisher = ConfirmingPublisher(queue="test_queue", max_retries=1)
+        self.publisher._connection = MagicMock()
+        self.publisher._channel = MagicMock()
+        self.publisher._ready = True
+
+    def confirm(self, method_class, delivery_tag, multiple=False):
+        frame = MagicMock()
+        frame.method = method_class(delivery_tag=delivery_tag, multiple=multiple)
+        self.publisher._on_delivery_confirmation(frame)
+
+    def test_multiple_ack_resolves_every_covered_publish(self):
+        """Test that one multiple=True ack confirms all earlier delivery tags"""
+        # Execute
+        futures = [self.publisher.publish_async({"id": str(i)}) for i in range(3)]
+        self.publisher._drain_outbox()
+        self.confirm(pika.spec.Basic.Ack, 2, multiple=True)
+
+        # Assert
+        self.assertEqual(self.publisher._channel.basic_publish.call_count, 3)
+        self.assertTrue(futures[0].result(timeout=0))
+        self.assertTrue(futures[1].result(timeout=0))
+        self.assertFalse(futures[2].done())
+        self.assertEqual(list(self.publisher._unconfirmed), [3])
+
+    def test_nack_is_retried_then_fails(self):
+        """Test that nacked publishes are retried by the publisher itself"""
+        # Execute
+        future = self.publisher.publish_async({"id": "1"})
+        self.publisher._drain_outbox()
+        self.confirm(pika.spec.Basic.Nack, 1)
+
+        # Assert - first nack puts it back in the outbox
+        self.assertFalse(future.done())
+        self.publisher._drain_outbox()
+        self.assertEqual(self.publisher._channel.basic_publish.call_count, 2)
+
+        # Second nack uses up the retries
+        self.confirm(pika.spec.Basic.Nack, 2)
+        with self.assertRaises(PublishError):
+            future.result(timeout=0)
+
+    def test_timed_out_publish_never_goes_out(self):
+        """Test that a publish the caller gave up on is taken out of the outbox"""
+        # Setup - the I/O thread never gets round to draining
+        self.publisher.confirm_timeout = 0.01
+
+        # Execute
+        with self.assertRaises(PublishError):
+            self.publisher.publish({"id": "1"})
+        self.publisher._drain_outbox()
+
+        # Assert
+        self.assertEqual(len(self.publisher._outbox), 0)
+        self.publisher._channel.basic_publish.assert_not_called()
+
+    def test_late_confirm_after_timeout_is_ignored(self):
+        """Test that a sent publish that timed out isn't retried or resolved twice"""
+        # Setup
+        self.publisher.confirm_timeout = 0.01
+        item = self.publisher._enqueue({"id": "1"}, None)
+        self.publisher._drain_outbox()
+
+        # Execute
+        with self.assertRaises(FutureTimeoutError):
+            item.future.result(timeout=self.publisher.confirm_timeout)
+        self.publisher._cancel(item)
+        self.confirm(pika.spec.Basic.Nack, 1)
+        self.publisher._drain_outbox()
+
+        # Assert
+        with self.assertRaises(PublishError):
+            item.future.result(timeout=0)
+        self.assertEqual(self.publisher._channel.basic_publish.call_count, 1)
+        self.assertEqual(len(self.publisher._outbox), 0)
+
+
+class TestAsyncConsumer(unittest.TestCase):
+
+    def make_message(self, body):
+        message = MagicMock()
+        message.body = body
+        message.ack = AsyncMock()
+        message.nack = AsyncMock()
+        return message
+
+    @patch("async_consumer.update_notification_status", new_callable=AsyncMock)
+    @patch("async_consumer.get_notification_service")
+    def test_handle_message_success(self, mock_get_service, mock_update_status):
+        """Test that the async handler sends, records the status and acks"""
+        # Setup
+        mock_service = MagicMock()
+        mock_service.send_async = AsyncMock(return_value=True)
+        mock_get_service.return_value = mock_service
+        message = self.make_message(
+            json.dumps(
+                {
+                    "id": "60f8f1b3c2d7a8f9e1d2c3b4",
+                    "user_id": 123,
+                    "type": "email",
+                    "content": "Test content",
+                }
+            ).encode("utf-8")
+        )
+
+        # Execute
+        asyncio.run(handle_message(message))
+
+        # Assert
+        mock_service.send_async.assert_awaited_once_with(123, "Test content")
+        mock_update_status.assert_awaited_once_with(
+            "60f8f1b3c2d7a8f9e1d2c3b4", "delivered", ANY
+        )
+        message.ack.assert_awaited_once()
+        message.nack.assert_not_called()
+
+    @patch("async_consumer.update_notification_status", new_callable=AsyncMock)
+    @patch("async_consumer.get_notification_service")
+    def test_handle_message_error_requeues(self, mock_get_service, mock_update_status):
+        """Test that provider errors are nacked with requeue, bad JSON is acked"""
+        # Setup
+        mock_service = MagicMock()
+        mock_service.send_async = AsyncMock(side_effect=RuntimeError("provider down"))
+        mock_get_service.return_value = mock_service
+        failing = self.make_message(
+            json.dumps(
+                {
+                    "id": "60f8f1b3c2d7a8f9e1d2c3b4",
+                    "user_id": 123,
+                    "type": "sms",
+                    "content": "Test content",
+                }
+            ).encode("utf-8")
+        )
+        garbage = self.make_message(b"not json")
+
+        # Execute
+        asyncio.run(handle_message(failing))
+        asyncio.run(handle_message(garbage))
+
+        # Assert
+        failing.nack.assert_awaited_once_with(requeue=True)
+        garbage.ack.assert_awaited_once()
+        mock_update_status.assert_not_called()
+
+    @patch("async_consumer.update_notification_status", new_callable=AsyncMock)
+    @patch("async_consumer.get_notification_service")
+    def test_handle_message_error_goes_to_delay_queue(
+        self, mock_get_service, mock_update_status
+    ):
+        """Test that with a retry exchange, errors are republished and acked"""
+        # Setup
+        mock_service = MagicMock()
+        mock_service.send_async = AsyncMock(side_effect=RuntimeError("provider down"))
+        mock_get_service.return_value = mock_service
+        message = self.make_message(
+            json.dumps(
+                {
+                    "id": "60f8f1b3c2d7a8f9e1d2c3b4",
+                    "user_id": 123,
+                    "type": "sms",
+                    "content": "Test content",
+                }
+            ).encode("utf-8")
+        )
+        message.headers = {"x-attempt": 2}
+        retry_exchange = MagicMock()
+        retry_exchange.publish = AsyncMock()
+
+        # Execute
+        asyncio.run(handle_message(message, retry_exchange))
+
+        # Assert
+        published, = retry_exchange.publish.await_args[0]
+        self.assertEqual(published.headers["x-attempt"], 3)
+        self.assertEqual(
+            retry_exchange.publish.await_args[1]["routing_key"], "notifications.retry.3"
+        )
+        message.ack.assert_awaited_once()
+        message.nack.assert_not_called()
+
+    def test_concurrency_is_capped_per_channel(self):
+        """Test that a busy channel can't take the send slots of another"""
+        # Setup - sends that don't finish until we say so
+        release = None
+
+        async def slow_send(message, retry_exchange, lane):
+            await release.wait()
+
+        async def run():
+            nonlocal release
+            release = asyncio.Event()
+            consumer = AsyncConsumer(
+                concurrency=2, channels=2, lanes=[Lane("default", "notifications", 1)]
+            )
+
+            # Execute
+            for _ in range(5):
+                consumer.dispatch("default", MagicMock(), channel=0)
+            busy = len(consumer._tasks)
+            consumer.dispatch("default", MagicMock(), channel=1)
+            other = len(consumer._tasks)
+            release.set()
+            while consumer._tasks:
+                await asyncio.wait(set(consumer._tasks))
+            return busy, other, consumer._in_flight
+
+        with patch("async_consumer.handle_message", side_effect=slow_send):
+            busy, other, in_flight = asyncio.run(run())
+
+        # Assert - channel 0 stops at 2 with 3 waiting, channel 1 still gets a slot
+        self.assertEqual(busy, 2)
+        self.assertEqual(other, 3)
+        self.assertEqual(in_flight, [0, 0])
+
+
+class TestConsumerSupervisor(unittest.TestCase):
+
+    def test_desired_worker_count(self):
+        """Test that the worker count follows queue depth within bounds"""
+        self.assertEqual(desired_worker_count(0, 1, 8, 1000), 1)
+        self.assertEqual(desired_worker_count(2500, 1, 8, 1000), 3)
+        self.assertEqual(desired_worker_count(1000000, 1, 8, 1000), 8)
+
+    @patch("supervisor.get_rabbitmq_connection")
+    def test_queue_depth_covers_every_lane(self, mock_get_connection):
+        """Test that a backlog in any priority lane counts towards scaling"""
+        # Setup
+        depths = {"notifications.transactional": 40, "notifications": 2}
+
+        def queue_declare(queue, **kwargs):
+            if queue not in depths:
+                raise pika.exceptions.ChannelClosedByBroker(404, "NOT_FOUND")
+            return MagicMock(method=MagicMock(message_count=depths[queue]))
+
+        channel = mock_get_connection.return_value.channel.return_value
+        channel.queue_declare.side_effect = queue_declare
+
+        # Execute
+        depth = get_queue_depth(
+            ["notifications.transactional", "notifications", "notifications.bulk"]
+        )
+
+        # Assert
+        self.assertEqual(depth, 42)
+        mock_get_connection.return_value.close.assert_called_once()
+
+    @patch("supervisor.time.sleep")
+    @patch("supervisor.multiprocessing.Process")
+    def test_dead_workers_are_restarted(self, mock_process_class, mock_sleep):
+        """Test that a crashed child is replaced on the next tick"""
+        # Setup
+        mock_process_class.side_effect = lambda **kwargs: MagicMock()
+        supervisor = ConsumerSupervisor(workers=2, autoscale=False)
+        supervisor.tick()
+        crashed = supervisor.workers[0]
+        crashed.is_alive.return_value = False
+
+        # Execute
+        supervisor.tick()
+
+        # Assert
+        self.assertEqual(mock_process_class.call_count, 3)
+        self.assertEqual(len(supervisor.workers), 2)
+        self.assertNotIn(crashed, supervisor.workers)
+
+    @patch("supervisor.time.sleep")
+    @patch("supervisor.multiprocessing.Process")
+    def test_workers_keep_fixed_metrics_ports(self, mock_process_class, mock_sleep):
+        """Test that a restarted worker gets the crashed one's metrics port back"""
+        # Setup
+        mock_process_class.side_effect = lambda **kwargs: MagicMock()
+        supervisor = ConsumerSupervisor(workers=3, autoscale=False, metrics_port=9100)
+        supervisor.tick()
+        supervisor.workers[1].is_alive.return_value = False
+
+        # Execute
+        supervisor.tick()
+
+        # Assert
+        ports = [call[1]["kwargs"]["metrics_port"] for call in mock_process_class.call_args_list]
+        self.assertEqual(ports, [9100, 9101, 9102, 9101])
+        self.assertEqual(sorted(process.slot for process in supervisor.workers), [0, 1, 2])
+
+
+class TestAsgiApp(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = TestClient(asgi.app)
+
+    def test_send_notification_api(self):
+        """Test that the async entry point matches the Flask response shape"""
+        with patch(
+            "asgi.async_database.save_notification", new_callable=AsyncMock
+        ) as mock_save, patch(
+            "asgi.publisher.publish", new_callable=AsyncMock
+        ) as mock_publish:
+            mock_save.return_value = "60f8f1b3c2d7a8f9e1d2c3b4"
+
+            # Execute
+            response = self.client.post(
+                "/notifications",
+                json={"user_id": 123, "type": "email", "content": "Test content"},
+            )
+
+            # Assert
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                response.json(),
+                {
+                    "message": "Notification sent successfully",
+                    "notification_id": "60f8f1b3c2d7a8f9e1d2c3b4",
+                },
+            )
+            mock_save.assert_awaited_once_with(123, "email", "Test content")
+            mock_publish.assert_awaited_once()
+
+    @patch("asgi.INGESTION_MODE", "write_behind")
+    def test_send_notification_api_write_behind(self):
+        """Test that write-behind mode publishes first and leaves the insert to the persister"""
+        with patch(
+            "asgi.async_database.save_notification", new_callable=AsyncMock
+        ) as mock_save, patch(
+            "asgi.publisher.publish", new_callable=AsyncMock
+        ) as mock_publish:
+            # Execute
+            response = self.client.post(
+                "/notifications",
+                json={"user_id": 123, "type": "email", "content": "Test content"},
+            )
+
+            # Assert
+            self.assertEqual(response.status_code, 200)
+            mock_save.assert_not_awaited()
+            message = mock_publish.call_args[0][0]
+            self.assertEqual(message["id"], response.json()["notification_id"])
+            self.assertIn("created_at", message)
+            self.assertNotIn("persisted", message["timestamps"])
+
+    def test_async_publisher_write_behind_topology(self):
+        """Test that the async publisher goes through the ingest exchange in write-behind mode"""
+        with patch("publisher.INGESTION_MODE", "write_behind"):
+            publisher = AsyncPublisher.from_config()
+        self.assertEqual(publisher.exchange_name, "notifications.ingest")
+        self.assertIn(("notifications.persist", "notifications"), publisher.bindings)
+
+    @patch.object(inbox_cache, "backend", new_callable=MemoryCacheBackend)
+    @patch("async_database.apply_counter_deltas", new_callable=AsyncMock)
+    @patch("async_database.get_notifications_collection")
+    def test_async_writes_invalidate_the_inbox_cache(self, mock_collection, mock_deltas, _):
+        """Test that Motor writes drop the user's cached inbox pages like database.py does"""
+        # Setup
+        collection = mock_collection.return_value
+        collection.insert_one = AsyncMock()
+        collection.insert_one.return_value.inserted_id = ObjectId()
+        collection.find_one_and_update = AsyncMock(
+            return_value={"_id": ObjectId(), "user_id": 7, "status": "pending"}
+        )
+        inbox_cache.set(123, "page", {"notifications": []})
+        inbox_cache.set(7, "page", {"notifications": []})
+
+        # Execute
+        asyncio.run(async_database.save_notification(123, "email", "Test content"))
+        asyncio.run(
+            async_database.update_notification_status(str(ObjectId()), "delivered")
+        )
+
+        # Assert
+        self.assertIsNone(inbox_cache.get(123, "page"))
+        self.assertIsNone(inbox_cache.get(7, "page"))
+        self.assertEqual(AsyncPublisher.from_config().exchange_name, "")
+
+    @patch("async_database.STATUS_UPSERT", True)
+    def test_async_status_update_upserts_in_write_behind_mode(self):
+        """Test the async consumer's status write survives beating the persister"""
+        # Setup
+        collection = MagicMock()
+        collection.find_one_and_update = AsyncMock(
+            side_effect=[DuplicateKeyError("raced the persister"), {"_id": 1}]
+        )
+
+        # Execute
+        with patch("async_database.get_notifications_collection", return_value=collection):
+            asyncio.run(
+                async_database.update_notification_status("60f8f1b3c2d7a8f9e1d2c3b4", "delivered")
+            )
+
+        # Assert
+        first, retry = collection.find_one_and_update.call_args_list
+        self.assertTrue(first[1]["upsert"])
+        self.assertNotIn("upsert", retry[1])
+
+    def test_send_notification_api_validation(self):
+        """Test that the async entry point applies the same validation"""
+        response = self.client.post(
+            "/notifications", json={"user_id": 123, "type": "fax", "content": "x"}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("type must be one of", response.json()["error"])
+
+    def test_get_user_notifications_api(self):
+        """Test the async inbox endpoint"""
+        with patch(
+            "asgi.async_database.get_user_notifications_page", new_callable=AsyncMock
+        ) as mock_get:
+            mock_get.return_value = {
+                "notifications": [{"id": "60f8f1b3c2d7a8f9e1d2c3b4"}],
+                "next_cursor": None,
+                "prev_cursor": None,
+            }
+
+            response = self.client.get("/users/123/notifications?limit=5")
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()["user_id"], 123)
+            mock_get.assert_awaited_once_with(123, 5)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,271 @@
+"""Request validation shared by the Flask and ASGI endpoints."""
+
+import datetime
+from jinja2 import TemplateSyntaxError
+from config import (
+    INBOX_DEFAULT_LIMIT,
+    INBOX_MAX_LIMIT,
+    DEAD_LETTER_LIST_MAX,
+    TEMPLATE_MAX_BYTES,
+    FANOUT_MAX_USER_IDS,
+    BATCH_MAX_SIZE,
+)
+from notification_services import registry
+from lanes import lane_names
+from templates import compile_template
+
+INBOX_FIELDS = ("type", "content", "template_id", "variables", "status", "created_at")
+
+
+def validate_notification(data):
+    """
+    Check a notification payload before we store or queue it
+
+    Returns None when everything looks good, otherwise the error message
+    the API should send back
+    """
+    if not isinstance(data, dict):
+        return "notification must be a JSON object"
+
+    if not data.get("user_id"):
+        return "user_id is required"
+
+    return validate_message(data)
+
+
+def validate_message(data):
+    """
+    The checks on what's being sent (type, content or template, priority,
+    tenant, send_at), whoever it's for
+    """
+    if not data.get("type"):
+        return "type is required"
+
+    # Either the text itself, or a registered template and its variables
+    if data.get("content") and data.get("template_id"):
+        return "use either content or template_id, not both"
+    if data.get("template_id"):
+        if not isinstance(data["template_id"], str):
+            return "template_id must be a string"
+        if not isinstance(data.get("variables", {}), dict):
+            return "variables must be an object"
+    elif not data.get("content"):
+        return "content or template_id is required"
+
+    # Whatever the provider registry knows about, plugins included
+    valid_types = registry.types()
+    if data["type"] not in valid_types:
+        return f"type must be one of: {', '.join(valid_types)}"
+
+    # Optional - leaving it out means the default lane
+    priority = data.get("priority")
+    if priority is not None and priority not in lane_names():
+        return f"priority must be one of: {', '.join(lane_names())}"
+
+    # Optional - who it's sent on behalf of, for per-tenant rate limits
+    tenant_id = data.get("tenant_id")
+    if tenant_id is not None and (not isinstance(tenant_id, str) or not tenant_id):
+        return "tenant_id must be a non-empty string"
+
+    _, error = parse_send_at(data.get("send_at"))
+    return error
+
+
+def parse_send_at(value):
+    """
+    Read an optional send_at (ISO 8601) into a naive local datetime
+
+    Everything in Mongo is naive local time (datetime.now()), so times with
+    an offset are converted to that
+
+    Returns:
+        tuple: (datetime or None, error message)
+    """
+    if value is None:
+        return None, None
+    if not isinstance(value, str):
+        return None, "send_at must be an ISO 8601 datetime"
+    try:
+        return parse_local_datetime(value), None
+    except ValueError:
+        return None, "send_at must be an ISO 8601 datetime"
+
+
+def parse_local_datetime(value):
+    """
+    An ISO 8601 date or datetime ("Z" and offsets allowed) as naive local time
+
+    That's how created_at and send_at are stored, so this is what queries
+    have to compare against. Raises ValueError if it isn't ISO 8601.
+    """
+    parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+def scheduled_for(data):
+    """When a valid notification should go out, or None for right away (send_at unset or past)"""
+    send_at, _ = parse_send_at(data.get("send_at"))
+    if send_at is None or send_at <= datetime.datetime.now():
+        return None
+    return send_at
+
+
+def validate_user_ids(user_ids, maximum):
+    """A non-empty list of at most `maximum` integer user ids - returns the error, or None"""
+    if not isinstance(user_ids, list) or not user_ids:
+        return "user_ids must be a non-empty list"
+    if len(user_ids) > maximum:
+        return f"user_ids must not have more than {maximum} entries"
+    if not all(isinstance(user_id, int) and not isinstance(user_id, bool) for user_id in user_ids):
+        return "user_ids must be integers"
+    return None
+
+
+def validate_fanout(data):
+    """
+    Check a fan-out request: a notification for a list of users or a segment
+
+    Returns None when it's fine, otherwise the error message
+    """
+    if not isinstance(data, dict):
+        return "fan-out request must be a JSON object"
+
+    if ("user_ids" in data) == ("segment_id" in data):
+        return "either user_ids or segment_id is required"
+    if "user_ids" in data:
+        error = validate_user_ids(data["user_ids"], FANOUT_MAX_USER_IDS)
+        if error:
+            return error
+    elif not data["segment_id"] or not isinstance(data["segment_id"], str):
+        return "segment_id must be a non-empty string"
+
+    if "send_at" in data:
+        return "send_at isn't supported for fan-out requests"
+
+    return validate_message(data)
+
+
+def validate_segment_members(data):
+    """Check a request adding users to a segment"""
+    if not isinstance(data, dict):
+        return "request must be a JSON object"
+    return validate_user_ids(data.get("user_ids"), BATCH_MAX_SIZE)
+
+
+def validate_template(data):
+    """
+    Check a template before we register it
+
+    Returns None when it's fine, otherwise the error message - including
+    where the template doesn't compile
+    """
+    if not isinstance(data, dict):
+        return "template must be a JSON object"
+
+    template_id = data.get("template_id")
+    if not template_id or not isinstance(template_id, str):
+        return "template_id is required"
+
+    content = data.get("content")
+    if not content or not isinstance(content, str):
+        return "content is required"
+    if len(content.encode("utf-8")) > TEMPLATE_MAX_BYTES:
+        return f"content must not exceed {TEMPLATE_MAX_BYTES} bytes"
+
+    try:
+        compile_template(content)
+    except TemplateSyntaxError as e:
+        return f"template does not compile (line {e.lineno}): {e.message}"
+
+    return None
+
+
+def parse_inbox_params(args):
+    """
+    Read the inbox query string (?limit=&before=&after=&status=&type=&fields=)
+
+    Returns:
+        tuple: (limit, options for get_user_notifications_page, error message)
+    """
+    try:
+        limit = int(args.get("limit", INBOX_DEFAULT_LIMIT))
+    except ValueError:
+        return None, None, "limit must be a number"
+    if not 1 <= limit <= INBOX_MAX_LIMIT:
+        return None, None, f"limit must be between 1 and {INBOX_MAX_LIMIT}"
+
+    options = {}
+    if args.get("before") and args.get("after"):
+        return None, None, "use either before or after, not both"
+    for name in ("before", "after", "status"):
+        if args.get(name):
+            options[name] = args.get(name)
+
+    notification_type = args.get("type")
+    if notification_type:
+        valid_types = registry.types()
+        if notification_type not in valid_types:
+            return None, None, f"type must be one of: {', '.join(valid_types)}"
+        options["notification_type"] = notification_type
+
+    if args.get("fields"):
+        fields = [field.strip() for field in args.get("fields").split(",") if field.strip()]
+        unknown = [field for field in fields if field not in INBOX_FIELDS]
+        if unknown:
+            return None, None, f"fields must be drawn from: {', '.join(INBOX_FIELDS)}"
+        options["fields"] = fields
+
+    return limit, options, None
+
+
+EXPORT_FORMATS = ("ndjson", "gzip")
+
+
+def parse_export_params(args):
+    """
+    Read the export query string (?from=&to=&format=)
+
+    from/to are ISO 8601 dates or datetimes (to is exclusive; ones with an
+    offset are converted to local time, like created_at), format is ndjson
+    (default) or gzip
+
+    Returns:
+        tuple: (start, end, compress, error message)
+    """
+    bounds = []
+    for name in ("from", "to"):
+        value = args.get(name)
+        if not value:
+            bounds.append(None)
+            continue
+        try:
+            bounds.append(parse_local_datetime(value))
+        except ValueError:
+            return None, None, None, f"{name} must be an ISO 8601 date or datetime"
+    start, end = bounds
+    if start and end and start >= end:
+        return None, None, None, "from must be earlier than to"
+
+    export_format = args.get("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        return None, None, None, f"format must be one of: {', '.join(EXPORT_FORMATS)}"
+
+    return start, end, export_format == "gzip", None
+
+
+def parse_dead_letter_limit(value, maximum=DEAD_LETTER_LIST_MAX):
+    """
+    How many dead letters to list or replay (default 100)
+
+    Returns:
+        tuple: (limit, error message)
+    """
+    try:
+        limit = int(value if value is not None else 100)
+    except (TypeError, ValueError):
+        return None, "limit must be a number"
+    if not 1 <= limit <= maximum:
+        return None, f"limit must be between 1 and {maximum}"
+    return limit, None